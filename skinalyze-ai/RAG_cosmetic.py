@@ -1,5 +1,7 @@
 import os
 import re
+import asyncio
+import hashlib
 import pandas as pd
 from pathlib import Path
 import chromadb
@@ -14,7 +16,7 @@ from langchain_core.output_parsers import StrOutputParser
 import torch
 import time
 from getpass import getpass
-from PIL import Image
+from PIL import Image, ImageOps
 import google.generativeai as genai
 from datetime import datetime
 import json
@@ -22,6 +24,8 @@ import base64
 import io
 from dotenv import load_dotenv
 
+from config import VISION_MAX_SIDE, VISION_JPEG_QUALITY
+
 # =============================================================================
 # CẤU HÌNH HỆ THỐNG
 # =============================================================================
@@ -42,6 +46,16 @@ _CACHED_EMBEDDINGS = None
 # Tỷ giá USD → VND (cố định)
 USD_TO_VND = 26349
 
+# Gemini model cho vision + smart filtering: tạo 1 lần / process (giữ client + connection), không tạo mỗi request
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+_GEMINI_MODELS = {}
+
+# Settings ảnh hưởng tới câu trả lời của RAG chain (cũng là một phần của key single-flight ở main.py)
+RAG_LLM_SETTINGS = {"model": "gemini-2.5-flash", "temperature": 0.3, "max_output_tokens": 2000}
+
+# Ảnh gửi lên Gemini vision (sau normalize) + thời gian chuẩn bị ảnh / gọi model -> /metrics
+VISION_STATS = {"requests": 0, "bytes_sent": 0, "prepare_ms_total": 0.0, "gemini_ms_total": 0.0}
+
 # =============================================================================
 # DATA MAPPING (MỚI)
 # =============================================================================
@@ -201,10 +215,43 @@ def setup_api_key():
     # Configure genai for vision
     genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
 
+def get_gemini_model(model_name: str = GEMINI_MODEL_NAME):
+    """GenerativeModel dùng chung (cần genai.configure trước lần gọi đầu tiên - xem setup_api_key)"""
+    model = _GEMINI_MODELS.get(model_name)
+    if model is None:
+        model = _GEMINI_MODELS[model_name] = genai.GenerativeModel(model_name)
+    return model
+
+def embedding_device() -> str:
+    """Thiết bị chạy embedding model (dùng cả khi tải model lẫn khi dọn cache GPU lúc tạo Vector Store)"""
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def load_embedding_model():
+    """Tải embedding model (cache theo process - preload trước fork thì các worker dùng chung)."""
+    global _CACHED_EMBEDDINGS
+
+    if _CACHED_EMBEDDINGS is not None:
+        print(f"\n⚡ Sử dụng cached embedding model")
+        return _CACHED_EMBEDDINGS
+
+    print(f"\n⏳ Đang tải embedding model: {MODEL_NAME}...")
+    device = embedding_device()
+    print(f"    🖥️ Sử dụng thiết bị: {device}")
+
+    try:
+        _CACHED_EMBEDDINGS = HuggingFaceEmbeddings(
+            model_name=MODEL_NAME,
+            model_kwargs={'device': device},
+            encode_kwargs={'normalize_embeddings': True}
+        )
+        print("✅ Đã tải embedding model!\n")
+    except Exception as e_embed_load:
+        print(f"\n❌ LỖI NGHIÊM TRỌNG khi tải embedding model: {e_embed_load}")
+        print("    Kiểm tra lại tên model, kết nối mạng và cài đặt thư viện.")
+    return _CACHED_EMBEDDINGS
+
 def load_or_create_vectorstore():
     """Load vector store có sẵn hoặc tạo mới nếu chưa có, với error handling."""
-    global _CACHED_EMBEDDINGS
-    
     print("=" * 80)
     print("📚 KHỞI TẠO VECTOR STORE")
     print("=" * 80)
@@ -215,26 +262,10 @@ def load_or_create_vectorstore():
     try: # <<< Try chính bao quanh toàn bộ hàm >>>
         
         # ----- Tải Embedding Model (với cache) -----
-        if _CACHED_EMBEDDINGS is not None:
-            print(f"\n⚡ Sử dụng cached embedding model")
-            embeddings = _CACHED_EMBEDDINGS
-        else:
-            print(f"\n⏳ Đang tải embedding model: {MODEL_NAME}...")
-            device = 'cuda' if torch.cuda.is_available() else 'cpu'
-            print(f"    🖥️ Sử dụng thiết bị: {device}")
-            
-            try: # <<< Try cho việc tải embedding model >>>
-                embeddings = HuggingFaceEmbeddings(
-                    model_name=MODEL_NAME,
-                    model_kwargs={'device': device},
-                    encode_kwargs={'normalize_embeddings': True}
-                )
-                _CACHED_EMBEDDINGS = embeddings  # Cache lại
-                print("✅ Đã tải embedding model!\n")
-            except Exception as e_embed_load:
-                print(f"\n❌ LỖI NGHIÊM TRỌNG khi tải embedding model: {e_embed_load}")
-                print("    Kiểm tra lại tên model, kết nối mạng và cài đặt thư viện.")
-                return None, None # Trả về None nếu không tải được model
+        embeddings = load_embedding_model()
+        if embeddings is None:
+            return None, None # Trả về None nếu không tải được model
+        device = embedding_device()
 
         # ----- Load hoặc Tạo Database -----
         if os.path.exists(PERSIST_DIRECTORY):
@@ -402,8 +433,169 @@ def load_or_create_vectorstore():
 
     return db, embeddings
 
-def setup_rag_chain(db):
-    """Thiết lập RAG chain với Retriever, LLM và Prompt"""
+# GROUNDING CHECK: context khi không tìm được sản phẩm nào (prompt bắt buộc trả lời "không tìm thấy")
+NO_PRODUCTS_CONTEXT = "KHÔNG TÌM THẤY SẢN PHẨM TRONG DATABASE"
+
+def select_products(docs):
+    """NHÓM chunks theo product_name, lọc sản phẩm có đủ thông tin, lấy top 3 theo relevance -> [(product_name, data)]"""
+    
+    # GROUNDING CHECK: Kiểm tra xem có chunks không
+    if not docs or len(docs) == 0:
+        return []
+    
+    # DEBUG: In số chunks tìm được
+    print(f"    🔍 Tìm được {len(docs)} chunks từ database")
+    
+    # Bước 1: Nhóm các chunks theo product_name và theo dõi thứ tự xuất hiện
+    product_groups = {}  # {product_name: {'chunks': [], 'first_index': int, 'metadata': {}}}
+    
+    for idx, doc in enumerate(docs):
+        product_name = doc.metadata.get('product_name', 'Unknown Product')
+        
+        if product_name not in product_groups:
+            # Trích xuất metadata từ chunk đầu tiên
+            content_lower = doc.page_content.lower()
+            metadata = {
+                'brand': extract_field_from_chunk(doc.page_content, 'Brand'),
+                'category': extract_field_from_chunk(doc.page_content, 'Category'),
+                'suitable_for': extract_field_from_chunk(doc.page_content, 'Suitable for'),
+                'rank': extract_field_from_chunk(doc.page_content, 'Rank'),
+                'price': extract_field_from_chunk(doc.page_content, 'Price')
+            }
+            
+            product_groups[product_name] = {
+                'chunks': [],
+                'first_index': idx,  # Lưu vị trí xuất hiện đầu tiên (relevance score)
+                'metadata': metadata,
+                'has_summary': False,
+                'has_ingredients': False
+            }
+        
+        # Đánh dấu loại chunk
+        if 'chunk type: product summary' in doc.page_content.lower():
+            product_groups[product_name]['has_summary'] = True
+        if 'chunk type: ingredients' in doc.page_content.lower():
+            product_groups[product_name]['has_ingredients'] = True
+        
+        product_groups[product_name]['chunks'].append(doc)
+    
+    # GROUNDING CHECK: Kiểm tra có sản phẩm nào không
+    if not product_groups or len(product_groups) == 0:
+        return []
+    
+    # DEBUG: In số sản phẩm tìm được
+    print(f"    📦 Tìm được {len(product_groups)} sản phẩm khác nhau")
+    
+    # Bước 2: Lọc sản phẩm có đủ thông tin (ưu tiên có summary)
+    complete_products = []
+    for name, data in product_groups.items():
+        if data['has_summary']:  # Ưu tiên sản phẩm có summary
+            complete_products.append((name, data))
+    
+    # Nếu không có sản phẩm nào có summary, lấy tất cả
+    if not complete_products:
+        complete_products = list(product_groups.items())
+    
+    # Bước 3: Sắp xếp sản phẩm theo relevance (first_index càng nhỏ = càng relevant)
+    sorted_products = sorted(
+        complete_products,
+        key=lambda x: x[1]['first_index']
+    )
+    
+    # Bước 4: Chọn top 3 sản phẩm để đảm bảo ĐỒNG NHẤT thông tin
+    num_products = min(3, len(sorted_products))  # Tối đa 3 sản phẩm
+    selected_products = sorted_products[:num_products]
+    
+    print(f"    ✅ Chọn {num_products} sản phẩm để tư vấn")
+    
+    return selected_products
+
+def format_products(selected_products):
+    """Gộp chunks của các sản phẩm đã chọn thành context cho prompt (loại duplicate, Summary -> Ingredients)"""
+    if not selected_products:
+        return NO_PRODUCTS_CONTEXT
+    
+    # Bước 5: Gộp và format chunks của mỗi sản phẩm
+    formatted = []
+    for i, (product_name, data) in enumerate(selected_products, 1):
+        chunks = data['chunks']
+        metadata = data['metadata']
+        
+        # Loại bỏ duplicate chunks (dựa trên page_content)
+        seen_contents = set()
+        unique_chunks = []
+        for chunk in chunks:
+            content_hash = hash(chunk.page_content.strip())
+            if content_hash not in seen_contents:
+                seen_contents.add(content_hash)
+                unique_chunks.append(chunk)
+        
+        # Sắp xếp chunks theo loại: Summary trước, Ingredients sau
+        def chunk_priority(chunk):
+            content = chunk.page_content.lower()
+            if 'chunk type: product summary' in content:
+                return 0  # Summary đầu tiên
+            elif 'chunk type: ingredients' in content:
+                return 1  # Ingredients sau
+            else:
+                return 2  # Các loại khác cuối cùng
+        
+        sorted_chunks = sorted(unique_chunks, key=chunk_priority)
+        
+        # Gộp thông tin sản phẩm với header rõ ràng
+        product_info = f"{'='*80}\n"
+        product_info += f"SẢN PHẨM #{i}: {product_name}\n"
+        product_info += f"{'='*80}\n"
+        
+        # Thêm metadata tổng hợp nếu có
+        if metadata['brand']:
+            product_info += f"🏢 Thương hiệu: {metadata['brand']}\n"
+        if metadata['category']:
+            product_info += f"📁 Loại: {metadata['category']}\n"
+        if metadata['suitable_for']:
+            product_info += f"👤 Phù hợp: {metadata['suitable_for']}\n"
+        if metadata['rank']:
+            product_info += f"⭐ Đánh giá: {metadata['rank']}\n"
+        if metadata['price']:
+            price_vnd = convert_price_in_text(f"Price: {metadata['price']}")
+            product_info += f"💰 {price_vnd}\n"
+        
+        product_info += f"{'-'*80}\n\n"
+        
+        # Thêm nội dung chi tiết từ chunks
+        for chunk in sorted_chunks:
+            content = chunk.page_content.strip()
+            # Chuyển đổi giá USD → VND
+            content = convert_price_in_text(content)
+            product_info += content + "\n\n"
+        
+        formatted.append(product_info)
+    
+    result = "\n\n".join(formatted)
+    
+    return result
+
+def format_docs(docs):
+    """Format documents: NHÓM chunks theo product_name, lấy 3-4 sản phẩm, sắp xếp chunks theo loại"""
+    return format_products(select_products(docs))
+
+def product_summaries(selected_products):
+    """Thông tin cơ bản của các sản phẩm đã chọn (tên, thương hiệu, loại, loại da, đánh giá, giá VND) cho client"""
+    summaries = []
+    for product_name, data in selected_products:
+        metadata = data['metadata']
+        summaries.append({
+            "name": product_name,
+            "brand": metadata['brand'],
+            "category": metadata['category'],
+            "suitable_for": metadata['suitable_for'],
+            "rank": metadata['rank'],
+            "price": convert_price_in_text(metadata['price']) if metadata['price'] else None,
+        })
+    return summaries
+
+def build_rag_components(db):
+    """Retriever, Prompt và LLM của RAG chain -> (retriever, prompt, llm), dùng chung cho rag_chain và RagStreamer"""
     print("\n" + "=" * 80)
     print("⛓️ KHỞI TẠO RAG CHAIN")
     print("=" * 80)
@@ -416,9 +608,7 @@ def setup_rag_chain(db):
     # 1. Khởi tạo LLM (tối ưu cho 2-3 sản phẩm ĐỒNG NHẤT)
     print("\n🤖 [1/3] Đang kết nối với Google Gemini...")
     llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash", 
-        temperature=0.3,  
-        max_output_tokens=2000,  
+        **RAG_LLM_SETTINGS,
         convert_system_message_to_human=True,
         request_timeout=90,
         max_retries=3  
@@ -598,139 +788,16 @@ TRẢ LỜI (mặc định 2 sản phẩm, hoặc đúng số lượng user yêu
     prompt = ChatPromptTemplate.from_template(template)
     print("    ✓ Đã tạo Prompt Template (compact + smart filtering)")
     
-    # 4. Xây dựng RAG Chain với NHÓM CHUNKS THEO SẢN PHẨM và GROUNDING CHECK
-    def format_docs(docs):
-        """Format documents: NHÓM chunks theo product_name, lấy 3-4 sản phẩm, sắp xếp chunks theo loại"""
-        
-        # GROUNDING CHECK: Kiểm tra xem có chunks không
-        if not docs or len(docs) == 0:
-            return "KHÔNG TÌM THẤY SẢN PHẨM TRONG DATABASE"
-        
-        # DEBUG: In số chunks tìm được
-        print(f"    🔍 Tìm được {len(docs)} chunks từ database")
-        
-        # Bước 1: Nhóm các chunks theo product_name và theo dõi thứ tự xuất hiện
-        product_groups = {}  # {product_name: {'chunks': [], 'first_index': int, 'metadata': {}}}
-        
-        for idx, doc in enumerate(docs):
-            product_name = doc.metadata.get('product_name', 'Unknown Product')
-            
-            if product_name not in product_groups:
-                # Trích xuất metadata từ chunk đầu tiên
-                content_lower = doc.page_content.lower()
-                metadata = {
-                    'brand': extract_field_from_chunk(doc.page_content, 'Brand'),
-                    'category': extract_field_from_chunk(doc.page_content, 'Category'),
-                    'suitable_for': extract_field_from_chunk(doc.page_content, 'Suitable for'),
-                    'rank': extract_field_from_chunk(doc.page_content, 'Rank'),
-                    'price': extract_field_from_chunk(doc.page_content, 'Price')
-                }
-                
-                product_groups[product_name] = {
-                    'chunks': [],
-                    'first_index': idx,  # Lưu vị trí xuất hiện đầu tiên (relevance score)
-                    'metadata': metadata,
-                    'has_summary': False,
-                    'has_ingredients': False
-                }
-            
-            # Đánh dấu loại chunk
-            if 'chunk type: product summary' in doc.page_content.lower():
-                product_groups[product_name]['has_summary'] = True
-            if 'chunk type: ingredients' in doc.page_content.lower():
-                product_groups[product_name]['has_ingredients'] = True
-            
-            product_groups[product_name]['chunks'].append(doc)
-        
-        # GROUNDING CHECK: Kiểm tra có sản phẩm nào không
-        if not product_groups or len(product_groups) == 0:
-            return "KHÔNG TÌM THẤY SẢN PHẨM TRONG DATABASE"
-        
-        # DEBUG: In số sản phẩm tìm được
-        print(f"    📦 Tìm được {len(product_groups)} sản phẩm khác nhau")
-        
-        # Bước 2: Lọc sản phẩm có đủ thông tin (ưu tiên có summary)
-        complete_products = []
-        for name, data in product_groups.items():
-            if data['has_summary']:  # Ưu tiên sản phẩm có summary
-                complete_products.append((name, data))
-        
-        # Nếu không có sản phẩm nào có summary, lấy tất cả
-        if not complete_products:
-            complete_products = list(product_groups.items())
-        
-        # Bước 3: Sắp xếp sản phẩm theo relevance (first_index càng nhỏ = càng relevant)
-        sorted_products = sorted(
-            complete_products,
-            key=lambda x: x[1]['first_index']
-        )
-        
-        # Bước 4: Chọn top 3 sản phẩm để đảm bảo ĐỒNG NHẤT thông tin
-        num_products = min(3, len(sorted_products))  # Tối đa 3 sản phẩm
-        selected_products = sorted_products[:num_products]
-        
-        print(f"    ✅ Chọn {num_products} sản phẩm để tư vấn")
-        
-        # Bước 5: Gộp và format chunks của mỗi sản phẩm
-        formatted = []
-        for i, (product_name, data) in enumerate(selected_products, 1):
-            chunks = data['chunks']
-            metadata = data['metadata']
-            
-            # Loại bỏ duplicate chunks (dựa trên page_content)
-            seen_contents = set()
-            unique_chunks = []
-            for chunk in chunks:
-                content_hash = hash(chunk.page_content.strip())
-                if content_hash not in seen_contents:
-                    seen_contents.add(content_hash)
-                    unique_chunks.append(chunk)
-            
-            # Sắp xếp chunks theo loại: Summary trước, Ingredients sau
-            def chunk_priority(chunk):
-                content = chunk.page_content.lower()
-                if 'chunk type: product summary' in content:
-                    return 0  # Summary đầu tiên
-                elif 'chunk type: ingredients' in content:
-                    return 1  # Ingredients sau
-                else:
-                    return 2  # Các loại khác cuối cùng
-            
-            sorted_chunks = sorted(unique_chunks, key=chunk_priority)
-            
-            # Gộp thông tin sản phẩm với header rõ ràng
-            product_info = f"{'='*80}\n"
-            product_info += f"SẢN PHẨM #{i}: {product_name}\n"
-            product_info += f"{'='*80}\n"
-            
-            # Thêm metadata tổng hợp nếu có
-            if metadata['brand']:
-                product_info += f"🏢 Thương hiệu: {metadata['brand']}\n"
-            if metadata['category']:
-                product_info += f"📁 Loại: {metadata['category']}\n"
-            if metadata['suitable_for']:
-                product_info += f"👤 Phù hợp: {metadata['suitable_for']}\n"
-            if metadata['rank']:
-                product_info += f"⭐ Đánh giá: {metadata['rank']}\n"
-            if metadata['price']:
-                price_vnd = convert_price_in_text(f"Price: {metadata['price']}")
-                product_info += f"💰 {price_vnd}\n"
-            
-            product_info += f"{'-'*80}\n\n"
-            
-            # Thêm nội dung chi tiết từ chunks
-            for chunk in sorted_chunks:
-                content = chunk.page_content.strip()
-                # Chuyển đổi giá USD → VND
-                content = convert_price_in_text(content)
-                product_info += content + "\n\n"
-            
-            formatted.append(product_info)
-        
-        result = "\n\n".join(formatted)
-        
-        return result
+    return retriever, prompt, llm
+
+def setup_rag_chain(db, components=None):
+    """Thiết lập RAG chain với Retriever, LLM và Prompt (components: kết quả build_rag_components để dùng chung)"""
+    components = components or build_rag_components(db)
+    if components is None:
+        return None
+    retriever, prompt, llm = components
     
+    # 4. Xây dựng RAG Chain với NHÓM CHUNKS THEO SẢN PHẨM và GROUNDING CHECK
     rag_chain = (
         {
             "context": retriever | format_docs,
@@ -755,6 +822,33 @@ TRẢ LỜI (mặc định 2 sản phẩm, hoặc đúng số lượng user yêu
 
     return rag_chain
 
+class RagStreamer:
+    """
+    Cùng retriever / prompt / LLM với rag_chain nhưng chạy từng bước để stream cho client:
+    retrieval xong -> sản phẩm đã chọn -> token của Gemini ngay khi sinh ra (không chờ đủ câu trả lời)
+    """
+
+    def __init__(self, retriever, prompt, llm):
+        self.retriever = retriever
+        self.answer_chain = prompt | llm | StrOutputParser()
+
+    async def astream(self, question: str):
+        """Async generator (event, data): ("retrieval", ...), ("products", ...), rồi ("token", {"text"}) nhiều lần"""
+        start = time.perf_counter()
+        docs = await self.retriever.ainvoke(question)
+        selected_products = select_products(docs)
+        yield "retrieval", {
+            "chunks": len(docs),
+            "products": len(selected_products),
+            "elapsed_ms": round((time.perf_counter() - start) * 1000.0, 1)
+        }
+        yield "products", {"products": product_summaries(selected_products)}
+
+        context = format_products(selected_products)
+        async for token in self.answer_chain.astream({"context": context, "question": question}):
+            if token:
+                yield "token", {"text": token}
+
 # =============================================================================
 # CHAT HISTORY
 # =============================================================================
@@ -802,47 +896,8 @@ def load_latest_chat_history():
 # =============================================================================
 # VISION ANALYSIS (MERGED: NEW LOGIC + OLD BACKEND SUPPORT)
 # =============================================================================
-def analyze_skin_image(image_input, note: str = None):
-    """
-    Phân tích ảnh da bằng VLM - Tập trung vào mức độ nghiêm trọng
-    Supports: File Path (CLI) and Base64/Bytes (Backend)
-    """
-    try:
-        print("\n📸 Đang phân tích tình trạng da từ ảnh...")
-        
-        img = None
-        # Xử lý input đa dạng (Merge từ file cũ)
-        if isinstance(image_input, str):
-            # Check for data URI or base64 string
-            if image_input.startswith('data:image'):
-                image_input = image_input.split(',')[1]
-                image_bytes = base64.b64decode(image_input)
-                img = Image.open(io.BytesIO(image_bytes))
-            elif os.path.exists(image_input):
-                 # Là đường dẫn file
-                img = Image.open(image_input)
-            else:
-                # Thử decode base64 thuần
-                try:
-                    image_bytes = base64.b64decode(image_input)
-                    img = Image.open(io.BytesIO(image_bytes))
-                except:
-                     print(f"❌ Input string không phải là path hợp lệ hay base64.")
-                     return None
-        elif isinstance(image_input, bytes):
-            img = Image.open(io.BytesIO(image_input))
-        elif isinstance(image_input, Image.Image):
-             img = image_input
-        
-        if img is None:
-             print("❌ Không thể đọc được ảnh từ input.")
-             return None
-
-        # Khởi tạo Gemini Vision model (Từ file mới)
-        vision_model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        # Prompt tập trung vào mức độ nghiêm trọng (Từ file mới)
-        vision_prompt = """Bạn là chuyên gia da liễu. Phân tích ảnh da và TÓM TẮT NGẮN GỌN:
+# Prompt tập trung vào mức độ nghiêm trọng
+VISION_PROMPT = """Bạn là chuyên gia da liễu. Phân tích ảnh da và TÓM TẮT NGẮN GỌN:
 
 1. LOẠI DA: (khô/dầu/hỗn hợp/nhạy cảm/thường)
 
@@ -864,11 +919,121 @@ QUAN TRỌNG: Phải ghi rõ MỨC ĐỘ (NHẸ/TRUNG BÌNH/NẶNG/RẤT NẶNG)
 
 Trả lời NGẮN GỌN, bằng tiếng Việt."""
 
-        if note:
-             vision_prompt += f"\n\nGhi chú thêm từ người dùng: {note}"
+
+# Tăng khi đổi cách dùng output của VISION_PROMPT mà text prompt không đổi -> VLM cache cũ hết hiệu lực
+VISION_PROMPT_VERSION = 1
+
+
+def build_vision_prompt(note: str = None) -> str:
+    if note:
+        return VISION_PROMPT + f"\n\nGhi chú thêm từ người dùng: {note}"
+    return VISION_PROMPT
+
+def vision_prompt_version() -> str:
+    """
+    Version cho VLM cache: số version + hash nội dung prompt + model + cách normalize ảnh
+    -> sửa prompt / đổi ảnh gửi lên Gemini là cache tự invalidate
+    """
+    prompt_hash = hashlib.sha256(VISION_PROMPT.encode('utf-8')).hexdigest()[:12]
+    return f"v{VISION_PROMPT_VERSION}-{prompt_hash}-{GEMINI_MODEL_NAME}-{VISION_MAX_SIDE}px-q{VISION_JPEG_QUALITY}"
+
+def normalize_note(note: str = None) -> str:
+    """Ghi chú cho cache key: bỏ khoảng trắng thừa, không phân biệt hoa thường"""
+    return " ".join((note or "").split()).casefold()
+
+def image_pixel_hash(img: Image.Image) -> str:
+    """SHA-256 của pixel đã decode (+ mode, size): cùng ảnh gửi lại dạng bytes / base64 / file khác metadata vẫn trùng"""
+    digest = hashlib.sha256(f"{img.mode}:{img.size[0]}x{img.size[1]}".encode('utf-8'))
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+def _open_vision_image(fp, max_side: int = VISION_MAX_SIDE) -> Image.Image:
+    """Image.open + JPEG draft: decode thẳng ở scale 1/2, 1/4, 1/8 nhỏ nhất vẫn >= max_side (không decode full 12MP)"""
+    img = Image.open(fp)
+    if max_side and img.format == 'JPEG':
+        img.draft('RGB', (max_side, max_side))
+    return img
+
+def decode_vision_input(image_input, max_side: int = VISION_MAX_SIDE):
+    """image_input (bytes / base64 / data URI / file path / PIL.Image) -> PIL.Image, None nếu không đọc được"""
+    img = None
+    # Xử lý input đa dạng (Merge từ file cũ)
+    if isinstance(image_input, str):
+        # Check for data URI or base64 string
+        if image_input.startswith('data:image'):
+            img = _open_vision_image(io.BytesIO(base64.b64decode(image_input.split(',')[1])), max_side)
+        elif os.path.exists(image_input):
+            # Là đường dẫn file
+            img = _open_vision_image(image_input, max_side)
+        else:
+            # Thử decode base64 thuần
+            try:
+                img = _open_vision_image(io.BytesIO(base64.b64decode(image_input)), max_side)
+            except Exception:
+                print(f"❌ Input string không phải là path hợp lệ hay base64.")
+                return None
+    elif isinstance(image_input, bytes):
+        img = _open_vision_image(io.BytesIO(image_input), max_side)
+    elif isinstance(image_input, Image.Image):
+        img = image_input
+    return img
+
+def normalize_vision_image(img: Image.Image, max_side: int = VISION_MAX_SIDE) -> Image.Image:
+    """Xoay theo EXIF orientation, RGB, cạnh dài <= max_side (0 = giữ nguyên), bỏ metadata (EXIF / GPS / ICC)"""
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if max_side and max(img.size) > max_side:
+        scale = max_side / max(img.size)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    else:
+        img = img.copy()
+    img.info = {}
+    return img
+
+def encode_vision_image(img: Image.Image, max_side: int = VISION_MAX_SIDE, quality: int = VISION_JPEG_QUALITY):
+    """
+    PIL.Image -> {"mime_type": "image/jpeg", "data"} đã normalize cho Gemini.
+    Chạy được trong thread -> không decode / resize / encode ảnh trên event loop.
+    """
+    buffer = io.BytesIO()
+    normalize_vision_image(img, max_side).save(buffer, format="JPEG", quality=quality)
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+def load_vision_image(image_input, max_side: int = VISION_MAX_SIDE, quality: int = VISION_JPEG_QUALITY):
+    """image_input -> {"mime_type", "data"} cho Gemini, None nếu không đọc được"""
+    img = decode_vision_input(image_input, max_side)
+    return encode_vision_image(img, max_side, quality) if img is not None else None
+
+def vision_stats():
+    """VISION_STATS + trung bình / request (bytes gửi lên Gemini, thời gian chuẩn bị ảnh, thời gian Gemini)"""
+    requests = VISION_STATS["requests"]
+    return {
+        "max_side": VISION_MAX_SIDE,
+        "jpeg_quality": VISION_JPEG_QUALITY,
+        "requests": requests,
+        "bytes_sent": VISION_STATS["bytes_sent"],
+        "avg_bytes_sent": round(VISION_STATS["bytes_sent"] / requests) if requests else None,
+        "avg_prepare_ms": round(VISION_STATS["prepare_ms_total"] / requests, 1) if requests else None,
+        "avg_gemini_ms": round(VISION_STATS["gemini_ms_total"] / requests, 1) if requests else None,
+    }
+
+def analyze_skin_image(image_input, note: str = None):
+    """
+    Phân tích ảnh da bằng VLM - Tập trung vào mức độ nghiêm trọng (blocking, dùng cho CLI)
+    Supports: File Path (CLI) and Base64/Bytes (Backend). API server dùng analyze_skin_image_async
+    """
+    try:
+        print("\n📸 Đang phân tích tình trạng da từ ảnh...")
         
-        # Gọi vision model
-        response = vision_model.generate_content([vision_prompt, img])
+        img = load_vision_image(image_input)
+        if img is None:
+             print("❌ Không thể đọc được ảnh từ input.")
+             return None
+
+        # Gọi vision model (dùng chung, không tạo lại mỗi lần)
+        response = get_gemini_model().generate_content([build_vision_prompt(note), img])
         analysis = response.text
         
         print("✅ Đã phân tích xong!")
@@ -879,6 +1044,38 @@ Trả lời NGẮN GỌN, bằng tiếng Việt."""
         print(f"❌ Lỗi khi phân tích ảnh: {str(e)}")
         return None
 
+async def analyze_skin_image_async(image_input, note: str = None):
+    """
+    Như analyze_skin_image nhưng không block event loop: đọc ảnh trong thread,
+    gọi Gemini bằng generate_content_async -> nhiều request VLM chạy song song trong 1 worker
+    """
+    try:
+        print("\n📸 Đang phân tích tình trạng da từ ảnh...")
+
+        # Decode + normalize + encode ảnh trong thread (CPU), event loop chỉ chờ I/O của Gemini
+        start = time.perf_counter()
+        img = await asyncio.to_thread(load_vision_image, image_input)
+        if img is None:
+            print("❌ Không thể đọc được ảnh từ input.")
+            return None
+        prepared = time.perf_counter()
+
+        response = await get_gemini_model().generate_content_async([build_vision_prompt(note), img])
+        analysis = response.text
+
+        VISION_STATS["requests"] += 1
+        VISION_STATS["bytes_sent"] += len(img["data"])
+        VISION_STATS["prepare_ms_total"] += (prepared - start) * 1000.0
+        VISION_STATS["gemini_ms_total"] += (time.perf_counter() - prepared) * 1000.0
+
+        print("✅ Đã phân tích xong!")
+
+        return analysis
+
+    except Exception as e:
+        print(f"❌ Lỗi khi phân tích ảnh: {str(e)}")
+        return None
+
 # =============================================================================
 # INTERACTIVE CHAT (CLI)
 # =============================================================================
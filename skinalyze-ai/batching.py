@@ -0,0 +1,196 @@
+"""
+Dynamic micro-batching cho inference
+Gom các request đồng thời thành một batched forward pass
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+# Số mẫu queue wait giữ lại để tính percentile
+_WAIT_SAMPLES = 1000
+
+
+class _PendingItem:
+    __slots__ = ("item", "future", "enqueued_at")
+
+    def __init__(self, item: Any, future: asyncio.Future):
+        self.item = item
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Collect concurrent requests for up to `window_ms` (or `max_batch_size` items),
+    run ONE call of `predict_fn(items)` and hand each caller back its own row.
+
+    `predict_fn` is synchronous and must return a sequence aligned with `items`.
+    It is executed through `run_fn(predict_fn, items)` (default: the loop's
+    default thread pool) so the event loop stays responsive.
+    """
+
+    def __init__(
+        self,
+        predict_fn: Callable[[List[Any]], Sequence[Any]],
+        max_batch_size: int = 16,
+        window_ms: float = 10.0,
+        name: str = "batcher",
+        run_fn: Optional[Callable[[Callable, List[Any]], Awaitable[Sequence[Any]]]] = None
+    ):
+        self.predict_fn = predict_fn
+        self.run_fn = run_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.window = max(0.0, float(window_ms)) / 1000.0
+        self.name = name
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+        # Metrics
+        self._batches = 0
+        self._items = 0
+        self._errors = 0
+        self._max_batch_seen = 0
+        self._batch_size_counts: Dict[int, int] = {}
+        self._queue_waits = deque(maxlen=_WAIT_SAMPLES)
+        self._inference_time = 0.0
+
+    # -------------------------------------------------------------------------
+    # Lifecycle
+    # -------------------------------------------------------------------------
+    def start(self):
+        """Start the background worker (must be called inside a running loop)"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop the worker and fail any request still waiting in the queue"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        if self._queue is not None:
+            while not self._queue.empty():
+                pending = self._queue.get_nowait()
+                if not pending.future.done():
+                    pending.future.set_exception(RuntimeError(f"{self.name} batcher stopped"))
+
+    # -------------------------------------------------------------------------
+    # Public API
+    # -------------------------------------------------------------------------
+    async def submit(self, item: Any) -> Any:
+        """Enqueue one sample and wait for its result row"""
+        if self._worker is None or self._worker.done():
+            self.start()
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_PendingItem(item, future))
+        return await future
+
+    def metrics(self) -> Dict[str, Any]:
+        waits_ms = sorted(w * 1000.0 for w in self._queue_waits)
+
+        def percentile(p: float) -> float:
+            if not waits_ms:
+                return 0.0
+            idx = min(len(waits_ms) - 1, int(round(p / 100.0 * (len(waits_ms) - 1))))
+            return round(waits_ms[idx], 3)
+
+        return {
+            "max_batch_size": self.max_batch_size,
+            "window_ms": round(self.window * 1000.0, 3),
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self._batches,
+            "items": self._items,
+            "errors": self._errors,
+            "avg_batch_size": round(self._items / self._batches, 3) if self._batches else 0.0,
+            "max_batch_seen": self._max_batch_seen,
+            "batch_size_histogram": {str(k): v for k, v in sorted(self._batch_size_counts.items())},
+            "queue_wait_ms": {
+                "p50": percentile(50),
+                "p95": percentile(95),
+                "max": round(waits_ms[-1], 3) if waits_ms else 0.0,
+            },
+            "avg_inference_ms": round(self._inference_time / (self._batches + self._errors) * 1000.0, 3)
+            if (self._batches + self._errors) else 0.0,
+        }
+
+    # -------------------------------------------------------------------------
+    # Worker
+    # -------------------------------------------------------------------------
+    async def _collect(self) -> List[_PendingItem]:
+        first = await self._queue.get()
+        batch = [first]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+
+        while len(batch) < self.max_batch_size:
+            # Lấy ngay những request đã nằm sẵn trong queue
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _predict(self, items: List[Any]) -> Sequence[Any]:
+        if self.run_fn is not None:
+            return await self.run_fn(self.predict_fn, items)
+        return await asyncio.get_running_loop().run_in_executor(None, self.predict_fn, items)
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+
+            # Bỏ qua các request mà client đã huỷ trong lúc chờ
+            batch = [p for p in batch if not p.future.done()]
+            if not batch:
+                continue
+
+            dispatched_at = time.perf_counter()
+            for pending in batch:
+                self._queue_waits.append(dispatched_at - pending.enqueued_at)
+
+            try:
+                results = await self._predict([p.item for p in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(
+                        f"{self.name}: predict_fn returned {len(results)} rows for {len(batch)} items"
+                    )
+            except asyncio.CancelledError:
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.cancel()
+                raise
+            except Exception as e:
+                self._errors += 1
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                continue
+            finally:
+                self._inference_time += time.perf_counter() - dispatched_at
+
+            size = len(batch)
+            self._batches += 1
+            self._items += size
+            self._max_batch_seen = max(self._max_batch_seen, size)
+            self._batch_size_counts[size] = self._batch_size_counts.get(size, 0) + 1
+
+            for pending, row in zip(batch, results):
+                if not pending.future.done():
+                    pending.future.set_result(row)
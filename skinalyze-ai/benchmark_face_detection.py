@@ -0,0 +1,189 @@
+"""
+Benchmark face detection throughput: 1 MediaPipe instance dùng chung (đường cũ) vs pool + downscale
+Chạy: python benchmark_face_detection.py [--images DIR] [--pool-size 4] [--concurrency 8] [--requests 200]
+Không có --images -> ảnh JPEG synthetic 4032x3024 (không có mặt thật: chỉ đo throughput, không đo box)
+
+Mỗi config xử lý cùng 1 loạt request từ bytes (decode + detect) với `--concurrency` client threads:
+- single/full:      1 detector sau 1 lock, decode + detect full-res (như trước)
+- single/downscale: 1 detector sau 1 lock, JPEG draft decode + detect ở FACE_DETECTION_MAX_SIDE
+- pool/full:        N detector (mỗi request checkout 1 instance), full-res
+- pool/downscale:   N detector + downscale (cấu hình server hiện tại)
+Với ảnh thật có mặt: báo thêm IoU của box downscale (đã map về toạ độ gốc) so với box full-res.
+"""
+
+import argparse
+import io
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from config import FACE_DETECTION_MAX_SIDE, FACE_DETECTION_MIN_CONFIDENCE
+from face_detection import create_face_detector, detect_faces
+from segmentation import decode_for_segmentation
+
+
+def synthetic_photos(count: int, seed: int = 0):
+    """Ảnh 4032x3024 nền da có texture (decode + detect cost như ảnh điện thoại 12MP)"""
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        coarse = rng.normal(0, 14, size=(75, 100, 3)) + np.array([210, 165, 140])
+        image = Image.fromarray(np.clip(coarse, 0, 255).astype(np.uint8)).resize((4032, 3024), Image.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=92)
+        yield f"synthetic_{i}", buffer.getvalue()
+
+
+def image_files(image_dir: str, count: int):
+    exts = ('.jpg', '.jpeg', '.png', '.webp')
+    names = sorted(name for name in os.listdir(image_dir) if name.lower().endswith(exts))
+    for name in names[:count]:
+        with open(os.path.join(image_dir, name), 'rb') as f:
+            yield name, f.read()
+
+
+class SingleDetector:
+    """1 graph dùng chung: MediaPipe không thread-safe nên mọi request phải xếp hàng sau 1 lock"""
+
+    def __init__(self, min_confidence: float):
+        self.detector = create_face_detector(min_confidence)
+        self.lock = threading.Lock()
+
+    def run(self, fn, *args):
+        with self.lock:
+            return fn(self.detector, *args)
+
+    def close(self):
+        self.detector.close()
+
+
+class DetectorPool:
+    """N graph, mỗi request checkout 1 instance (như PredictorPool của server, bản đồng bộ)"""
+
+    def __init__(self, size: int, min_confidence: float):
+        self.detectors = [create_face_detector(min_confidence) for _ in range(size)]
+        self.available = queue.Queue()
+        for detector in self.detectors:
+            self.available.put(detector)
+
+    def run(self, fn, *args):
+        detector = self.available.get()
+        try:
+            return fn(detector, *args)
+        finally:
+            self.available.put(detector)
+
+    def close(self):
+        for detector in self.detectors:
+            detector.close()
+
+
+def detect_request(runner, data: bytes, max_side: int):
+    """1 request end-to-end từ upload bytes -> faces (box theo pixel ảnh gốc)"""
+    if max_side:
+        image, _, original_size = decode_for_segmentation(data, max_side, keep_full=False)
+    else:
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+        original_size = image.size
+    return runner.run(detect_faces, np.asarray(image), original_size, max_side)
+
+
+def measure(runner, samples, max_side: int, requests: int, concurrency: int):
+    jobs = [samples[i % len(samples)][1] for i in range(requests)]
+    latencies = []
+
+    def one(data):
+        start = time.perf_counter()
+        faces = detect_request(runner, data, max_side)
+        latencies.append(time.perf_counter() - start)
+        return faces
+
+    # Warmup (graph init lazily ở lần process đầu tiên)
+    for _, data in samples[:2]:
+        detect_request(runner, data, max_side)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, jobs))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "throughput": requests / wall,
+        "p50_ms": latencies[len(latencies) // 2] * 1000.0,
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000.0,
+    }
+
+
+def box_iou(a, b) -> float:
+    ax1, ay1, bx1, by1 = a[0] + a[2], a[1] + a[3], b[0] + b[2], b[1] + b[3]
+    inter_w = max(0.0, min(ax1, bx1) - max(a[0], b[0]))
+    inter_h = max(0.0, min(ay1, by1) - max(a[1], b[1]))
+    inter = inter_w * inter_h
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Face detection: single instance vs pooled + downscaled")
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--count", type=int, default=8)
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--max-side", type=int, default=FACE_DETECTION_MAX_SIDE or 640)
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print(f"🙂 FACE DETECTION BENCHMARK (pool {args.pool_size}, concurrency {args.concurrency}, "
+          f"max side {args.max_side})")
+    print("=" * 80)
+
+    samples = list(image_files(args.images, args.count) if args.images else synthetic_photos(args.count))
+    if not samples:
+        print("❌ No images found")
+        return 1
+
+    # Box agreement: downscale (map về toạ độ gốc) vs full-res
+    single = SingleDetector(FACE_DETECTION_MIN_CONFIDENCE)
+    ious, found, missed = [], 0, 0
+    for _, data in samples:
+        full_faces = detect_request(single, data, 0)
+        small_faces = detect_request(single, data, args.max_side)
+        if full_faces:
+            found += 1
+            if small_faces:
+                ious.append(box_iou(full_faces[0]["box"], small_faces[0]["box"]))
+            else:
+                missed += 1
+    if found:
+        agreement = f"box IoU vs full-res: mean {np.mean(ious):.3f}, min {np.min(ious):.3f}" if ious else "no boxes"
+        print(f"\n🎯 Faces in {found}/{len(samples)} images | downscaled missed {missed} | {agreement}")
+    else:
+        print("\nℹ️  No faces found in the sample images - measuring throughput only")
+
+    configs = (("single/full", False, 0), ("single/downscale", False, args.max_side),
+               ("pool/full", True, 0), ("pool/downscale", True, args.max_side))
+    results = {}
+    print(f"\n    {'config':<20}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, pooled, max_side in configs:
+        runner = DetectorPool(args.pool_size, FACE_DETECTION_MIN_CONFIDENCE) if pooled else single
+        results[name] = measure(runner, samples, max_side, args.requests, args.concurrency)
+        if pooled:
+            runner.close()
+        stats = results[name]
+        print(f"    {name:<20}{stats['throughput']:>10.1f}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}")
+    single.close()
+
+    speedup = results["pool/downscale"]["throughput"] / results["single/full"]["throughput"]
+    print(f"\n✅ pool/downscale: {speedup:.1f}x throughput of single/full")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
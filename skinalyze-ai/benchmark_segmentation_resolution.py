@@ -0,0 +1,139 @@
+"""
+Benchmark segmentation full-res (đường cũ) vs working resolution giới hạn (SEGMENTATION_MAX_SIDE)
+Chạy: python benchmark_segmentation_resolution.py [--images DIR] [--max-side 1024] [--count 6]
+Không có --images -> ảnh JPEG synthetic 4032x3024 (ảnh điện thoại 12MP) có 1 vùng tổn thương
+
+So sánh cho mỗi ảnh:
+- full:           decode full-res -> SAM2 -> composite + encode PNG/JPEG full-size (như trước)
+- capped:         JPEG draft decode + resize về max side -> SAM2 -> output ở working resolution
+- capped+upscale: như capped nhưng mask được upsample về full-size (full_size=true)
+Báo latency (median), peak RSS tăng thêm, và IoU của mask capped+upscale so với mask full-res.
+"""
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw, ImageFilter
+
+from config import MODEL_PATHS, SEGMENTATION_MAX_SIDE
+from classifier import current_rss_mb, peak_rss_mb
+from segmentation import decode_for_segmentation, load_sam2_model, segment_image, upsample_mask
+
+
+def synthetic_photos(count: int, seed: int = 0):
+    """Ảnh 4032x3024: nền da có texture + 1 vùng tổn thương tối (vị trí seeded)"""
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    for i in range(count):
+        coarse = np_rng.normal(0, 12, size=(75, 100, 3)) + np.array([222, 170, 140])
+        image = Image.fromarray(np.clip(coarse, 0, 255).astype(np.uint8)).resize((4032, 3024), Image.BICUBIC)
+        draw = ImageDraw.Draw(image)
+        rx, ry = rng.randint(250, 600), rng.randint(250, 600)
+        cx, cy = rng.randint(rx + 50, 4032 - rx - 50), rng.randint(ry + 50, 3024 - ry - 50)
+        draw.ellipse((cx - rx, cy - ry, cx + rx, cy + ry), fill=(118, 52, 44))
+        image = image.filter(ImageFilter.GaussianBlur(6))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=92)
+        yield f"synthetic_{i}", buffer.getvalue()
+
+
+def image_files(image_dir: str, count: int):
+    exts = ('.jpg', '.jpeg', '.png', '.webp')
+    names = sorted(name for name in os.listdir(image_dir) if name.lower().endswith(exts))
+    for name in names[:count]:
+        with open(os.path.join(image_dir, name), 'rb') as f:
+            yield name, f.read()
+
+
+def render(mask: np.ndarray, image: Image.Image):
+    """Mask + lesion_on_black ở kích thước của `image`, encode như endpoint"""
+    mask_image = upsample_mask(mask, image.size)
+    composite = Image.composite(image, Image.new("RGB", image.size, (0, 0, 0)), mask_image)
+    mask_buffer, composite_buffer = io.BytesIO(), io.BytesIO()
+    mask_image.save(mask_buffer, format="PNG")
+    composite.save(composite_buffer, format="JPEG", quality=90)
+    return mask_image, len(mask_buffer.getvalue()) + len(composite_buffer.getvalue())
+
+
+def run_path(predictor, data: bytes, max_side: int, full_output: bool):
+    """1 request end-to-end: decode -> SAM2 -> render. Returns (mask L image, bytes out)"""
+    working, full_image, _ = decode_for_segmentation(data, max_side, keep_full=full_output)
+    _, masks, _, _ = segment_image(predictor, np.asarray(working))
+    return render(masks[0], full_image if full_output else working)
+
+
+def measure(predictor, data: bytes, max_side: int, full_output: bool, repeats: int):
+    # Peak RSS của riêng path này (reset VmHWM trước khi chạy)
+    baseline = current_rss_mb()
+    peak_rss_mb(reset=True)
+    mask_image, payload = run_path(predictor, data, max_side, full_output)
+    peak = peak_rss_mb() - baseline
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run_path(predictor, data, max_side, full_output)
+        timings.append(time.perf_counter() - start)
+    return mask_image, {"latency_s": float(np.median(timings)), "peak_mb": peak, "payload_kb": payload / 1024.0}
+
+
+def iou(a: Image.Image, b: Image.Image) -> float:
+    a, b = np.asarray(a) > 127, np.asarray(b) > 127
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segmentation: full-res vs capped working resolution")
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--count", type=int, default=4)
+    parser.add_argument("--max-side", type=int, default=SEGMENTATION_MAX_SIDE or 1024)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print(f"📐 SEGMENTATION RESOLUTION BENCHMARK (max side {args.max_side})")
+    print("=" * 80)
+
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = load_sam2_model(MODEL_PATHS['segmentation'], device, safetensors_path=MODEL_PATHS['segmentation_safetensors'])
+    predictor = SAM2ImagePredictor(model)
+
+    samples = image_files(args.images, args.count) if args.images else synthetic_photos(args.count)
+    paths = (("full", 0, True), ("capped", args.max_side, False), ("capped+upscale", args.max_side, True))
+    totals = {name: [] for name, _, _ in paths}
+    ious = []
+
+    print(f"\n    {'image':<22}{'path':<16}{'latency s':>11}{'peak MB':>10}{'output KB':>11}{'IoU':>8}")
+    for name, data in samples:
+        masks = {}
+        for path, max_side, full_output in paths:
+            masks[path], stats = measure(predictor, data, max_side, full_output, args.repeats)
+            totals[path].append(stats)
+            score = iou(masks[path], masks["full"]) if path == "capped+upscale" else None
+            if score is not None:
+                ious.append(score)
+            print(f"    {name[:21]:<22}{path:<16}{stats['latency_s']:>11.3f}{stats['peak_mb']:>10.1f}"
+                  f"{stats['payload_kb']:>11.1f}{(f'{score:.4f}' if score is not None else '-'):>8}")
+
+    print("\n📊 Mean over images")
+    for path, rows in totals.items():
+        print(f"    {path:<16} latency {np.mean([r['latency_s'] for r in rows]):.3f}s | "
+              f"peak +{np.mean([r['peak_mb'] for r in rows]):.1f} MB | "
+              f"output {np.mean([r['payload_kb'] for r in rows]):.1f} KB")
+    full_latency = np.mean([r['latency_s'] for r in totals["full"]])
+    capped_latency = np.mean([r['latency_s'] for r in totals["capped"]])
+    print(f"\n✅ capped is {full_latency / capped_latency:.1f}x faster | "
+          f"mask IoU (capped+upscale vs full): mean {np.mean(ious):.4f}, min {np.min(ious):.4f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
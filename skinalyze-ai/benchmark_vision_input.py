@@ -0,0 +1,135 @@
+"""
+Benchmark ảnh gửi lên Gemini vision: trước (ảnh gốc, encode như SDK làm với PIL.Image) vs sau normalize
+(xoay EXIF, bỏ metadata, cạnh dài <= VISION_MAX_SIDE, JPEG VISION_JPEG_QUALITY)
+Chạy: python benchmark_vision_input.py [--images DIR] [--count 6] [--live]
+Không có --images -> ảnh JPEG synthetic 4032x3024 có EXIF orientation 6 (như ảnh điện thoại chụp dọc)
+
+- Luôn báo: bytes gửi lên, thời gian chuẩn bị ảnh (decode + resize + encode), ước lượng upload ở --uplink-mbps
+- --live (cần GOOGLE_API_KEY): gọi Gemini thật cho cả 2 cách -> latency end-to-end + in 2 kết quả để so sánh
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from config import VISION_JPEG_QUALITY, VISION_MAX_SIDE
+from RAG_cosmetic import build_vision_prompt, get_gemini_model, load_vision_image, setup_api_key
+
+
+def synthetic_photos(count: int, seed: int = 0):
+    """Ảnh 4032x3024 nền da có texture + EXIF (máy, GPS giả, orientation 6) như ảnh điện thoại 12MP"""
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        coarse = rng.normal(0, 14, size=(75, 100, 3)) + np.array([210, 165, 140])
+        fine = rng.normal(0, 6, size=(3024, 4032, 3))
+        pixels = np.asarray(Image.fromarray(np.clip(coarse, 0, 255).astype(np.uint8)).resize((4032, 3024), Image.BICUBIC))
+        image = Image.fromarray(np.clip(pixels + fine, 0, 255).astype(np.uint8))
+        exif = Image.Exif()
+        exif[0x0112] = 6           # Orientation: xoay 90° khi hiển thị
+        exif[0x010F] = "Phone"     # Make
+        exif[0x8825] = {1: "N", 2: (10.0, 46.0, 0.0)}  # GPS
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=92, exif=exif.tobytes())
+        yield f"synthetic_{i}", buffer.getvalue()
+
+
+def image_files(image_dir: str, count: int):
+    exts = ('.jpg', '.jpeg', '.png', '.webp')
+    names = sorted(name for name in os.listdir(image_dir) if name.lower().endswith(exts))
+    for name in names[:count]:
+        with open(os.path.join(image_dir, name), 'rb') as f:
+            yield name, f.read()
+
+
+def legacy_vision_part(data: bytes):
+    """Cách cũ: PIL.Image full-res đưa thẳng cho SDK (PNG giữ PNG, còn lại JPEG quality mặc định, không xoay EXIF)"""
+    image = Image.open(io.BytesIO(data))
+    buffer = io.BytesIO()
+    if image.format == 'PNG':
+        image.save(buffer, format="PNG")
+        return {"mime_type": "image/png", "data": buffer.getvalue()}
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(buffer, format="JPEG")
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+
+def normalized_vision_part(data: bytes):
+    return load_vision_image(data)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini vision input: original vs normalized (bytes + latency)")
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--count", type=int, default=6)
+    parser.add_argument("--uplink-mbps", type=float, default=20.0, help="Uplink used to estimate upload time")
+    parser.add_argument("--live", action="store_true", help="Call Gemini for both variants (needs GOOGLE_API_KEY)")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print(f"🖼️  GEMINI VISION INPUT BENCHMARK (max side {VISION_MAX_SIDE or 'original'}, JPEG q{VISION_JPEG_QUALITY})")
+    print("=" * 80)
+
+    samples = list(image_files(args.images, args.count) if args.images else synthetic_photos(args.count))
+    if not samples:
+        print("❌ No images found")
+        return 1
+
+    variants = (("original", legacy_vision_part), ("normalized", normalized_vision_part))
+    results = {name: {"bytes": [], "prepare_ms": [], "gemini_ms": []} for name, _ in variants}
+    model = None
+    if args.live:
+        setup_api_key()
+        model = get_gemini_model()
+
+    for sample_name, data in samples:
+        source = Image.open(io.BytesIO(data))
+        print(f"\n    {sample_name}: {source.size[0]}x{source.size[1]} {source.format}, upload {len(data) / 1024:.0f} KB")
+        for name, prepare in variants:
+            part, prepare_ms = timed(prepare, data)
+            sent = Image.open(io.BytesIO(part["data"]))
+            results[name]["bytes"].append(len(part["data"]))
+            results[name]["prepare_ms"].append(prepare_ms)
+            line = (f"      {name:<11} {sent.size[0]}x{sent.size[1]} {len(part['data']) / 1024:8.0f} KB "
+                    f"prepare {prepare_ms:6.1f} ms exif {'yes' if sent.getexif() else 'no'}")
+            if model is not None:
+                response, gemini_ms = timed(model.generate_content, [build_vision_prompt(), part])
+                results[name]["gemini_ms"].append(prepare_ms + gemini_ms)
+                line += f" | end-to-end {(prepare_ms + gemini_ms) / 1000:.2f}s"
+                print(line)
+                print("        " + response.text.strip().replace("\n", " ")[:160] + "...")
+            else:
+                print(line)
+
+    print(f"\n📊 Mean over {len(samples)} images")
+    print(f"    {'variant':<12}{'KB sent':>10}{'prepare ms':>12}{f'upload @{args.uplink_mbps:g}Mbps':>18}"
+          + (f"{'end-to-end s':>15}" if model is not None else ""))
+    for name, _ in variants:
+        stats = results[name]
+        kb = float(np.mean(stats["bytes"])) / 1024
+        upload_s = float(np.mean(stats["bytes"])) * 8 / (args.uplink_mbps * 1e6)
+        row = f"    {name:<12}{kb:>10.0f}{float(np.mean(stats['prepare_ms'])):>12.1f}{upload_s:>17.2f}s"
+        if model is not None:
+            row += f"{float(np.mean(stats['gemini_ms'])) / 1000:>15.2f}"
+        print(row)
+
+    ratio = np.mean(results["original"]["bytes"]) / np.mean(results["normalized"]["bytes"])
+    print(f"\n✅ Normalized payload is {ratio:.1f}x smaller")
+    if model is None:
+        print("💡 Measure Gemini end-to-end latency: python benchmark_vision_input.py --live")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
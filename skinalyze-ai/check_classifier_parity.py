@@ -0,0 +1,94 @@
+"""
+Parity check: so sánh softmax output của backend ONNX Runtime với PyTorch model gốc
+Chạy: python check_classifier_parity.py [--images DIR] [--atol 1e-4]
+Không có --images -> dùng bộ ảnh synthetic cố định (seeded, encode JPEG)
+Ảnh đi qua đúng decode + preprocess của server, cho cả 2 mode: fast (JPEG draft decode, mặc định
+CLASSIFICATION_FAST_PREPROCESS=1) và torchvision -> parity đúng trên input mà production thấy.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+
+from config import MODEL_PATHS, CLASSIFICATION_FAST_PREPROCESS
+from classifier import (
+    SKIN_CLASSES,
+    OnnxClassifier,
+    TorchClassifier,
+    load_image_bytes,
+    load_torch_classifier,
+    prepare_classification_bytes,
+    preprocess_mode
+)
+
+
+def time_per_image(model, batch: np.ndarray, repeats: int = 3) -> float:
+    """Median latency (ms) của single-image inference trên toàn bộ batch"""
+    model.predict_proba(batch[:1])  # warm-up
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for sample in batch:
+            model.predict_proba(sample[None])
+        timings.append((time.perf_counter() - start) / len(batch))
+    return float(np.median(timings)) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ONNX Runtime vs PyTorch classifier outputs")
+    parser.add_argument("--checkpoint", default=MODEL_PATHS['classification'])
+    parser.add_argument("--onnx", default=MODEL_PATHS['classification_onnx'])
+    parser.add_argument("--images", default=None, help="Directory of sample images (default: fixed synthetic set)")
+    parser.add_argument("--count", type=int, default=16)
+    parser.add_argument("--atol", type=float, default=1e-4, help="Max allowed absolute softmax difference")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print("🔍 CLASSIFIER PARITY CHECK (PyTorch vs ONNX Runtime)")
+    print("=" * 80)
+
+    device = torch.device("cpu")
+    reference = TorchClassifier(load_torch_classifier(args.checkpoint, device), device)
+    candidate = OnnxClassifier(args.onnx)
+
+    images = load_image_bytes(args.images, count=args.count)
+    print(f"🖼️  Evaluating {len(images)} images")
+
+    serving_mode = preprocess_mode(CLASSIFICATION_FAST_PREPROCESS)
+    max_diffs = {}
+    for fast in (True, False):
+        mode = preprocess_mode(fast)
+        batch = np.stack([prepare_classification_bytes(data, fast) for data in images])
+        ref_probs = reference.predict_proba(batch)
+        cand_probs = candidate.predict_proba(batch)
+
+        abs_diff = np.abs(ref_probs - cand_probs)
+        max_diffs[mode] = float(abs_diff.max())
+        top1_agreement = float(np.mean(ref_probs.argmax(axis=1) == cand_probs.argmax(axis=1)))
+
+        print(f"\n🖼️  Preprocess mode: {mode}{' (serving)' if mode == serving_mode else ''}")
+        print(f"📊 Max |Δsoftmax|:   {max_diffs[mode]:.2e} (atol {args.atol:.0e})")
+        print(f"📊 Mean |Δsoftmax|:  {float(abs_diff.mean()):.2e}")
+        print(f"📊 Top-1 agreement:  {top1_agreement * 100:.2f}%")
+        for i, name in enumerate(SKIN_CLASSES[:abs_diff.shape[1]]):
+            print(f"    {name:<22} max Δ {float(abs_diff[:, i].max()):.2e}")
+
+    batch = np.stack([prepare_classification_bytes(data, CLASSIFICATION_FAST_PREPROCESS) for data in images])
+    torch_ms = time_per_image(reference, batch)
+    onnx_ms = time_per_image(candidate, batch)
+    print(f"\n⏱️  PyTorch:      {torch_ms:.2f} ms/image")
+    print(f"⏱️  ONNX Runtime: {onnx_ms:.2f} ms/image ({torch_ms / onnx_ms:.2f}x)")
+
+    failed = [mode for mode, diff in max_diffs.items() if diff > args.atol]
+    if failed:
+        print(f"\n❌ PARITY FAILED ({', '.join(failed)})")
+        return 1
+    print("\n✅ PARITY OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
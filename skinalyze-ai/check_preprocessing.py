@@ -0,0 +1,79 @@
+"""
+So sánh fast preprocessing (JPEG draft decode + numpy normalize) với torchvision transforms gốc
+Chạy: python check_preprocessing.py [--images DIR] [--tolerance 0.03]
+Không có --images -> dùng ảnh JPEG synthetic 12MP cố định (seeded)
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from classifier import INPUT_SIZE, decode_image, preprocess_classification
+
+
+def synthetic_jpegs(count: int, seed: int = 0):
+    """Ảnh 4032x3024 mượt (giống ảnh chụp điện thoại hơn noise thuần)"""
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        coarse = rng.integers(0, 256, size=(60, 80, 3)).astype(np.uint8)
+        image = Image.fromarray(coarse).resize((4032, 3024), Image.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=92)
+        yield "synthetic", buffer.getvalue()
+
+
+def image_files(image_dir: str, count: int):
+    exts = ('.jpg', '.jpeg', '.png', '.webp')
+    names = sorted(name for name in os.listdir(image_dir) if name.lower().endswith(exts))
+    for name in names[:count]:
+        with open(os.path.join(image_dir, name), 'rb') as f:
+            yield name, f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check fast classification preprocessing against torchvision")
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--count", type=int, default=8)
+    parser.add_argument("--tolerance", type=float, default=0.03, help="Max allowed mean |Δ| (normalized units)")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print("🖼️  PREPROCESSING CHECK (torchvision vs fast path)")
+    print("=" * 80)
+
+    samples = image_files(args.images, args.count) if args.images else synthetic_jpegs(args.count)
+
+    ref_times, fast_times, mean_diffs, max_diffs = [], [], [], []
+    for name, data in samples:
+        start = time.perf_counter()
+        reference = preprocess_classification(decode_image(data), fast=False)
+        ref_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        fast = preprocess_classification(decode_image(data, draft_size=INPUT_SIZE), fast=True)
+        fast_times.append(time.perf_counter() - start)
+
+        diff = np.abs(reference - fast)
+        mean_diffs.append(float(diff.mean()))
+        max_diffs.append(float(diff.max()))
+        print(f"    {name:<30} mean |Δ| {mean_diffs[-1]:.4f}  max |Δ| {max_diffs[-1]:.4f}")
+
+    ref_ms = float(np.mean(ref_times)) * 1000.0
+    fast_ms = float(np.mean(fast_times)) * 1000.0
+    print(f"\n⏱️  torchvision: {ref_ms:.1f} ms/image | fast: {fast_ms:.1f} ms/image ({ref_ms / fast_ms:.1f}x)")
+    print(f"📊 Worst mean |Δ|: {max(mean_diffs):.4f} (tolerance {args.tolerance}) | worst max |Δ|: {max(max_diffs):.4f}")
+
+    if max(mean_diffs) > args.tolerance:
+        print("\n❌ Fast preprocessing outside tolerance")
+        return 1
+    print("\n✅ Fast preprocessing within tolerance")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
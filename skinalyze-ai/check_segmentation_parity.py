@@ -0,0 +1,147 @@
+"""
+Parity check: so sánh mask của OnnxSam2Predictor (ONNX Runtime) với SAM2ImagePredictor (PyTorch) gốc
+Chạy: python check_segmentation_parity.py [--images DIR] [--min-iou 0.97]
+Không có --images -> ảnh synthetic cố định (seeded), mỗi ảnh 1 vùng tổn thương
+
+Mỗi ảnh được segment với các prompt mà API dùng: không prompt (/api/segmentation-disease),
+box, điểm foreground và multimask (/api/segmentation-disease/refine). Báo IoU của từng mask,
+|Δscore| và latency encoder / decoder của 2 backend.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw, ImageFilter
+
+from config import MODEL_PATHS, ONNX_INTRA_OP_THREADS, SEGMENTATION_MAX_SIDE
+from segmentation import (
+    OnnxSam2Predictor,
+    Sam2OnnxSessions,
+    encode_image,
+    load_sam2_model,
+    predict_with_embedding,
+    resize_max_side
+)
+
+
+def synthetic_lesions(count: int, seed: int = 0):
+    """(image, lesion box [x0, y0, x1, y1]): nền da có texture + 1 vùng tổn thương tối"""
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    for _ in range(count):
+        width, height = rng.choice([(1024, 768), (768, 1024), (1024, 1024), (800, 600)])
+        coarse = np_rng.normal(0, 12, size=(height // 32, width // 32, 3)) + np.array([222, 170, 140])
+        image = Image.fromarray(np.clip(coarse, 0, 255).astype(np.uint8)).resize((width, height), Image.BICUBIC)
+        rx, ry = rng.randint(width // 10, width // 4), rng.randint(height // 10, height // 4)
+        cx, cy = rng.randint(rx + 20, width - rx - 20), rng.randint(ry + 20, height - ry - 20)
+        ImageDraw.Draw(image).ellipse((cx - rx, cy - ry, cx + rx, cy + ry), fill=(118, 52, 44))
+        yield image.filter(ImageFilter.GaussianBlur(3)), [cx - rx, cy - ry, cx + rx, cy + ry]
+
+
+def image_files(image_dir: str, count: int):
+    """Ảnh thật: box prompt = vùng giữa ảnh (không có ground truth)"""
+    exts = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+    names = sorted(name for name in os.listdir(image_dir) if name.lower().endswith(exts))
+    for name in names[:count]:
+        image = resize_max_side(Image.open(os.path.join(image_dir, name)).convert("RGB"), SEGMENTATION_MAX_SIDE)
+        width, height = image.size
+        yield image, [width // 4, height // 4, width * 3 // 4, height * 3 // 4]
+
+
+def prompt_cases(box):
+    x0, y0, x1, y1 = box
+    center = np.array([[(x0 + x1) / 2.0, (y0 + y1) / 2.0]], dtype=np.float32)
+    return {
+        "no prompt": {},
+        "box": {"box": np.array(box, dtype=np.float32)},
+        "point": {"point_coords": center, "point_labels": np.array([1], dtype=np.int32)},
+        "box + point": {"box": np.array(box, dtype=np.float32), "point_coords": center,
+                        "point_labels": np.array([1], dtype=np.int32)},
+        "multimask point": {"point_coords": center, "point_labels": np.array([1], dtype=np.int32),
+                            "multimask_output": True},
+    }
+
+
+def mask_iou(a: np.ndarray, b: np.ndarray) -> float:
+    a, b = a > 0.5, b > 0.5
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ONNX Runtime vs PyTorch SAM2 masks (IoU)")
+    parser.add_argument("--checkpoint", default=MODEL_PATHS['segmentation'])
+    parser.add_argument("--safetensors", default=MODEL_PATHS['segmentation_safetensors'])
+    parser.add_argument("--encoder", default=MODEL_PATHS['segmentation_onnx_encoder'])
+    parser.add_argument("--decoder", default=MODEL_PATHS['segmentation_onnx_decoder'])
+    parser.add_argument("--images", default=None, help="Directory of sample images (default: fixed synthetic set)")
+    parser.add_argument("--count", type=int, default=6)
+    parser.add_argument("--min-iou", type=float, default=0.97, help="Min allowed mask IoU vs PyTorch")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print("🔍 SEGMENTATION PARITY CHECK (PyTorch SAM2 vs ONNX Runtime)")
+    print("=" * 80)
+
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+    reference = SAM2ImagePredictor(
+        load_sam2_model(args.checkpoint, torch.device("cpu"), safetensors_path=args.safetensors)
+    )
+    candidate = OnnxSam2Predictor(Sam2OnnxSessions(args.encoder, args.decoder, intra_op_threads=ONNX_INTRA_OP_THREADS))
+
+    samples = list(image_files(args.images, args.count) if args.images else synthetic_lesions(args.count))
+    print(f"🖼️  Evaluating {len(samples)} images x {len(prompt_cases([0, 0, 1, 1]))} prompt cases")
+
+    ious = {name: [] for name in prompt_cases([0, 0, 1, 1])}
+    score_diffs = []
+    timings = {"torch": {"encode": [], "decode": []}, "onnx": {"encode": [], "decode": []}}
+    for index, (image, box) in enumerate(samples):
+        image_np = np.asarray(image)
+        embeddings = {}
+        for name, predictor in (("torch", reference), ("onnx", candidate)):
+            embeddings[name], elapsed = timed(encode_image, predictor, image_np)
+            timings[name]["encode"].append(elapsed)
+
+        for case, prompts in prompt_cases(box).items():
+            outputs = {}
+            for name, predictor in (("torch", reference), ("onnx", candidate)):
+                outputs[name], elapsed = timed(predict_with_embedding, predictor, embeddings[name], **prompts)
+                timings[name]["decode"].append(elapsed)
+            (ref_masks, ref_scores, _), (cand_masks, cand_scores, _) = outputs["torch"], outputs["onnx"]
+            case_ious = [mask_iou(r, c) for r, c in zip(ref_masks, cand_masks)]
+            ious[case].append(min(case_ious))
+            score_diffs.append(float(np.abs(np.asarray(ref_scores) - np.asarray(cand_scores)).max()))
+        print(f"    image {index} ({image.size[0]}x{image.size[1]}): "
+              + ", ".join(f"{case} {values[-1]:.4f}" for case, values in ious.items()))
+
+    print("\n📊 Mask IoU vs PyTorch (min / mean over images)")
+    for case, values in ious.items():
+        print(f"    {case:<18} {min(values):.4f} / {np.mean(values):.4f}")
+    print(f"📊 Max |Δscore|: {max(score_diffs):.2e}")
+
+    for stage in ("encode", "decode"):
+        torch_ms = float(np.median(timings["torch"][stage]))
+        onnx_ms = float(np.median(timings["onnx"][stage]))
+        print(f"⏱️  {stage:<7} PyTorch {torch_ms:8.1f} ms | ONNX Runtime {onnx_ms:8.1f} ms ({torch_ms / onnx_ms:.2f}x)")
+
+    worst = min(min(values) for values in ious.values())
+    if worst < args.min_iou:
+        print(f"\n❌ PARITY FAILED (min IoU {worst:.4f} < {args.min_iou})")
+        return 1
+    print("\n✅ PARITY OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,428 @@
+"""
+Skin disease classifier (EfficientNet-B0) - architecture, preprocessing và execution backends
+Dùng chung cho API server (main.py) và các tool export / parity check
+"""
+
+import hashlib
+import io
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from torchvision import models, transforms
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+SKIN_CLASSES = [
+    'Acne',
+    'Actinic_Keratosis',
+    'Drug_Eruption',
+    'Eczema',
+    'Normal',
+    'Psoriasis',
+    'Rosacea',
+    'Seborrh_Keratoses',
+    'Sun_Sunlight_Damage',
+    'Tinea',
+    'Warts'
+]
+
+INPUT_SIZE = 224
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# Normalize gộp thành 1 phép multiply-add: (x / 255 - mean) / std = x * scale + bias
+_NORM_SCALE = 1.0 / (255.0 * np.array(IMAGENET_STD, dtype=np.float32))
+_NORM_BIAS = -np.array(IMAGENET_MEAN, dtype=np.float32) / np.array(IMAGENET_STD, dtype=np.float32)
+
+IMAGE_TRANSFORMS = {
+    'classification': transforms.Compose([
+        transforms.Resize((INPUT_SIZE, INPUT_SIZE)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
+    ])
+}
+
+# =============================================================================
+# ARCHITECTURE
+# =============================================================================
+def build_classifier(num_classes: int = len(SKIN_CLASSES), dropout1: float = 0.4, dropout2: float = 0.3) -> nn.Module:
+    """
+    EfficientNet-B0 với architecture khớp training notebook
+    Architecture: 1280 → [Dropout 0.4] → 512 → [BN + ReLU + Dropout 0.3] → 256 → [BN + ReLU] → 11
+    """
+    model = models.efficientnet_b0(weights=None)
+    num_features = 1280
+
+    model.classifier = nn.Sequential(
+        nn.Dropout(p=dropout1),
+        nn.Linear(num_features, 512),
+        nn.BatchNorm1d(512),
+        nn.ReLU(),
+        nn.Dropout(p=dropout2),
+        nn.Linear(512, 256),
+        nn.BatchNorm1d(256),
+        nn.ReLU(),
+        nn.Linear(256, num_classes)
+    )
+    return model
+
+def classifier_metadata(checkpoint) -> Dict[str, str]:
+    """Architecture config của checkpoint, lưu vào header safetensors khi convert"""
+    config = checkpoint.get('config', {}) if isinstance(checkpoint, dict) else {}
+    num_classes = checkpoint.get('num_classes', len(SKIN_CLASSES)) if isinstance(checkpoint, dict) else len(SKIN_CLASSES)
+    return {
+        'num_classes': str(num_classes),
+        'dropout1': str(config.get('dropout1', 0.4)),
+        'dropout2': str(config.get('dropout2', 0.3)),
+    }
+
+def load_safetensors_classifier(model_path: str, device: torch.device) -> nn.Module:
+    """Build architecture từ metadata + map weights (mmap) - không unpickle, không copy weights"""
+    from weights import build_with_mmap_weights, read_metadata
+
+    metadata = read_metadata(model_path)
+    return build_with_mmap_weights(
+        lambda _device: build_classifier(
+            num_classes=int(metadata.get('num_classes', len(SKIN_CLASSES))),
+            dropout1=float(metadata.get('dropout1', 0.4)),
+            dropout2=float(metadata.get('dropout2', 0.3))
+        ),
+        model_path,
+        device
+    )
+
+def load_torch_classifier(model_path: str, device: torch.device) -> nn.Module:
+    """Load checkpoint (.safetensors, full model object hoặc state_dict + config) thành model ở eval mode"""
+    if model_path.endswith(".safetensors"):
+        return load_safetensors_classifier(model_path, device)
+
+    checkpoint = torch.load(model_path, map_location=device, weights_only=False)
+
+    # 1. If checkpoint is a full model object
+    if not isinstance(checkpoint, dict):
+        print("ℹ️  Checkpoint is a full model object.")
+        model = checkpoint
+        model.to(device)
+        model.eval()
+        return model
+
+    # 2. Extract state_dict + architecture config
+    state_dict = checkpoint.get('model_state_dict', checkpoint)
+    config = checkpoint.get('config', {})
+    num_classes = checkpoint.get('num_classes', len(SKIN_CLASSES))
+
+    print(f"ℹ️  Loading model with config:")
+    print(f"   - Num classes: {num_classes}")
+
+    model = build_classifier(
+        num_classes=num_classes,
+        dropout1=config.get('dropout1', 0.4),
+        dropout2=config.get('dropout2', 0.3)
+    )
+    model.load_state_dict(state_dict, strict=False)
+    model.to(device)
+    model.eval()
+    return model
+
+# =============================================================================
+# PREPROCESSING
+# =============================================================================
+def decode_image(data: bytes, draft_size: Optional[int] = None) -> Image.Image:
+    """
+    Decode upload bytes -> PIL RGB.
+    draft_size: với JPEG, dùng scale-on-decode (DCT 1/2, 1/4, 1/8) để decode thẳng ở độ phân giải
+    nhỏ nhất mà vẫn >= draft_size x draft_size, bỏ qua phần lớn pixel của ảnh 12MP.
+    """
+    image = Image.open(io.BytesIO(data))
+    if draft_size and image.format == "JPEG":
+        image.draft("RGB", (draft_size, draft_size))
+    return image.convert("RGB")
+
+def preprocess_classification(image: Image.Image, fast: bool = False) -> np.ndarray:
+    """
+    PIL RGB image -> normalized float32 array [3, 224, 224]
+    fast=True: PIL bilinear resize + vectorized numpy normalize (1 float buffer, không tạo tensor trung gian).
+    Cùng phép resize với torchvision Resize trên PIL image nên chênh lệch chỉ đến từ JPEG draft decode.
+    """
+    if not fast:
+        return IMAGE_TRANSFORMS['classification'](image).numpy()
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != (INPUT_SIZE, INPUT_SIZE):
+        image = image.resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR)
+
+    pixels = np.asarray(image, dtype=np.float32)  # [H, W, 3], bản copy float32 duy nhất
+    pixels *= _NORM_SCALE
+    pixels += _NORM_BIAS
+    return np.ascontiguousarray(pixels.transpose(2, 0, 1))
+
+def preprocess_mode(fast: bool) -> str:
+    """Tên preprocess path, ghi vào quantization report: 'fast' (JPEG draft decode + numpy) | 'torchvision'"""
+    return "fast" if fast else "torchvision"
+
+def prepare_classification_bytes(data: bytes, fast: bool) -> np.ndarray:
+    """
+    Upload bytes -> [3, 224, 224] đúng như server (decode_image + preprocess_classification cùng mode).
+    Các tool quantize / parity dùng hàm này để đo trên chính input mà production thấy.
+    """
+    image = decode_image(data, draft_size=INPUT_SIZE if fast else None)
+    return preprocess_classification(image, fast=fast)
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+# =============================================================================
+# EXECUTION BACKENDS
+# =============================================================================
+class TorchClassifier:
+    """Eager PyTorch backend"""
+    backend = "torch"
+
+    def __init__(self, model: nn.Module, device: torch.device):
+        self.model = model
+        self.device = device
+
+    def predict_proba(self, batch: np.ndarray) -> np.ndarray:
+        """batch: float32 [N, 3, 224, 224] -> softmax probabilities [N, num_classes]"""
+        inputs = torch.from_numpy(np.ascontiguousarray(batch, dtype=np.float32)).to(self.device)
+        with torch.no_grad():
+            probabilities = torch.nn.functional.softmax(self.model(inputs), dim=1)
+        return probabilities.cpu().numpy()
+
+class OnnxClassifier:
+    """ONNX Runtime backend (CPU, full graph optimizations) - FP32 hoặc INT8 graph"""
+
+    def __init__(self, model_path: str, intra_op_threads: int = 0, backend: str = "onnx"):
+        import onnxruntime as ort
+
+        self.backend = backend
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+
+    def predict_proba(self, batch: np.ndarray) -> np.ndarray:
+        logits = self.session.run(
+            [self.output_name],
+            {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)}
+        )[0]
+        return softmax(logits)
+
+def export_onnx(model: nn.Module, output_path: str, opset: int = 17):
+    """
+    Export the exact EfficientNet-B0 + custom head (eval mode) to ONNX with a dynamic batch axis.
+    Dropout becomes identity and BatchNorm uses its running statistics, same as eager eval().
+    """
+    model = model.cpu().eval()
+    dummy = torch.randn(1, 3, INPUT_SIZE, INPUT_SIZE)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    torch.onnx.export(
+        model,
+        dummy,
+        output_path,
+        input_names=['input'],
+        output_names=['logits'],
+        dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+        opset_version=opset,
+        do_constant_folding=True,
+        training=torch.onnx.TrainingMode.EVAL
+    )
+
+def quantize_onnx_static(fp32_path: str, int8_path: str, calibration_batch: np.ndarray):
+    """
+    Static post-training INT8 quantization (QDQ, per-channel weights) với ONNX Runtime.
+    calibration_batch: float32 [N, 3, 224, 224] đã preprocess, dùng để đo range activation.
+    """
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        CalibrationMethod,
+        QuantFormat,
+        QuantType,
+        quantize_static
+    )
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class _CalibrationReader(CalibrationDataReader):
+        def __init__(self, input_name: str, batch: np.ndarray):
+            self._samples = iter([{input_name: sample[None].astype(np.float32)} for sample in batch])
+
+        def get_next(self):
+            return next(self._samples, None)
+
+    import onnxruntime as ort
+    input_name = ort.InferenceSession(fp32_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+
+    # Pre-process (shape inference + graph optimization) giúp quantizer fuse Conv/BN tốt hơn
+    prepared_path = int8_path + ".prep.onnx"
+    quant_pre_process(fp32_path, prepared_path)
+    try:
+        quantize_static(
+            prepared_path,
+            int8_path,
+            _CalibrationReader(input_name, calibration_batch),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            calibrate_method=CalibrationMethod.MinMax
+        )
+    finally:
+        if os.path.exists(prepared_path):
+            os.remove(prepared_path)
+
+def quantization_report_path(int8_path: str) -> str:
+    return os.path.splitext(int8_path)[0] + ".report.json"
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_quantization_report(int8_path: str) -> Optional[Dict]:
+    path = quantization_report_path(int8_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def create_classifier(backend: str, device: torch.device, checkpoint_path: str,
+                      onnx_path: Optional[str] = None, intra_op_threads: int = 0,
+                      int8_path: Optional[str] = None, int8_min_agreement: float = 1.0,
+                      safetensors_path: Optional[str] = None, fast_preprocess: bool = False):
+    """
+    Build the configured execution backend ('torch' | 'onnx' | 'int8').
+    Backend torch ưu tiên safetensors_path (mmap, xem convert_checkpoints.py) nếu file tồn tại.
+    'int8' chỉ được bật khi report của quantize_classifier.py có top-1 agreement >= int8_min_agreement,
+    int8_sha256 trong report khớp file .int8.onnx hiện tại (report cũ không duyệt được model quantize lại)
+    VÀ preprocess_mode của report khớp fast_preprocess của server (agreement đo trên input khác không tính),
+    nếu không sẽ fallback về FP32 (onnx nếu đã export, ngược lại torch).
+    """
+    if backend == "int8":
+        report = load_quantization_report(int8_path) if int8_path else None
+        agreement = report.get("top1_agreement") if report else None
+
+        if not int8_path or not os.path.exists(int8_path):
+            print(f"⚠️  INT8 model not found at {int8_path}. Run: python quantize_classifier.py")
+        elif agreement is None:
+            print(f"⚠️  No quantization report for {int8_path}. Run: python quantize_classifier.py")
+        elif report.get("int8_sha256") != file_sha256(int8_path):
+            print(f"⚠️  Quantization report does not match {int8_path} (re-quantized?). Run: python quantize_classifier.py")
+        elif report.get("preprocess_mode") != preprocess_mode(fast_preprocess):
+            print(f"⚠️  Quantization report was measured with preprocess_mode={report.get('preprocess_mode')}, "
+                  f"server uses {preprocess_mode(fast_preprocess)}. Run: python quantize_classifier.py")
+        elif agreement < int8_min_agreement:
+            print(f"⚠️  INT8 top-1 agreement {agreement:.4f} < required {int8_min_agreement:.4f}")
+        else:
+            print(f"ℹ️  INT8 top-1 agreement {agreement:.4f} >= {int8_min_agreement:.4f}")
+            return OnnxClassifier(int8_path, intra_op_threads=intra_op_threads, backend="int8")
+
+        backend = "onnx" if onnx_path and os.path.exists(onnx_path) else "torch"
+        print(f"⚠️  Falling back to FP32 backend: {backend}")
+
+    if backend == "onnx":
+        if not onnx_path or not os.path.exists(onnx_path):
+            raise FileNotFoundError(
+                f"ONNX model not found at {onnx_path}. Run: python export_classifier_onnx.py"
+            )
+        return OnnxClassifier(onnx_path, intra_op_threads=intra_op_threads, backend="onnx")
+
+    if backend != "torch":
+        raise ValueError(f"Unknown classification backend: {backend}")
+    if safetensors_path and os.path.exists(safetensors_path):
+        checkpoint_path = safetensors_path
+    return TorchClassifier(load_torch_classifier(checkpoint_path, device), device)
+
+def image_paths(image_dir: str, count: Optional[int] = None) -> List[str]:
+    """Các file ảnh trong image_dir (sắp xếp theo tên, tối đa count)"""
+    exts = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+    paths = sorted(
+        os.path.join(image_dir, name) for name in os.listdir(image_dir)
+        if name.lower().endswith(exts)
+    )
+    return paths[:count] if count is not None else paths
+
+def load_image_bytes(image_dir: Optional[str], count: int = 16, seed: int = 0) -> List[bytes]:
+    """
+    Như load_images nhưng trả file bytes (đi qua decode của server, gồm cả JPEG draft decode).
+    Không có image_dir -> ảnh synthetic cố định được encode JPEG.
+    """
+    if image_dir:
+        data = []
+        for path in image_paths(image_dir, count):
+            with open(path, 'rb') as f:
+                data.append(f.read())
+        return data
+
+    encoded = []
+    for image in load_images(None, count=count, seed=seed):
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        encoded.append(buffer.getvalue())
+    return encoded
+
+def load_images(image_dir: Optional[str], count: int = 16, seed: int = 0) -> List:
+    """
+    Fixed evaluation image set cho các tool parity/benchmark.
+    Nếu không có image_dir -> sinh ảnh synthetic cố định (seeded) để kết quả tái lập được.
+    """
+    from PIL import Image
+
+    if image_dir:
+        return [Image.open(path).convert("RGB") for path in image_paths(image_dir, count)]
+
+    print("⚠️  No image directory given, using fixed synthetic images")
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        h, w = rng.integers(256, 1024, size=2)
+        base = rng.integers(0, 256, size=(1, 1, 3))
+        noise = rng.normal(0, 40, size=(h, w, 3))
+        pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+        images.append(Image.fromarray(pixels))
+    return images
+
+def current_rss_mb() -> float:
+    """Resident set size hiện tại của process (MB)"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def peak_rss_mb(reset: bool = False) -> float:
+    """
+    Peak resident set size (VmHWM) của process (MB).
+    reset=True: reset peak về RSS hiện tại (Linux /proc/self/clear_refs) để đo peak của từng đoạn code.
+    """
+    try:
+        if reset:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
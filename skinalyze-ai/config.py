@@ -24,6 +24,37 @@ EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 GEMINI_TEXT_MODEL = "gemini-2.5-flash"
 GEMINI_VISION_MODEL = "gemini-2.5-flash"
 
+# Skin models (classification / segmentation)
+MODELS_DIR = BASE_DIR / "models"
+MODEL_PATHS = {
+    'classification': str(MODELS_DIR / "efficientnet_b0_complete.pt"),
+    'classification_onnx': os.getenv('CLASSIFICATION_ONNX_PATH', str(MODELS_DIR / "efficientnet_b0.onnx")),
+    'classification_int8': os.getenv('CLASSIFICATION_INT8_PATH', str(MODELS_DIR / "efficientnet_b0_int8.onnx")),
+    'segmentation': str(MODELS_DIR / "medsam2_dermatology_best_aug2.pth"),
+    # SAM2 ONNX graphs (python export_segmentation_onnx.py) cho SEGMENTATION_BACKEND=onnx
+    'segmentation_onnx_encoder': os.getenv(
+        'SEGMENTATION_ONNX_ENCODER_PATH', str(MODELS_DIR / "medsam2_dermatology_encoder.onnx")
+    ),
+    'segmentation_onnx_decoder': os.getenv(
+        'SEGMENTATION_ONNX_DECODER_PATH', str(MODELS_DIR / "medsam2_dermatology_decoder.onnx")
+    ),
+    # Memory-mapped weights (python convert_checkpoints.py) - ưu tiên dùng nếu file tồn tại
+    'classification_safetensors': os.getenv(
+        'CLASSIFICATION_SAFETENSORS_PATH', str(MODELS_DIR / "efficientnet_b0_complete.safetensors")
+    ),
+    'segmentation_safetensors': os.getenv(
+        'SEGMENTATION_SAFETENSORS_PATH', str(MODELS_DIR / "medsam2_dermatology_best_aug2.safetensors")
+    ),
+}
+
+# Backend chạy classifier: 'torch' (eager PyTorch) | 'onnx' (ONNX Runtime) | 'int8' (ONNX quantized)
+CLASSIFICATION_BACKEND = os.getenv('CLASSIFICATION_BACKEND', 'torch').lower()
+ONNX_INTRA_OP_THREADS = int(os.getenv('ONNX_INTRA_OP_THREADS', '0'))  # 0 = ONNX Runtime tự chọn
+# Backend segmentation: 'torch' (SAM2 eager) | 'onnx' (ONNX Runtime, encoder + decoder graph riêng)
+SEGMENTATION_BACKEND = os.getenv('SEGMENTATION_BACKEND', 'torch').lower()
+# INT8 chỉ được bật khi top-1 agreement với FP32 (quantize_classifier.py report) >= ngưỡng này
+CLASSIFICATION_INT8_MIN_AGREEMENT = float(os.getenv('CLASSIFICATION_INT8_MIN_AGREEMENT', '0.98'))
+
 # =============================================================================
 # RAG SETTINGS - Cấu hình RAG
 # =============================================================================
@@ -37,6 +68,115 @@ LLM_TEMPERATURE = 0.1
 LLM_MAX_OUTPUT_TOKENS = 512
 LLM_MAX_RETRIES = 2
 
+# =============================================================================
+# SERVING SETTINGS - Cấu hình phục vụ inference (override bằng env)
+# =============================================================================
+# Micro-batching cho classification: gom request đồng thời trong cửa sổ thời gian
+CLASSIFICATION_BATCH_WINDOW_MS = float(os.getenv('CLASSIFICATION_BATCH_WINDOW_MS', '10'))
+CLASSIFICATION_MAX_BATCH_SIZE = int(os.getenv('CLASSIFICATION_MAX_BATCH_SIZE', '16'))
+
+# Fast preprocessing: JPEG scale-on-decode + vectorized normalize (thay cho torchvision transforms)
+CLASSIFICATION_FAST_PREPROCESS = os.getenv('CLASSIFICATION_FAST_PREPROCESS', '1') == '1'
+
+# Result cache (LRU + TTL): probabilities theo hash ảnh, product suggestions theo class + profile
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '2048'))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv('RESULT_CACHE_TTL_SECONDS', '3600'))
+SUGGESTION_CACHE_MAX_ENTRIES = int(os.getenv('SUGGESTION_CACHE_MAX_ENTRIES', '1024'))
+SUGGESTION_CACHE_TTL_SECONDS = float(os.getenv('SUGGESTION_CACHE_TTL_SECONDS', '1800'))
+
+# SAM2 predictor pool: N predictor (state riêng, chung weights), mỗi request checkout 1 predictor
+SEGMENTATION_POOL_SIZE = int(os.getenv('SEGMENTATION_POOL_SIZE', '2'))
+SEGMENTATION_MAX_WAITING = int(os.getenv('SEGMENTATION_MAX_WAITING', '8'))  # quá số này -> 503 ngay
+SEGMENTATION_CHECKOUT_TIMEOUT_SECONDS = float(os.getenv('SEGMENTATION_CHECKOUT_TIMEOUT_SECONDS', '30'))
+
+# Working resolution cho segmentation: cạnh dài tối đa của ảnh đưa vào SAM2 (0 = full-res)
+# SAM2 resize nội bộ về 1024x1024 nên giá trị này gần như không ảnh hưởng chất lượng mask
+SEGMENTATION_MAX_SIDE = int(os.getenv('SEGMENTATION_MAX_SIDE', '1024'))
+
+# SAM2 image embedding cache (LRU theo content hash, giới hạn dung lượng) cho prompted re-segmentation
+SEGMENTATION_EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('SEGMENTATION_EMBEDDING_CACHE_MAX_ENTRIES', '64'))
+SEGMENTATION_EMBEDDING_CACHE_MAX_MB = float(os.getenv('SEGMENTATION_EMBEDDING_CACHE_MAX_MB', '512'))
+SEGMENTATION_EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv('SEGMENTATION_EMBEDDING_CACHE_TTL_SECONDS', '1800'))
+
+# MediaPipe face detection: pool N detector (mỗi graph chỉ 1 thread dùng tại 1 thời điểm)
+# Ảnh được thu nhỏ về cạnh dài FACE_DETECTION_MAX_SIDE trước khi detect (model short-range chạy ở 128x128)
+FACE_DETECTION_POOL_SIZE = int(os.getenv('FACE_DETECTION_POOL_SIZE', '2'))
+FACE_DETECTION_MAX_WAITING = int(os.getenv('FACE_DETECTION_MAX_WAITING', '32'))
+FACE_DETECTION_CHECKOUT_TIMEOUT_SECONDS = float(os.getenv('FACE_DETECTION_CHECKOUT_TIMEOUT_SECONDS', '10'))
+FACE_DETECTION_MAX_SIDE = int(os.getenv('FACE_DETECTION_MAX_SIDE', '640'))
+FACE_DETECTION_MIN_CONFIDENCE = float(os.getenv('FACE_DETECTION_MIN_CONFIDENCE', '0.5'))
+
+# notes == 'facial': classify vùng mặt (box khuôn mặt lớn nhất + margin) thay vì cả khung hình
+# Ảnh được decode 1 lần ở FACE_ROI_DECODE_MAX_SIDE (đủ để crop mặt >= 224px) cho cả detection lẫn crop
+FACE_CROP_ENABLED = os.getenv('FACE_CROP_ENABLED', '1') == '1'
+FACE_CROP_MARGIN = float(os.getenv('FACE_CROP_MARGIN', '0.25'))
+FACE_ROI_DECODE_MAX_SIDE = int(os.getenv('FACE_ROI_DECODE_MAX_SIDE', '1024'))
+
+# Số thread inference riêng cho từng model (chạy ngoài asyncio event loop)
+# segmentation / face_detection = số predictor trong pool (mỗi thread checkout 1 instance riêng)
+INFERENCE_THREADS = {
+    'classification': int(os.getenv('INFERENCE_THREADS_CLASSIFICATION', '1')),
+    'segmentation': int(os.getenv('INFERENCE_THREADS_SEGMENTATION', str(SEGMENTATION_POOL_SIZE))),
+    'face_detection': int(os.getenv('INFERENCE_THREADS_FACE_DETECTION', str(FACE_DETECTION_POOL_SIZE))),
+    'preprocess': int(os.getenv('INFERENCE_THREADS_PREPROCESS', '2')),  # decode + resize ảnh upload
+}
+
+# Model registry: model load khi có request đầu tiên, unload sau khi idle quá timeout (0 = không unload)
+MODEL_IDLE_TIMEOUT_SECONDS = float(os.getenv('MODEL_IDLE_TIMEOUT_SECONDS', '1800'))
+MODEL_LOAD_RETRY_SECONDS = float(os.getenv('MODEL_LOAD_RETRY_SECONDS', '60'))
+# Model luôn warm (load lúc khởi động, không unload): vd "classification,face_detection" hoặc "all"
+MODEL_PINNED = [name.strip() for name in os.getenv('MODEL_PINNED', '').split(',') if name.strip()]
+
+# Image store (POST /api/images): upload 1 lần -> image_handle dùng cho mọi endpoint ảnh
+# Bytes gốc spool ra IMAGE_STORE_DIR (chung giữa các worker), ảnh đã decode nằm trong LRU của từng worker
+IMAGE_STORE_DIR = os.getenv('IMAGE_STORE_DIR', '')  # rỗng = /dev/shm/skinalyze-image-store (hoặc temp dir)
+IMAGE_STORE_TTL_SECONDS = float(os.getenv('IMAGE_STORE_TTL_SECONDS', '600'))
+IMAGE_STORE_MAX_FILES = int(os.getenv('IMAGE_STORE_MAX_FILES', '256'))
+IMAGE_STORE_MAX_IMAGE_BYTES = int(os.getenv('IMAGE_STORE_MAX_IMAGE_BYTES', str(20 * 1024 * 1024)))
+IMAGE_STORE_CACHE_MAX_ENTRIES = int(os.getenv('IMAGE_STORE_CACHE_MAX_ENTRIES', '128'))
+IMAGE_STORE_CACHE_MAX_MB = float(os.getenv('IMAGE_STORE_CACHE_MAX_MB', '256'))
+
+# Image quality gate: kiểm tra sharpness / exposure / resolution / skin coverage trên bản thu nhỏ trước khi chạy model
+# "warn" = vẫn chạy, trả "image_quality" kèm issues | "reject" = 422 khi không đạt | "off" = tắt
+IMAGE_QUALITY_MODE = os.getenv('IMAGE_QUALITY_MODE', 'warn').lower()
+IMAGE_QUALITY_MAX_SIDE = int(os.getenv('IMAGE_QUALITY_MAX_SIDE', '512'))
+# Ngưỡng (0 = tắt check đó); sharpness = variance of Laplacian đo ở IMAGE_QUALITY_MAX_SIDE
+IMAGE_QUALITY_THRESHOLDS = {
+    'min_side': int(os.getenv('IMAGE_QUALITY_MIN_SIDE', '224')),
+    'min_sharpness': float(os.getenv('IMAGE_QUALITY_MIN_SHARPNESS', '40')),
+    'min_brightness': float(os.getenv('IMAGE_QUALITY_MIN_BRIGHTNESS', '40')),
+    'max_brightness': float(os.getenv('IMAGE_QUALITY_MAX_BRIGHTNESS', '225')),
+    'max_clipped_fraction': float(os.getenv('IMAGE_QUALITY_MAX_CLIPPED_FRACTION', '0.35')),
+    'min_skin_coverage': float(os.getenv('IMAGE_QUALITY_MIN_SKIN_COVERAGE', '0.05')),
+}
+
+# Ảnh gửi lên Gemini vision: xoay theo EXIF, bỏ metadata, thu nhỏ cạnh dài <= VISION_MAX_SIDE (0 = giữ nguyên), JPEG
+VISION_MAX_SIDE = int(os.getenv('VISION_MAX_SIDE', '1024'))
+VISION_JPEG_QUALITY = int(os.getenv('VISION_JPEG_QUALITY', '85'))
+
+# VLM (Gemini vision) cache trên disk (SQLite, dùng chung giữa các worker, giữ qua restart)
+# Key = hash pixel ảnh + note chuẩn hoá; entry tự invalidate khi VISION_PROMPT / model thay đổi
+VLM_CACHE_ENABLED = os.getenv('VLM_CACHE_ENABLED', '1') == '1'
+VLM_CACHE_PATH = os.getenv('VLM_CACHE_PATH', str(BASE_DIR / "cache" / "vlm_analysis.sqlite3"))
+VLM_CACHE_TTL_SECONDS = float(os.getenv('VLM_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+VLM_CACHE_MAX_MB = float(os.getenv('VLM_CACHE_MAX_MB', '64'))
+
+# /chat/stream (SSE): chu kỳ kiểm tra client đã ngắt kết nối -> huỷ request Gemini đang chạy
+CHAT_STREAM_DISCONNECT_POLL_SECONDS = float(os.getenv('CHAT_STREAM_DISCONNECT_POLL_SECONDS', '0.5'))
+
+# Single-flight: các lời gọi Gemini đồng thời có cùng prompt cuối + model settings dùng chung 1 upstream call
+LLM_SINGLEFLIGHT_ENABLED = os.getenv('LLM_SINGLEFLIGHT_ENABLED', '1') == '1'
+
+# Bulk classification: số ảnh tối đa đang xử lý / giữ trong RAM cùng lúc
+BULK_MAX_IN_FLIGHT = int(os.getenv('BULK_MAX_IN_FLIGHT', '32'))
+BULK_MAX_IMAGE_BYTES = int(os.getenv('BULK_MAX_IMAGE_BYTES', str(20 * 1024 * 1024)))
+
+# Preload-then-fork (gunicorn_conf.py): load weights 1 lần ở master, các worker dùng chung copy-on-write
+# vd "classification,segmentation,embeddings" (rỗng = mỗi worker tự load như cũ)
+PRELOAD_MODELS = [name.strip() for name in os.getenv('PRELOAD_MODELS', '').split(',') if name.strip()]
+# Số torch intra-op threads mỗi worker (0 = CPU cores / số workers)
+WORKER_TORCH_THREADS = int(os.getenv('WORKER_TORCH_THREADS', '0'))
+
 # =============================================================================
 # CONVERSATION MEMORY
 # =============================================================================
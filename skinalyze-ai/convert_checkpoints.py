@@ -0,0 +1,134 @@
+"""
+Convert classifier + SAM2 checkpoints (pickle) sang safetensors để load bằng mmap
+Chạy: python convert_checkpoints.py [--skip-benchmark]
+
+Server tự dùng file .safetensors nếu tồn tại (MODEL_PATHS['*_safetensors']).
+Benchmark load mỗi model trong process riêng (pickle vs safetensors) và báo startup time + peak RSS.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import torch
+
+from config import MODEL_PATHS
+from classifier import classifier_metadata, current_rss_mb, peak_rss_mb
+from weights import extract_state_dict, save_state_dict
+
+MODELS = ('classification', 'segmentation')
+
+
+def convert(name: str):
+    source = MODEL_PATHS[name]
+    target = MODEL_PATHS[f'{name}_safetensors']
+    if not os.path.exists(source):
+        print(f"    ⚠️  {name}: checkpoint not found at {source}, skipping")
+        return False
+
+    start = time.perf_counter()
+    checkpoint = torch.load(source, map_location="cpu", weights_only=False)
+    metadata = classifier_metadata(checkpoint) if name == 'classification' else {}
+    metadata['source'] = os.path.basename(source)
+    state_dict = extract_state_dict(checkpoint)
+
+    save_state_dict(state_dict, target, metadata)
+    print(f"    ✓ {name}: {len(state_dict)} tensors -> {target} "
+          f"({os.path.getsize(source) / 1e6:.1f} MB -> {os.path.getsize(target) / 1e6:.1f} MB, "
+          f"{time.perf_counter() - start:.1f}s)")
+    return True
+
+
+def load_once(name: str, path: str):
+    """Chạy trong process con: load model 1 lần, in JSON (thời gian, RSS)"""
+    device = torch.device("cpu")
+    baseline = current_rss_mb()
+    start = time.perf_counter()
+
+    if name == 'classification':
+        from classifier import load_torch_classifier
+        model = load_torch_classifier(path, device)
+    else:
+        from segmentation import load_sam2_model
+        is_safetensors = path.endswith(".safetensors")
+        model = load_sam2_model(MODEL_PATHS['segmentation'], device, safetensors_path=path if is_safetensors else None)
+
+    load_s = time.perf_counter() - start
+    params_mb = sum(p.numel() * p.element_size() for p in model.parameters()) / (1024 * 1024)
+    print(json.dumps({
+        "load_s": round(load_s, 3),
+        "baseline_rss_mb": round(baseline, 1),
+        "rss_mb": round(current_rss_mb(), 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "params_mb": round(params_mb, 1),
+    }))
+
+
+def measure(name: str, path: str, repeats: int):
+    """Median của `repeats` lần load, mỗi lần 1 process mới (cold start)"""
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, __file__, "--load-once", name, path],
+            capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    runs.sort(key=lambda run: run["load_s"])
+    return runs[len(runs) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert model checkpoints to memory-mapped safetensors")
+    parser.add_argument("--models", default=",".join(MODELS))
+    parser.add_argument("--skip-convert", action="store_true")
+    parser.add_argument("--skip-benchmark", action="store_true")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--load-once", nargs=2, metavar=("MODEL", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load_once:
+        load_once(*args.load_once)
+        return 0
+
+    names = [name.strip() for name in args.models.split(",") if name.strip() in MODELS]
+
+    print("\n" + "=" * 80)
+    print("📦 CONVERT CHECKPOINTS -> SAFETENSORS (mmap)")
+    print("=" * 80)
+
+    if not args.skip_convert:
+        print("\n🔄 [1/2] Converting...")
+        for name in names:
+            convert(name)
+    else:
+        print("\n🔄 [1/2] Skipping conversion")
+
+    if args.skip_benchmark:
+        return 0
+
+    print(f"\n⏱️  [2/2] Cold-start benchmark (median of {args.repeats} fresh processes)")
+    print(f"    {'model':<16}{'format':<14}{'load s':>9}{'peak RSS MB':>14}{'Δ peak MB':>12}{'RSS after MB':>15}")
+    for name in names:
+        rows = [("pickle", MODEL_PATHS[name]), ("safetensors", MODEL_PATHS[f'{name}_safetensors'])]
+        results = {}
+        for fmt, path in rows:
+            if not os.path.exists(path):
+                continue
+            result = results[fmt] = measure(name, path, args.repeats)
+            print(f"    {name:<16}{fmt:<14}{result['load_s']:>9.2f}{result['peak_rss_mb']:>14.1f}"
+                  f"{result['peak_rss_mb'] - result['baseline_rss_mb']:>12.1f}{result['rss_mb']:>15.1f}")
+
+        if len(results) == 2:
+            before, after = results["pickle"], results["safetensors"]
+            print(f"    ➜ {name}: {before['load_s'] / max(after['load_s'], 1e-6):.1f}x faster load, "
+                  f"peak RSS {before['peak_rss_mb']:.1f} -> {after['peak_rss_mb']:.1f} MB "
+                  f"(weights {after['params_mb']:.1f} MB)")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""
+Export EfficientNet-B0 classifier (checkpoint .pt) sang ONNX cho backend ONNX Runtime
+Chạy: python export_classifier_onnx.py [--checkpoint models/efficientnet_b0_complete.pt] [--output models/efficientnet_b0.onnx]
+Sau đó bật backend: CLASSIFICATION_BACKEND=onnx
+"""
+
+import argparse
+import time
+
+import torch
+
+from config import MODEL_PATHS
+from classifier import export_onnx, load_torch_classifier
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the skin classifier to ONNX")
+    parser.add_argument("--checkpoint", default=MODEL_PATHS['classification'])
+    parser.add_argument("--output", default=MODEL_PATHS['classification_onnx'])
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print("📦 EXPORT CLASSIFIER → ONNX")
+    print("=" * 80)
+
+    model = load_torch_classifier(args.checkpoint, torch.device("cpu"))
+
+    start_time = time.time()
+    export_onnx(model, args.output, opset=args.opset)
+    print(f"✅ Exported to {args.output} ({time.time() - start_time:.1f}s, opset {args.opset})")
+
+    try:
+        import onnx
+        onnx.checker.check_model(onnx.load(args.output))
+        print("✅ ONNX graph check passed")
+    except ImportError:
+        print("ℹ️  Package 'onnx' not installed, skipping graph check")
+
+    print("💡 Verify parity: python check_classifier_parity.py")
+
+
+if __name__ == "__main__":
+    main()
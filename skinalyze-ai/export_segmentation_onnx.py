@@ -0,0 +1,71 @@
+"""
+Export SAM2 segmentation (medsam2_dermatology fine-tuned) sang 2 ONNX graph cho backend ONNX Runtime
+- encoder: image [1, 3, 1024, 1024] -> image_embed + high_res_feats (chạy 1 lần / ảnh)
+- decoder: embedding + prompt points -> low-res mask logits + IoU (chạy cho mỗi prompt)
+Chạy: python export_segmentation_onnx.py [--checkpoint models/medsam2_dermatology_best_aug2.pth]
+Sau khi export: decoder được chạy với 0 / 2 / 3 / 5 điểm (dynamic num_points) và so với PyTorch
+Sau đó bật backend: SEGMENTATION_BACKEND=onnx
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+from config import MODEL_PATHS
+from segmentation import check_sam2_decoder_onnx, export_sam2_onnx, load_sam2_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the SAM2 segmentation model to ONNX (encoder + decoder)")
+    parser.add_argument("--checkpoint", default=MODEL_PATHS['segmentation'])
+    parser.add_argument("--safetensors", default=MODEL_PATHS['segmentation_safetensors'])
+    parser.add_argument("--encoder-output", default=MODEL_PATHS['segmentation_onnx_encoder'])
+    parser.add_argument("--decoder-output", default=MODEL_PATHS['segmentation_onnx_decoder'])
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--max-diff", type=float, default=1e-2,
+                        help="Max allowed |Δ| of decoder logits / IoU vs PyTorch per prompt case")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print("📦 EXPORT SAM2 SEGMENTATION → ONNX (encoder + decoder)")
+    print("=" * 80)
+
+    model = load_sam2_model(args.checkpoint, torch.device("cpu"), safetensors_path=args.safetensors)
+
+    start_time = time.time()
+    export_sam2_onnx(model, args.encoder_output, args.decoder_output, opset=args.opset)
+    print(f"✅ Exported in {time.time() - start_time:.1f}s (opset {args.opset})")
+    for path in (args.encoder_output, args.decoder_output):
+        print(f"    {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MB)")
+
+    try:
+        import onnx
+        for path in (args.encoder_output, args.decoder_output):
+            onnx.checker.check_model(path)
+        print("✅ ONNX graph check passed")
+    except ImportError:
+        print("ℹ️  Package 'onnx' not installed, skipping graph check")
+
+    # Dummy lúc trace có 3 điểm: kiểm tra trục num_points dynamic, nhất là 0 điểm (endpoint không prompt)
+    try:
+        diffs = check_sam2_decoder_onnx(model, args.decoder_output)
+    except RuntimeError as e:
+        print(f"❌ Decoder prompt check failed: {e}")
+        return 1
+    for case, diff in diffs.items():
+        print(f"    {case:<14} max |Δ| {diff:.2e}")
+    worst = max(diffs, key=diffs.get)
+    if diffs[worst] > args.max_diff:
+        print(f"❌ Decoder mismatch for '{worst}' ({diffs[worst]:.2e} > {args.max_diff})")
+        return 1
+    print("✅ Decoder prompt check passed (0 / 2 / 3 / 5 points)")
+
+    print("💡 Verify parity: python check_segmentation_parity.py")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+MediaPipe face detection - tạo detector + detect trên ảnh đã thu nhỏ + crop face ROI cho classification
+Dùng chung cho API server (main.py, qua PredictorPool) và benchmark_face_detection.py
+
+MediaPipe FaceDetection giữ graph có state nội bộ -> mỗi instance chỉ được 1 thread dùng tại 1 thời điểm.
+Model short-range chạy ở 128x128 nên đưa ảnh 12MP vào chỉ tốn thời gian copy/resize bên trong graph.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def create_face_detector(min_confidence: float = 0.5, model_selection: int = 0):
+    """1 MediaPipe FaceDetection (model_selection=0: short-range, khuôn mặt trong ~2m)"""
+    import mediapipe as mp
+
+    return mp.solutions.face_detection.FaceDetection(
+        model_selection=model_selection,
+        min_detection_confidence=min_confidence
+    )
+
+
+def downscale_for_detection(image_np: np.ndarray, max_side: int) -> np.ndarray:
+    """Thu nhỏ để cạnh dài <= max_side (INTER_AREA); max_side <= 0 hoặc ảnh đã nhỏ -> giữ nguyên"""
+    height, width = image_np.shape[:2]
+    if not max_side or max_side <= 0 or max(width, height) <= max_side:
+        return np.ascontiguousarray(image_np)
+    scale = max_side / max(width, height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image_np, size, interpolation=cv2.INTER_AREA)
+
+
+def _to_box(relative_box, size: Tuple[int, int]) -> List[float]:
+    """relative_bounding_box (0-1) -> [x, y, w, h] pixel của ảnh `size` (w, h), clip trong ảnh"""
+    width, height = size
+    x0 = min(max(relative_box.xmin, 0.0), 1.0) * width
+    y0 = min(max(relative_box.ymin, 0.0), 1.0) * height
+    x1 = min(max(relative_box.xmin + relative_box.width, 0.0), 1.0) * width
+    y1 = min(max(relative_box.ymin + relative_box.height, 0.0), 1.0) * height
+    return [round(x0, 1), round(y0, 1), round(x1 - x0, 1), round(y1 - y0, 1)]
+
+
+def detect_faces(detector, image_np: np.ndarray, original_size: Optional[Tuple[int, int]] = None,
+                 max_side: int = 0) -> List[Dict[str, Any]]:
+    """
+    Detect trên bản thu nhỏ của image_np (RGB uint8) -> [{"box": [x, y, w, h], "score": float}, ...]
+    Box theo pixel của original_size (w, h) - mặc định kích thước image_np. MediaPipe trả box
+    chuẩn hoá 0-1 nên map về ảnh gốc chỉ là nhân với kích thước gốc, không phụ thuộc bản thu nhỏ.
+    """
+    if original_size is None:
+        original_size = (image_np.shape[1], image_np.shape[0])
+    detections = detector.process(downscale_for_detection(image_np, max_side)).detections or []
+    faces = []
+    for detection in detections:
+        box = _to_box(detection.location_data.relative_bounding_box, original_size)
+        if box[2] <= 0 or box[3] <= 0:
+            continue
+        faces.append({"box": box, "score": round(float(detection.score[0]), 4) if detection.score else None})
+    return sorted(faces, key=lambda face: face["box"][2] * face["box"][3], reverse=True)
+
+
+def face_roi_box(faces: List[Dict[str, Any]], size: Tuple[int, int], margin: float = 0.25) -> Optional[List[float]]:
+    """
+    Box [x, y, w, h] quanh khuôn mặt lớn nhất, nới thêm `margin` x kích thước box mỗi phía
+    (lấy cả trán / cằm / má - vùng da classifier cần), clip trong ảnh `size` (w, h).
+    """
+    if not faces:
+        return None
+    x, y, w, h = faces[0]["box"]
+    width, height = size
+    x0, y0 = max(0.0, x - w * margin), max(0.0, y - h * margin)
+    x1, y1 = min(float(width), x + w * (1 + margin)), min(float(height), y + h * (1 + margin))
+    if x1 - x0 < 1 or y1 - y0 < 1:
+        return None
+    return [round(x0, 1), round(y0, 1), round(x1 - x0, 1), round(y1 - y0, 1)]
+
+
+def crop_to_box(image: Image.Image, box: List[float], original_size: Tuple[int, int]) -> Image.Image:
+    """Crop `box` (pixel ảnh gốc original_size) từ image - có thể là bản thu nhỏ của ảnh gốc"""
+    sx, sy = image.width / original_size[0], image.height / original_size[1]
+    x, y, w, h = box
+    left, top = int(x * sx), int(y * sy)
+    right, bottom = max(left + 1, round((x + w) * sx)), max(top + 1, round((y + h) * sy))
+    return image.crop((left, top, min(right, image.width), min(bottom, image.height)))
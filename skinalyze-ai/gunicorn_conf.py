@@ -0,0 +1,36 @@
+"""
+Gunicorn config - preload-then-fork serving mode
+Chạy: gunicorn -c gunicorn_conf.py main:app
+
+Master import app + load weights (PRELOAD_MODELS) một lần, sau đó fork WEB_CONCURRENCY
+uvicorn workers. Weights nằm trong các trang nhớ dùng chung copy-on-write nên mỗi worker
+chỉ tốn phần RAM riêng (activations, caches, ONNX/MediaPipe sessions).
+Đo RAM từng worker: python measure_worker_memory.py
+"""
+
+import os
+
+os.environ.setdefault("PRELOAD_MODELS", "classification,segmentation,embeddings")
+
+from config import PRELOAD_MODELS, WORKER_TORCH_THREADS  # noqa: E402
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "180"))
+graceful_timeout = 30
+# Import app ở master -> on_starting preload weights trước khi fork
+preload_app = bool(PRELOAD_MODELS)
+
+
+def on_starting(server):
+    if not preload_app:
+        return
+    import main
+    main.preload_shared_models()
+
+
+def post_fork(server, worker):
+    from preload import configure_worker_threads
+    threads = configure_worker_threads(workers, WORKER_TORCH_THREADS)
+    server.log.info("Worker %s: torch intra-op threads = %s", worker.pid, threads)
@@ -0,0 +1,90 @@
+"""
+Image quality gate - kiểm tra nhanh trên bản thu nhỏ trước khi chạy model (classification / SAM2 / Gemini VLM)
+- sharpness:     variance of Laplacian (ảnh mờ / rung tay -> thấp)
+- exposure:      độ sáng trung bình + tỉ lệ pixel cháy sáng / quá tối
+- resolution:    cạnh ngắn của ảnh gốc (không phải bản thu nhỏ)
+- skin coverage: tỉ lệ pixel màu da (YCrCb) - ảnh không có da / chụp nhầm vật khác -> thấp
+Chỉ dùng OpenCV trên ảnh <= max_side (mặc định 512) -> vài ms / ảnh.
+"""
+
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from face_detection import downscale_for_detection
+
+# Ngưỡng mặc định (override qua IMAGE_QUALITY_THRESHOLDS trong config.py); giá trị 0 = tắt check đó
+DEFAULT_THRESHOLDS = {
+    'min_side': 224,                # cạnh ngắn ảnh gốc (px) - classifier chạy ở 224x224
+    'min_sharpness': 40.0,          # variance of Laplacian đo ở max_side
+    'min_brightness': 40.0,         # độ sáng trung bình (0-255)
+    'max_brightness': 225.0,
+    'max_clipped_fraction': 0.35,   # tỉ lệ pixel quá tối (<16) hoặc cháy sáng (>240)
+    'min_skin_coverage': 0.05,      # tỉ lệ pixel màu da
+}
+
+# Vùng màu da trong YCrCb (Chai & Ngan) - đủ rộng cho nhiều tông da, không phụ thuộc độ sáng (Y)
+SKIN_YCRCB_LOWER = np.array([0, 133, 77], dtype=np.uint8)
+SKIN_YCRCB_UPPER = np.array([255, 173, 127], dtype=np.uint8)
+
+ISSUE_MESSAGES = {
+    'low_resolution': "Image resolution is too low",
+    'blurry': "Image is blurry - hold the camera steady and tap to focus",
+    'too_dark': "Image is too dark - take the photo in better light",
+    'overexposed': "Image is overexposed - avoid direct flash or strong light",
+    'low_skin_coverage': "Little or no skin visible in the image",
+}
+
+
+def assess_image_quality(image_np: np.ndarray, original_size: Optional[Tuple[int, int]] = None,
+                         max_side: int = 512, thresholds: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """
+    image_np: RGB uint8 (có thể đã là bản thu nhỏ), original_size: (w, h) của ảnh gốc
+    Returns {"passed", "issues": [{"code", "message"}], "metrics": {...}, "elapsed_ms"}
+    """
+    start = time.perf_counter()
+    limits = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+    if original_size is None:
+        original_size = (image_np.shape[1], image_np.shape[0])
+
+    small = downscale_for_detection(image_np, max_side)
+    gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    brightness = float(gray.mean())
+    dark_fraction = float(np.count_nonzero(gray < 16)) / gray.size
+    bright_fraction = float(np.count_nonzero(gray > 240)) / gray.size
+    skin_mask = cv2.inRange(cv2.cvtColor(small, cv2.COLOR_RGB2YCrCb), SKIN_YCRCB_LOWER, SKIN_YCRCB_UPPER)
+    skin_coverage = float(np.count_nonzero(skin_mask)) / skin_mask.size
+
+    issues = []
+    if limits['min_side'] and min(original_size) < limits['min_side']:
+        issues.append('low_resolution')
+    if (limits['min_brightness'] and brightness < limits['min_brightness']) or \
+            (limits['max_clipped_fraction'] and dark_fraction > limits['max_clipped_fraction']):
+        issues.append('too_dark')
+    if (limits['max_brightness'] and brightness > limits['max_brightness']) or \
+            (limits['max_clipped_fraction'] and bright_fraction > limits['max_clipped_fraction']):
+        issues.append('overexposed')
+    # Laplacian variance tỉ lệ với contrast: ảnh quá tối / cháy sáng đã bị báo lỗi exposure, không báo mờ nữa
+    exposure_ok = 'too_dark' not in issues and 'overexposed' not in issues
+    if exposure_ok and limits['min_sharpness'] and sharpness < limits['min_sharpness']:
+        issues.append('blurry')
+    if limits['min_skin_coverage'] and skin_coverage < limits['min_skin_coverage']:
+        issues.append('low_skin_coverage')
+
+    return {
+        "passed": not issues,
+        "issues": [{"code": code, "message": ISSUE_MESSAGES[code]} for code in issues],
+        "metrics": {
+            "sharpness": round(sharpness, 1),
+            "brightness": round(brightness, 1),
+            "dark_fraction": round(dark_fraction, 4),
+            "bright_fraction": round(bright_fraction, 4),
+            "resolution": list(original_size),
+            "skin_coverage": round(skin_coverage, 4),
+        },
+        "elapsed_ms": round((time.perf_counter() - start) * 1000.0, 2)
+    }
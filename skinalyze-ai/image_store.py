@@ -0,0 +1,191 @@
+"""
+Image store: upload ảnh 1 lần -> handle ngắn hạn dùng lại cho mọi endpoint phân tích ảnh
+- Bytes gốc được spool ra IMAGE_STORE_DIR (tmpfs nếu có) -> mọi gunicorn worker đều resolve được handle
+- Ảnh đã decode (RGB) + các bản thu nhỏ thông dụng (max side) nằm trong LRU giới hạn theo bytes của từng process
+  -> phân tích lặp lại trên cùng 1 ảnh bỏ qua cả upload lẫn decode
+"""
+
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+
+from cache import TTLCache
+from segmentation import decode_for_segmentation
+
+HANDLE_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+
+def default_store_dir() -> str:
+    """/dev/shm (RAM, chung giữa các worker) nếu có, ngược lại thư mục temp của hệ thống"""
+    base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+    return os.path.join(base, "skinalyze-image-store")
+
+
+class ImageNotFound(Exception):
+    """Handle không tồn tại / đã hết hạn"""
+
+
+class ImageStore:
+    """
+    handle = store.put(contents)
+    contents = store.get_bytes(handle)
+    image, original_size = store.variant(handle, 1024)   # RGB, cạnh dài <= 1024 (0 = full-res)
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        ttl_seconds: float = 600,
+        max_files: int = 256,
+        max_image_bytes: int = 20 * 1024 * 1024,
+        cache_max_entries: int = 128,
+        cache_max_bytes: int = 256 * 1024 * 1024
+    ):
+        self.directory = directory
+        self.ttl = ttl_seconds if ttl_seconds and ttl_seconds > 0 else None
+        self.max_files = max(1, int(max_files))
+        self.max_image_bytes = max_image_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+        # (handle, "bytes") -> bytes gốc, (handle, max_side) -> (PIL RGB, original_size)
+        self.decoded = TTLCache(
+            max_entries=cache_max_entries,
+            ttl_seconds=self.ttl,
+            max_bytes=cache_max_bytes,
+            sizeof=self._sizeof,
+            name="image_store"
+        )
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.decodes = 0
+        self.spool_reads = 0
+        self.expired = 0
+
+    @staticmethod
+    def _sizeof(value: Any) -> int:
+        if isinstance(value, bytes):
+            return len(value)
+        image, _ = value
+        return image.width * image.height * len(image.getbands())
+
+    def _path(self, handle: str) -> str:
+        if not handle or not HANDLE_PATTERN.match(handle):
+            raise ImageNotFound(f"Invalid image handle: {handle!r}")
+        return os.path.join(self.directory, f"{handle}.img")
+
+    def _expired(self, path: str) -> bool:
+        try:
+            return self.ttl is not None and os.path.getmtime(path) + self.ttl <= time.time()
+        except FileNotFoundError:
+            return True
+
+    def _sweep(self):
+        """Xoá file hết hạn, rồi file cũ nhất nếu vượt max_files (gọi khi put)"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".img"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            if self.ttl is not None and mtime + self.ttl <= time.time():
+                self._unlink(path)
+                self.expired += 1
+            else:
+                entries.append((mtime, path))
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_files + 1)]:
+            self._unlink(path)
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, contents: bytes) -> str:
+        """Spool bytes gốc, trả về handle mới (ghi file tạm rồi rename -> worker khác không đọc phải file dở)"""
+        if self.max_image_bytes and len(contents) > self.max_image_bytes:
+            raise ValueError(f"Image larger than {self.max_image_bytes // (1024 * 1024)}MB")
+
+        handle = secrets.token_urlsafe(18)
+        path = self._path(handle)
+        with self._lock:
+            self._sweep()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+
+        self.decoded.set((handle, "bytes"), contents)
+        self.uploads += 1
+        return handle
+
+    def get_bytes(self, handle: str) -> bytes:
+        path = self._path(handle)
+        if self._expired(path):
+            self.delete(handle)
+            raise ImageNotFound(f"Image handle {handle} not found or expired")
+
+        contents = self.decoded.get((handle, "bytes"))
+        if contents is None:
+            try:
+                with open(path, "rb") as f:
+                    contents = f.read()
+            except FileNotFoundError:
+                raise ImageNotFound(f"Image handle {handle} not found or expired")
+            self.spool_reads += 1
+            self.decoded.set((handle, "bytes"), contents)
+        return contents
+
+    def variant(self, handle: str, max_side: int = 0) -> Tuple[Image.Image, Tuple[int, int]]:
+        """Ảnh RGB với cạnh dài <= max_side (0 = full-res) + original_size (w, h); decode 1 lần / process"""
+        contents = self.get_bytes(handle)
+        key = (handle, max(0, int(max_side or 0)))
+        cached = self.decoded.get(key)
+        if cached is not None:
+            return cached
+
+        working, _, original_size = decode_for_segmentation(contents, key[1], keep_full=False)
+        self.decodes += 1
+        self.decoded.set(key, (working, original_size))
+        return working, original_size
+
+    def expires_at(self, handle: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(self._path(handle)) + self.ttl if self.ttl else None
+        except FileNotFoundError:
+            return None
+
+    def delete(self, handle: str) -> bool:
+        path = self._path(handle)
+        existed = os.path.exists(path)
+        self._unlink(path)
+        self.decoded.pop((handle, "bytes"))
+        return existed
+
+    def metrics(self) -> Dict[str, Any]:
+        try:
+            files = sum(1 for name in os.listdir(self.directory) if name.endswith(".img"))
+        except FileNotFoundError:
+            files = 0
+        return {
+            "directory": self.directory,
+            "files": files,
+            "max_files": self.max_files,
+            "ttl_seconds": self.ttl,
+            "uploads": self.uploads,
+            "decodes": self.decodes,
+            "spool_reads": self.spool_reads,
+            "expired": self.expired,
+            "decoded_cache": self.decoded.metrics(),
+        }
@@ -0,0 +1,130 @@
+"""
+Inference executor - chạy model blocking (torch, SAM2, MediaPipe) ngoài event loop
+Mỗi model có thread pool riêng để một model chậm không chặn các model khác
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict
+
+
+class _ModelStats:
+    __slots__ = ("queued", "active", "completed", "errors", "busy_time", "wait_time")
+
+    def __init__(self):
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+
+
+class _Job:
+    __slots__ = ("started", "abandoned")
+
+    def __init__(self):
+        self.started = False
+        self.abandoned = False
+
+
+class InferenceExecutor:
+    """
+    Per-model thread pools for blocking inference calls.
+
+    Usage:
+        executor = InferenceExecutor({'classification': 2, 'segmentation': 1})
+        result = await executor.run('segmentation', fn, *args)
+    """
+
+    def __init__(self, pool_sizes: Dict[str, int], default_size: int = 1):
+        self.pool_sizes = {name: max(1, int(size)) for name, size in pool_sizes.items()}
+        self.default_size = max(1, int(default_size))
+        self._pools: Dict[str, ThreadPoolExecutor] = {}
+        self._stats: Dict[str, _ModelStats] = {}
+        self._lock = threading.Lock()
+        self._started_at = time.perf_counter()
+
+    def _get_pool(self, model: str) -> ThreadPoolExecutor:
+        with self._lock:
+            pool = self._pools.get(model)
+            if pool is None:
+                size = self.pool_sizes.setdefault(model, self.default_size)
+                pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"infer-{model}")
+                self._pools[model] = pool
+                self._stats[model] = _ModelStats()
+            return pool
+
+    def _timed_call(self, model: str, job: _Job, submitted_at: float, fn: Callable, *args, **kwargs):
+        stats = self._stats[model]
+        started_at = time.perf_counter()
+        with self._lock:
+            if job.abandoned:
+                return None  # caller đã bị huỷ trước khi job chạy -> bỏ qua, queued đã được trừ
+            job.started = True
+            stats.queued -= 1
+            stats.active += 1
+            stats.wait_time += started_at - submitted_at
+
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - started_at
+            with self._lock:
+                stats.active -= 1
+                stats.busy_time += elapsed
+                if ok:
+                    stats.completed += 1
+                else:
+                    stats.errors += 1
+
+    async def run(self, model: str, fn: Callable, *args, **kwargs) -> Any:
+        """Run `fn(*args, **kwargs)` on the thread pool dedicated to `model`"""
+        pool = self._get_pool(model)
+        job = _Job()
+        with self._lock:
+            self._stats[model].queued += 1
+
+        call = partial(self._timed_call, model, job, time.perf_counter(), fn, *args, **kwargs)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, call)
+        finally:
+            # Caller bị huỷ (client ngắt kết nối) / pool shutdown trước khi job chạy -> không để queue_depth bị treo
+            with self._lock:
+                if not job.started and not job.abandoned:
+                    job.abandoned = True
+                    self._stats[model].queued -= 1
+
+    def metrics(self) -> Dict[str, Any]:
+        uptime = time.perf_counter() - self._started_at
+        report = {}
+        with self._lock:
+            for model, stats in self._stats.items():
+                finished = stats.completed + stats.errors
+                started = finished + stats.active
+                workers = self.pool_sizes[model]
+                report[model] = {
+                    "workers": workers,
+                    "queue_depth": stats.queued,
+                    "active": stats.active,
+                    "completed": stats.completed,
+                    "errors": stats.errors,
+                    "busy_time_s": round(stats.busy_time, 3),
+                    "avg_busy_ms": round(stats.busy_time / finished * 1000.0, 3) if finished else 0.0,
+                    "avg_queue_wait_ms": round(stats.wait_time / started * 1000.0, 3) if started else 0.0,
+                    "utilization": round(stats.busy_time / (uptime * workers), 4) if uptime > 0 else 0.0,
+                }
+        return report
+
+    def shutdown(self, wait: bool = False):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.shutdown(wait=wait, cancel_futures=True)
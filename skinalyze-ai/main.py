@@ -6,26 +6,26 @@ Stateless API for NestJS Backend Integration
 # =============================================================================
 # IMPORTS
 # =============================================================================
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager, aclosing
 from pydantic import BaseModel
 import torch
-import torch.nn as nn
-from torchvision import models, transforms
 from PIL import Image
 import io
 import base64
 import numpy as np
-from typing import Dict, Optional, List, Any
+from typing import Dict, Optional, List, Any, Tuple
 import os
 import time
 import json
 import re
+import asyncio
+import zipfile
+import zlib
 from datetime import datetime
-import mediapipe as mp
 from dotenv import load_dotenv
-import google.generativeai as genai 
 
 load_dotenv()
 
@@ -33,8 +33,20 @@ load_dotenv()
 from RAG_cosmetic import (
     setup_api_key,
     load_or_create_vectorstore,
+    load_embedding_model,
+    build_rag_components,
     setup_rag_chain,
-    analyze_skin_image,
+    RagStreamer,
+    analyze_skin_image_async,
+    get_gemini_model,
+    GEMINI_MODEL_NAME,
+    RAG_LLM_SETTINGS,
+    decode_vision_input,
+    image_pixel_hash,
+    normalize_vision_image,
+    normalize_note,
+    vision_prompt_version,
+    vision_stats,
     check_severity,
     build_image_analysis_query,
     detect_skin_condition_and_types,
@@ -42,49 +54,114 @@ from RAG_cosmetic import (
     map_disease_to_skin_types,
     convert_price_in_text
 )
+from config import (
+    MODEL_PATHS,
+    CLASSIFICATION_BACKEND,
+    SEGMENTATION_BACKEND,
+    ONNX_INTRA_OP_THREADS,
+    CLASSIFICATION_INT8_MIN_AGREEMENT,
+    CLASSIFICATION_BATCH_WINDOW_MS,
+    CLASSIFICATION_MAX_BATCH_SIZE,
+    CLASSIFICATION_FAST_PREPROCESS,
+    INFERENCE_THREADS,
+    RESULT_CACHE_MAX_ENTRIES,
+    RESULT_CACHE_TTL_SECONDS,
+    SUGGESTION_CACHE_MAX_ENTRIES,
+    SUGGESTION_CACHE_TTL_SECONDS,
+    BULK_MAX_IN_FLIGHT,
+    BULK_MAX_IMAGE_BYTES,
+    MODEL_IDLE_TIMEOUT_SECONDS,
+    MODEL_LOAD_RETRY_SECONDS,
+    MODEL_PINNED,
+    PRELOAD_MODELS,
+    SEGMENTATION_POOL_SIZE,
+    SEGMENTATION_MAX_WAITING,
+    SEGMENTATION_CHECKOUT_TIMEOUT_SECONDS,
+    SEGMENTATION_EMBEDDING_CACHE_MAX_ENTRIES,
+    SEGMENTATION_EMBEDDING_CACHE_MAX_MB,
+    SEGMENTATION_EMBEDDING_CACHE_TTL_SECONDS,
+    SEGMENTATION_MAX_SIDE,
+    FACE_DETECTION_POOL_SIZE,
+    FACE_DETECTION_MAX_WAITING,
+    FACE_DETECTION_CHECKOUT_TIMEOUT_SECONDS,
+    FACE_DETECTION_MAX_SIDE,
+    FACE_DETECTION_MIN_CONFIDENCE,
+    FACE_CROP_ENABLED,
+    FACE_CROP_MARGIN,
+    FACE_ROI_DECODE_MAX_SIDE,
+    IMAGE_STORE_DIR,
+    IMAGE_STORE_TTL_SECONDS,
+    IMAGE_STORE_MAX_FILES,
+    IMAGE_STORE_MAX_IMAGE_BYTES,
+    IMAGE_STORE_CACHE_MAX_ENTRIES,
+    IMAGE_STORE_CACHE_MAX_MB,
+    IMAGE_QUALITY_MODE,
+    IMAGE_QUALITY_MAX_SIDE,
+    IMAGE_QUALITY_THRESHOLDS,
+    VLM_CACHE_ENABLED,
+    VLM_CACHE_PATH,
+    VLM_CACHE_TTL_SECONDS,
+    VLM_CACHE_MAX_MB,
+    CHAT_STREAM_DISCONNECT_POLL_SECONDS,
+    LLM_SINGLEFLIGHT_ENABLED
+)
+from classifier import SKIN_CLASSES, INPUT_SIZE, create_classifier, decode_image, preprocess_classification
+from segmentation import load_sam2_model, Sam2OnnxSessions, OnnxSam2Predictor, segment_image, embedding_nbytes, decode_for_segmentation, upsample_mask
+from face_detection import create_face_detector, detect_faces, face_roi_box, crop_to_box
+from mask_encoding import parse_output_formats, encode_rle, mask_polygons, mask_bbox
+from batching import MicroBatcher
+from singleflight import SingleFlight
+from inference_executor import InferenceExecutor
+from cache import TTLCache, DiskCache, content_hash
+from model_registry import ModelRegistry
+from preload import PRELOADED, preload_models, preloaded_loader
+from predictor_pool import PredictorPool, PoolExhausted
+from image_store import ImageStore, ImageNotFound, default_store_dir
+from image_quality import assess_image_quality
 
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
-SKIN_CLASSES = [
-    'Acne',
-    'Actinic_Keratosis',
-    'Drug_Eruption',
-    'Eczema',
-    'Normal',
-    'Psoriasis',
-    'Rosacea',
-    'Seborrh_Keratoses',
-    'Sun_Sunlight_Damage',
-    'Tinea',
-    'Warts'
-]
-
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-MODEL_PATHS = {
-    'classification': os.path.join(BASE_DIR, "models/efficientnet_b0_complete.pt"),
-    'segmentation': os.path.join(BASE_DIR, "models/medsam2_dermatology_best_aug2.pth")
-}
-
-IMAGE_TRANSFORMS = {
-    'classification': transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-}
-
 # =============================================================================
 # GLOBAL STATE
 # =============================================================================
 class AppState:
     rag_chain = None
-    classification_model = None
-    segmentation_model = None
-    face_detector = None
+    # Cùng retriever / prompt / LLM với rag_chain, chạy từng bước cho /chat/stream (SSE)
+    rag_streamer = None
+    # Skin models (classification / segmentation / face_detection) - lazy load qua registry
+    models = ModelRegistry(MODEL_IDLE_TIMEOUT_SECONDS, MODEL_LOAD_RETRY_SECONDS)
+    classification_batcher = None
     vectorstore = None
+    inference_executor = None
+    # Result caches: probabilities theo ảnh, product suggestions theo (class + profile)
+    classification_cache = TTLCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL_SECONDS, name="classification")
+    suggestion_cache = TTLCache(SUGGESTION_CACHE_MAX_ENTRIES, SUGGESTION_CACHE_TTL_SECONDS, name="product_suggestions")
+    # SAM2 image embeddings theo content hash -> refine mask bằng prompt chỉ chạy mask decoder
+    embedding_cache = TTLCache(
+        SEGMENTATION_EMBEDDING_CACHE_MAX_ENTRIES,
+        SEGMENTATION_EMBEDDING_CACHE_TTL_SECONDS,
+        max_bytes=int(SEGMENTATION_EMBEDDING_CACHE_MAX_MB * 1024 * 1024),
+        sizeof=embedding_nbytes,
+        name="segmentation_embeddings"
+    )
+    # Upload-once image handles (POST /api/images), tạo trong lifespan
+    image_store = None
+    # Image quality gate: số ảnh đã kiểm tra / không đạt / bị reject + đếm theo issue code
+    image_quality_stats = {"checked": 0, "failed": 0, "rejected": 0, "issues": {}}
+    # Gemini vision cache trên disk (tạo trong lifespan) + thời gian tiết kiệm được / thời gian gọi Gemini
+    vlm_cache = None
+    vlm_stats = {"saved_calls": 0, "saved_seconds": 0.0, "hit_ms_total": 0.0,
+                 "gemini_calls": 0, "gemini_ms_total": 0.0}
+    # Lời gọi LLM đồng thời giống hệt nhau (cùng prompt + settings) -> 1 upstream call
+    llm_flights = SingleFlight(name="llm")
+    # /chat/stream: số stream xong / bị client huỷ / lỗi + thời gian tới event đầu tiên và token đầu tiên
+    chat_stream_stats = {"requests": 0, "completed": 0, "cancelled": 0, "errors": 0,
+                         "first_events": 0, "first_event_ms_total": 0.0,
+                         "first_tokens": 0, "first_token_ms_total": 0.0}
 
 state = AppState()
 
@@ -98,10 +175,11 @@ async def smart_product_filtering(
     age: Optional[int], 
     gender: Optional[str], 
     allergies: Optional[str]
-) -> List[Dict[str, str]]:
+) -> Tuple[List[Dict[str, str]], bool]:
     """
     ASYNC Version: Lọc sản phẩm dùng Gemini với Prompt chú trọng toàn diện:
     Disease + Skin Type + Age + Gender + Allergies.
+    Returns (suggestions, from_llm): from_llm = False khi là danh sách fallback (Gemini lỗi / sai format).
     """
     try:
         print(f"\n🧠 Starting Smart Product Filtering for {disease_class}...")
@@ -111,7 +189,8 @@ async def smart_product_filtering(
         # Thêm từ khóa ingredients để đảm bảo có thông tin thành phần cho việc lọc
         query = f"sản phẩm điều trị chăm sóc da {disease_class} {' '.join(skin_types)} ingredients"
         
-        docs = db.similarity_search(query, k=25)
+        # Embedding query + Chroma search chạy trong thread (asimilarity_search), không block event loop
+        docs = await db.asimilarity_search(query, k=25)
         
         # 2. Group & Deduplicate
         candidates = {}
@@ -127,7 +206,7 @@ async def smart_product_filtering(
                 candidates[name] = doc.page_content[:500]
         
         if not candidates:
-            return []
+            return [], False
 
         print(f"   🔍 Found {len(candidates)} candidate products. Asking Gemini (Async)...")
 
@@ -169,9 +248,11 @@ async def smart_product_filtering(
         ]
         """
 
-        # 4. Call Gemini ASYNC
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = await model.generate_content_async(prompt)
+        # 4. Call Gemini ASYNC (GenerativeModel dùng chung cho cả process); cùng prompt đồng thời -> 1 call
+        response = await coalesced_llm_call(
+            "product_filtering", (GEMINI_MODEL_NAME, prompt),
+            lambda: get_gemini_model().generate_content_async(prompt)
+        )
         
         # 5. Parse Result
         result_text = response.text.strip()
@@ -196,82 +277,95 @@ async def smart_product_filtering(
                         valid_results.append({"product_name": item, "reason": f"Gợi ý chuyên biệt cho {display_gender}, {display_age} bị {disease_class}."})
                 
                 print(f"   ✅ Gemini selected top {len(valid_results)} products with personalized reasons.")
-                return valid_results[:5]
+                return valid_results[:5], True
             else:
                  print("   ⚠️ Gemini response format unexpected, falling back.")
-                 return [{"product_name": name, "reason": f"Phù hợp với {disease_class} và loại da của bạn."} for name in list(candidates.keys())[:5]]
+                 return [{"product_name": name, "reason": f"Phù hợp với {disease_class} và loại da của bạn."} for name in list(candidates.keys())[:5]], False
 
         except json.JSONDecodeError:
             print(f"   ⚠️ JSON Parse Error. Fallback.")
-            return [{"product_name": name, "reason": f"Sản phẩm được gợi ý cho tình trạng {disease_class}."} for name in list(candidates.keys())[:5]]
+            return [{"product_name": name, "reason": f"Sản phẩm được gợi ý cho tình trạng {disease_class}."} for name in list(candidates.keys())[:5]], False
 
     except Exception as e:
         print(f"   ❌ Error in smart filtering: {str(e)}")
         # Fallback về logic cũ
-        basic_list = get_product_suggestions_by_skin_types(db, skin_types, num_products=5)
-        return [{"product_name": name, "reason": f"Đề xuất dựa trên loại da {', '.join(skin_types)}."} for name in basic_list]
+        basic_list = await asyncio.to_thread(get_product_suggestions_by_skin_types, db, skin_types, 5)
+        return [{"product_name": name, "reason": f"Đề xuất dựa trên loại da {', '.join(skin_types)}."} for name in basic_list], False
+
+def _normalize_profile_field(value) -> Optional[str]:
+    """Profile field cho cả cache key lẫn prompt Gemini: bỏ khoảng trắng thừa, chữ thường, 'none' / 'null' -> None"""
+    if value is None:
+        return None
+    text = " ".join(str(value).split()).lower()
+    return None if text in ["", "none", "null"] else text
+
+async def get_product_suggestions(
+    predicted_class: str,
+    age: Optional[int],
+    gender: Optional[str],
+    allergies: Optional[str]
+) -> List[Dict[str, str]]:
+    """
+    Smart filtering có cache: suggestions chỉ phụ thuộc vào class + profile (age, gender, allergies),
+    nên request retry / đổi ảnh cùng bệnh không gọi lại Gemini.
+    Chỉ cache kết quả Gemini đã xếp hạng: fallback (Gemini lỗi / timeout) -> request sau thử lại Gemini.
+    """
+    if not state.vectorstore:
+        return []
+
+    # Normalize 1 lần: cache key và prompt dùng cùng giá trị -> cùng key luôn là cùng prompt
+    gender = _normalize_profile_field(gender)
+    allergies = _normalize_profile_field(allergies)
+    cache_key = content_hash(predicted_class, age, gender or "", allergies or "")
+    cached = state.suggestion_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Map disease to skin types
+    suitable_skin_types = map_disease_to_skin_types(predicted_class)
+    
+    # ✅ CALL SMART FILTERING with Gemini (Async)
+    product_suggestions, from_llm = await smart_product_filtering(
+        state.vectorstore,
+        predicted_class,
+        suitable_skin_types,
+        age,
+        gender,
+        allergies
+    )
+    if product_suggestions and from_llm:
+        state.suggestion_cache.set(cache_key, product_suggestions)
+    return product_suggestions
 
 # =============================================================================
 # MODEL LOADING
 # =============================================================================
 def load_classification_model():
     """
-    Load EfficientNet-B0 với architecture khớp training notebook
-    Architecture: 1280 → [Dropout 0.4] → 512 → [BN + ReLU + Dropout 0.3] → 256 → [BN + ReLU] → 11
+    Load EfficientNet-B0 classifier với backend cấu hình bởi CLASSIFICATION_BACKEND
+    - torch: eager PyTorch (rebuild architecture khớp training notebook)
+    - onnx:  ONNX Runtime với graph optimizations (xem export_classifier_onnx.py)
+    - int8:  ONNX Runtime INT8, chỉ bật khi agreement >= ngưỡng (xem quantize_classifier.py)
     """
     model_path = MODEL_PATHS['classification']
-    if not os.path.exists(model_path):
+    safetensors_path = MODEL_PATHS['classification_safetensors']
+    if CLASSIFICATION_BACKEND == "torch" and not os.path.exists(model_path) and not os.path.exists(safetensors_path):
         print(f"⚠️  Classification model not found at {model_path}")
         return None
     
     try:
-        # Load checkpoint
-        checkpoint = torch.load(model_path, map_location=device, weights_only=False)
-        
-        # 1. If checkpoint is a full model object
-        if not isinstance(checkpoint, dict):
-            print("ℹ️  Checkpoint is a full model object.")
-            model = checkpoint
-            model.to(device)
-            model.eval()
-            return model
-
-        # 2. Extract state_dict
-        state_dict = checkpoint.get('model_state_dict', checkpoint)
-        
-        # Get architecture config
-        config = checkpoint.get('config', {})
-        dropout1 = config.get('dropout1', 0.4)
-        dropout2 = config.get('dropout2', 0.3)
-        num_classes = checkpoint.get('num_classes', len(SKIN_CLASSES))
-        
-        print(f"ℹ️  Loading model with config:")
-        print(f"   - Num classes: {num_classes}")
-        
-        # Initialize EfficientNet-B0 base
-        model = models.efficientnet_b0(weights=None)
-        
-        # Reconstruct EXACT classifier
-        num_features = 1280
-        
-        model.classifier = nn.Sequential(
-            nn.Dropout(p=dropout1),
-            nn.Linear(num_features, 512),
-            nn.BatchNorm1d(512),
-            nn.ReLU(),
-            nn.Dropout(p=dropout2),
-            nn.Linear(512, 256),
-            nn.BatchNorm1d(256),
-            nn.ReLU(),
-            nn.Linear(256, num_classes)
+        model = create_classifier(
+            CLASSIFICATION_BACKEND,
+            device,
+            checkpoint_path=model_path,
+            onnx_path=MODEL_PATHS['classification_onnx'],
+            intra_op_threads=ONNX_INTRA_OP_THREADS,
+            int8_path=MODEL_PATHS['classification_int8'],
+            int8_min_agreement=CLASSIFICATION_INT8_MIN_AGREEMENT,
+            safetensors_path=safetensors_path,
+            fast_preprocess=CLASSIFICATION_FAST_PREPROCESS
         )
-        
-        # Load trained weights
-        model.load_state_dict(state_dict, strict=False)
-        model.to(device)
-        model.eval()
-        
-        print(f"✅ Classification model loaded successfully")
+        print(f"✅ Classification model loaded successfully (backend: {model.backend})")
         
         return model
         
@@ -281,51 +375,350 @@ def load_classification_model():
         traceback.print_exc()
         return None
 
+def create_segmentation_predictors(count: int) -> list:
+    """
+    N predictor dùng chung weights theo SEGMENTATION_BACKEND
+    - torch: SAM2ImagePredictor (safetensors mmap nếu đã convert, xem convert_checkpoints.py)
+    - onnx:  OnnxSam2Predictor trên 2 ONNX Runtime session dùng chung (xem export_segmentation_onnx.py)
+    """
+    if SEGMENTATION_BACKEND == "onnx":
+        encoder_path = MODEL_PATHS['segmentation_onnx_encoder']
+        decoder_path = MODEL_PATHS['segmentation_onnx_decoder']
+        if not os.path.exists(encoder_path) or not os.path.exists(decoder_path):
+            raise FileNotFoundError(
+                f"SAM2 ONNX graphs not found at {encoder_path} / {decoder_path}. Run: python export_segmentation_onnx.py"
+            )
+        sessions = Sam2OnnxSessions(encoder_path, decoder_path, intra_op_threads=ONNX_INTRA_OP_THREADS)
+        return [OnnxSam2Predictor(sessions) for _ in range(count)]
+
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    sam2_model = load_sam2_model(
+        MODEL_PATHS['segmentation'], device, safetensors_path=MODEL_PATHS['segmentation_safetensors']
+    )
+    return [SAM2ImagePredictor(sam2_model) for _ in range(count)]
+
 def load_segmentation_model():
-    """Load SAM2 segmentation model"""
+    """
+    Load SAM2 segmentation model (backend SEGMENTATION_BACKEND)
+    Trả về pool SEGMENTATION_POOL_SIZE predictor dùng chung weights (mỗi predictor giữ embedding riêng)
+    """
     model_path = MODEL_PATHS['segmentation']
-    if not os.path.exists(model_path):
+    safetensors_path = MODEL_PATHS['segmentation_safetensors']
+    if SEGMENTATION_BACKEND != "onnx" and not os.path.exists(model_path) and not os.path.exists(safetensors_path):
         print(f"⚠️  Segmentation model not found")
         return None
     
     try:
-        from sam2.build_sam import build_sam2
-        from sam2.sam2_image_predictor import SAM2ImagePredictor
-        
-        checkpoint = torch.load(model_path, map_location=device, weights_only=False)
-        config_file = "configs/sam2.1/sam2.1_hiera_t.yaml"
-        print(f"ℹ️ Loading SAM2 with config: {config_file}")
-
-        sam2_model = build_sam2(
-            config_file=config_file,
-            ckpt_path=None,
-            device=device,
-            mode='eval',
-            apply_postprocessing=False
+        pool = PredictorPool(
+            create_segmentation_predictors(max(1, SEGMENTATION_POOL_SIZE)),
+            run_fn=lambda fn, predictor, *args, **kwargs: run_inference('segmentation', fn, predictor, *args, **kwargs),
+            max_waiting=SEGMENTATION_MAX_WAITING,
+            checkout_timeout=SEGMENTATION_CHECKOUT_TIMEOUT_SECONDS,
+            name="segmentation"
         )
-        
-        if isinstance(checkpoint, dict) and 'model_state_dict' in checkpoint:
-            sam2_model.load_state_dict(checkpoint['model_state_dict'], strict=False)
-        
-        predictor = SAM2ImagePredictor(sam2_model)
-        print("✅ SAM2 segmentation model loaded")
-        return predictor
+        print(f"✅ SAM2 segmentation model loaded ({pool.size} predictors, backend: {SEGMENTATION_BACKEND})")
+        return pool
         
     except Exception as e:
         print(f"❌ Error loading segmentation model: {e}")
         return None
 
 def load_face_detection_model():
-    """Load Mediapipe Face Detection model"""
+    """
+    Load pool FACE_DETECTION_POOL_SIZE MediaPipe Face Detection graph
+    (1 graph không dùng đồng thời được từ nhiều thread -> mỗi request checkout 1 instance)
+    """
     try:
-        mp_face_detection = mp.solutions.face_detection
-        detector = mp_face_detection.FaceDetection(model_selection=0, min_detection_confidence=0.5)
-        print("✅ Face detection model loaded")
-        return detector
+        pool = PredictorPool(
+            [create_face_detector(FACE_DETECTION_MIN_CONFIDENCE) for _ in range(max(1, FACE_DETECTION_POOL_SIZE))],
+            run_fn=lambda fn, detector, *args, **kwargs: run_inference('face_detection', fn, detector, *args, **kwargs),
+            max_waiting=FACE_DETECTION_MAX_WAITING,
+            checkout_timeout=FACE_DETECTION_CHECKOUT_TIMEOUT_SECONDS,
+            name="face_detection"
+        )
+        print(f"✅ Face detection model loaded ({pool.size} detectors)")
+        return pool
     except Exception as e:
         print(f"❌ Error loading face detection model: {e}")
         return None
 
+def preload_shared_models():
+    """
+    Gọi ở gunicorn master (preload_app) trước khi fork, xem gunicorn_conf.py.
+    Chỉ preload model fork-safe: torch modules (CPU) + embedding model.
+    ONNX Runtime sessions và MediaPipe giữ thread pool riêng nên vẫn load trong từng worker.
+    """
+    if torch.cuda.is_available():
+        print("⚠️  CUDA device detected - CUDA context is not fork-safe, skipping preload")
+        return PRELOADED
+
+    loaders = {
+        'embeddings': load_embedding_model,
+    }
+    if SEGMENTATION_BACKEND == "torch":
+        loaders['segmentation'] = load_segmentation_model
+    if CLASSIFICATION_BACKEND == "torch":
+        loaders['classification'] = load_classification_model
+    return preload_models(loaders, PRELOAD_MODELS)
+
+# =============================================================================
+# INFERENCE HELPERS (blocking - chạy trên thread pool của InferenceExecutor)
+# =============================================================================
+def predict_classification_batch(samples: List[np.ndarray]) -> np.ndarray:
+    """Batched forward pass: list of [3, 224, 224] arrays -> softmax rows [N, num_classes]"""
+    # Các request trong batch đang giữ model qua state.models.use() nên model chắc chắn resident
+    return state.models.peek('classification').predict_proba(np.stack(samples))
+
+NO_FACE_DETAIL = "No face detected. Please upload a clear image of a face for facial analysis."
+
+async def run_face_detection(image_np: np.ndarray, original_size=None) -> Optional[List[Dict[str, Any]]]:
+    """
+    Faces của ảnh ([] nếu không có mặt), None nếu detector không load được.
+    Detect trên bản thu nhỏ FACE_DETECTION_MAX_SIDE, box theo pixel của original_size (mặc định image_np).
+    """
+    async with state.models.use('face_detection') as pool:
+        if pool is None:
+            return None
+        try:
+            return await pool.run(detect_faces, image_np, original_size, FACE_DETECTION_MAX_SIDE)
+        except PoolExhausted as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+async def coalesced_llm_call(label: str, key_parts: tuple, fn):
+    """
+    Single-flight: request đồng thời có cùng key (prompt cuối + model settings) chờ chung 1 lời gọi `fn()`.
+    Lỗi được trả cho mọi caller đang chờ và không được giữ lại; xem SingleFlight.
+    """
+    if not LLM_SINGLEFLIGHT_ENABLED:
+        return await fn()
+    return await state.llm_flights.do(content_hash(label, *key_parts), fn, label=label)
+
+async def rag_chain_answer(query: str) -> str:
+    settings = json.dumps(RAG_LLM_SETTINGS, sort_keys=True)
+    return await coalesced_llm_call("rag_chain", (settings, query), lambda: state.rag_chain.ainvoke(query))
+
+def _vlm_cache_lookup(image_input, note: Optional[str]):
+    """(ảnh đã normalize, cache key, entry | None) - decode + normalize + hash pixel + SQLite, chạy trong thread"""
+    image = decode_vision_input(image_input)
+    if image is None:
+        return None, None, None
+    # Hash pixel SAU khi xoay theo EXIF orientation: cùng pixel thô nhưng khác Orientation -> ảnh gửi Gemini khác -> key khác
+    image = normalize_vision_image(image)
+    key = content_hash(image_pixel_hash(image), normalize_note(note))
+    return image, key, state.vlm_cache.get(key)
+
+async def analyze_skin_image_cached(image_input, note: Optional[str] = None) -> Optional[str]:
+    """
+    analyze_skin_image_async + VLM cache: cùng ảnh (theo pixel) + cùng note + cùng prompt version
+    -> trả kết quả cũ, không gọi Gemini. Chỉ cache kết quả thành công; cache lỗi -> gọi Gemini như thường.
+    """
+    if state.vlm_cache is None:
+        return await analyze_skin_image_async(image_input, note)
+
+    stats = state.vlm_stats
+    start = time.perf_counter()
+    key = None
+    try:
+        image, key, cached = await asyncio.to_thread(_vlm_cache_lookup, image_input, note)
+        if cached is not None:
+            stats["saved_calls"] += 1
+            stats["saved_seconds"] += cached["latency_ms"] / 1000.0
+            stats["hit_ms_total"] += (time.perf_counter() - start) * 1000.0
+            return cached["analysis"]
+        if image is not None:
+            image_input = image  # đã decode + normalize -> không decode lại
+    except Exception as e:
+        print(f"⚠️ VLM cache lookup failed: {e}")
+
+    if key is None:
+        return await _analyze_and_cache(image_input, note, None)
+    # Cache miss của cùng ảnh + note đang được phân tích -> chờ chung lời gọi Gemini đó
+    return await coalesced_llm_call(
+        "vlm", (state.vlm_cache.version, key), lambda: _analyze_and_cache(image_input, note, key)
+    )
+
+async def _analyze_and_cache(image_input, note: Optional[str], key: Optional[str]) -> Optional[str]:
+    stats = state.vlm_stats
+    start = time.perf_counter()
+    analysis = await analyze_skin_image_async(image_input, note)
+    latency_ms = (time.perf_counter() - start) * 1000.0
+    stats["gemini_calls"] += 1
+    stats["gemini_ms_total"] += latency_ms
+
+    if analysis and key is not None:
+        entry = {"analysis": analysis, "latency_ms": round(latency_ms, 1), "created_at": datetime.now().isoformat()}
+        try:
+            await asyncio.to_thread(state.vlm_cache.set, key, entry)
+        except Exception as e:
+            print(f"⚠️ VLM cache write failed: {e}")
+    return analysis
+
+def vlm_metrics() -> Optional[Dict[str, Any]]:
+    if state.vlm_cache is None:
+        return None
+    stats = state.vlm_stats
+    return {
+        **state.vlm_cache.metrics(),
+        "version": state.vlm_cache.version,
+        "saved_calls": stats["saved_calls"],
+        "saved_seconds": round(stats["saved_seconds"], 1),
+        "avg_hit_ms": round(stats["hit_ms_total"] / stats["saved_calls"], 1) if stats["saved_calls"] else None,
+        "gemini_calls": stats["gemini_calls"],
+        "avg_gemini_ms": round(stats["gemini_ms_total"] / stats["gemini_calls"], 1) if stats["gemini_calls"] else None,
+    }
+
+def chat_stream_metrics() -> Dict[str, Any]:
+    stats = state.chat_stream_stats
+    return {
+        "requests": stats["requests"],
+        "completed": stats["completed"],
+        "cancelled": stats["cancelled"],
+        "errors": stats["errors"],
+        "avg_first_event_ms": round(stats["first_event_ms_total"] / stats["first_events"], 1) if stats["first_events"] else None,
+        "avg_first_token_ms": round(stats["first_token_ms_total"] / stats["first_tokens"], 1) if stats["first_tokens"] else None,
+    }
+
+async def run_inference(model: str, fn, *args, **kwargs):
+    """Run a blocking model call on the dedicated executor, off the event loop"""
+    return await state.inference_executor.run(model, fn, *args, **kwargs)
+
+async def read_image_input(file: Optional[UploadFile], image_handle: Optional[str] = None) -> bytes:
+    """Bytes của ảnh: từ upload, hoặc từ image_handle (POST /api/images) -> không upload lại"""
+    if image_handle:
+        try:
+            return state.image_store.get_bytes(image_handle)
+        except ImageNotFound as e:
+            raise HTTPException(status_code=404, detail=str(e))
+    if file is None:
+        raise HTTPException(status_code=400, detail="Provide an image file or an image_handle")
+    if not file.content_type or not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Invalid file type")
+    return await file.read()
+
+def decode_base64_image(value: str) -> bytes:
+    """Base64 (có thể kèm prefix data URI "data:image/...;base64,") -> bytes"""
+    if value.startswith('data:image'):
+        value = value.split(',', 1)[1]
+    try:
+        return base64.b64decode(value)
+    except Exception:
+        raise HTTPException(status_code=400, detail="image_base64 is not valid base64")
+
+async def decode_image_input(contents: bytes, image_handle: Optional[str], max_side: int):
+    """
+    (RGB image cạnh dài <= max_side, original_size). Có image_handle -> bản decode sẵn trong image store,
+    ngược lại decode upload (JPEG draft) trên preprocess pool.
+    """
+    try:
+        if image_handle:
+            return await run_inference('preprocess', state.image_store.variant, image_handle, max_side)
+        working, _, original_size = await run_inference(
+            'preprocess', decode_for_segmentation, contents, max_side, False
+        )
+        return working, original_size
+    except ImageNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def prepare_classification_input(contents: bytes, image: Optional[Image.Image] = None,
+                                 crop_box: Optional[List[float]] = None, original_size=None) -> np.ndarray:
+    """
+    Decode (+ crop face ROI) + preprocess upload bytes -> [3, 224, 224] array
+    image: ảnh đã decode sẵn (có thể là bản thu nhỏ); crop_box: [x, y, w, h] theo pixel ảnh gốc original_size
+    """
+    # Fast path: JPEG decode thẳng ở độ phân giải gần 224x224 (draft), không decode full 12MP
+    if image is None:
+        image = decode_image(contents, draft_size=INPUT_SIZE if CLASSIFICATION_FAST_PREPROCESS else None)
+    if crop_box is not None:
+        image = crop_to_box(image, crop_box, original_size or image.size)
+    return preprocess_classification(image, fast=CLASSIFICATION_FAST_PREPROCESS)
+
+async def run_classification(contents: bytes, image: Optional[Image.Image] = None,
+                             crop_box: Optional[List[float]] = None, original_size=None) -> np.ndarray:
+    """
+    Cached + batched classification của một ảnh -> softmax row.
+    image: ảnh đã decode sẵn (facial / combined analysis) -> không decode lại từ bytes.
+    crop_box: chỉ classify vùng này (face ROI, xem facial_roi)
+    """
+    async with state.models.use('classification') as model:
+        if model is None:
+            raise HTTPException(status_code=503, detail="Model not loaded")
+
+        # Cache probabilities theo hash của ảnh (+ backend/preprocessing/crop vì output phụ thuộc vào chúng)
+        image_key = content_hash(contents, model.backend, CLASSIFICATION_FAST_PREPROCESS, image is not None, crop_box)
+        all_probs = state.classification_cache.get(image_key)
+
+        if all_probs is None:
+            input_array = await run_inference(
+                'preprocess', prepare_classification_input, contents, image, crop_box, original_size
+            )
+            # Batched forward pass (gom với các request đồng thời khác)
+            all_probs = await state.classification_batcher.submit(input_array)
+            state.classification_cache.set(image_key, all_probs)
+
+        return all_probs
+
+async def facial_roi(image: Image.Image, original_size, face_crop: bool = True) -> Optional[List[float]]:
+    """
+    notes == 'facial': image đã decode 1 lần ở FACE_ROI_DECODE_MAX_SIDE, dùng cho cả face detection lẫn crop.
+    Không có khuôn mặt -> HTTPException 400. Returns crop_box | None
+    """
+    faces = await run_face_detection(np.asarray(image), original_size)
+    if faces is None:
+        print("⚠️ Face detector skipped (not loaded)")
+    elif not faces:
+        raise HTTPException(status_code=400, detail=NO_FACE_DETAIL)
+    return face_roi_box(faces, original_size, FACE_CROP_MARGIN) if face_crop else None
+
+async def quality_gate(contents: bytes, image_handle: Optional[str] = None, image: Optional[Image.Image] = None,
+                       original_size=None) -> Optional[Dict[str, Any]]:
+    """
+    Image quality gate trước khi chạy model: sharpness / exposure / resolution / skin coverage trên bản thu nhỏ
+    (IMAGE_QUALITY_MAX_SIDE, vài ms). image: ảnh đã decode sẵn -> không decode lại.
+    IMAGE_QUALITY_MODE: "warn" -> trả report ("image_quality" trong response), "reject" -> 422 khi không đạt, "off" -> None
+    """
+    if IMAGE_QUALITY_MODE == 'off':
+        return None
+    if image is None:
+        image, original_size = await decode_image_input(contents, image_handle, IMAGE_QUALITY_MAX_SIDE)
+    report = await run_inference(
+        'preprocess', assess_image_quality, np.asarray(image), original_size,
+        IMAGE_QUALITY_MAX_SIDE, IMAGE_QUALITY_THRESHOLDS
+    )
+
+    stats = state.image_quality_stats
+    stats["checked"] += 1
+    if not report["passed"]:
+        stats["failed"] += 1
+        for issue in report["issues"]:
+            stats["issues"][issue["code"]] = stats["issues"].get(issue["code"], 0) + 1
+        if IMAGE_QUALITY_MODE == 'reject':
+            stats["rejected"] += 1
+            raise HTTPException(status_code=422, detail={
+                "message": "Image quality too low: " + "; ".join(issue["message"] for issue in report["issues"]),
+                "image_quality": report
+            })
+    return report
+
+def format_classification(all_probs: np.ndarray) -> Dict[str, Any]:
+    """Softmax row -> predicted_class / confidence / all_predictions"""
+    pred_index = int(np.argmax(all_probs))
+    confidence = float(all_probs[pred_index])
+    
+    # Safe Prediction Logic
+    if pred_index >= len(SKIN_CLASSES):
+        return {
+            "predicted_class": "Unknown",
+            "confidence": confidence,
+            "note": "Model prediction index out of bounds for current class list"
+        }
+
+    return {
+        "predicted_class": SKIN_CLASSES[pred_index],
+        "confidence": confidence,
+        "all_predictions": {SKIN_CLASSES[i]: float(all_probs[i]) for i in range(min(len(SKIN_CLASSES), len(all_probs)))}
+    }
+
 # =============================================================================
 # LIFESPAN (STARTUP/SHUTDOWN)
 # =============================================================================
@@ -336,9 +729,57 @@ async def lifespan(app: FastAPI):
     print("🚀 STARTING AI DERMATOLOGY & COSMETIC API SERVER")
     print("=" * 80)
     
-    state.classification_model = load_classification_model()
-    state.segmentation_model = load_segmentation_model()
-    state.face_detector = load_face_detection_model()
+    state.inference_executor = InferenceExecutor(INFERENCE_THREADS)
+    print(f"ℹ️  Inference threads per model: {INFERENCE_THREADS}")
+
+    state.image_store = ImageStore(
+        IMAGE_STORE_DIR or default_store_dir(),
+        ttl_seconds=IMAGE_STORE_TTL_SECONDS,
+        max_files=IMAGE_STORE_MAX_FILES,
+        max_image_bytes=IMAGE_STORE_MAX_IMAGE_BYTES,
+        cache_max_entries=IMAGE_STORE_CACHE_MAX_ENTRIES,
+        cache_max_bytes=int(IMAGE_STORE_CACHE_MAX_MB * 1024 * 1024)
+    )
+    print(f"ℹ️  Image store: {state.image_store.directory} (handles expire after {IMAGE_STORE_TTL_SECONDS:.0f}s)")
+
+    if VLM_CACHE_ENABLED:
+        try:
+            state.vlm_cache = DiskCache(
+                VLM_CACHE_PATH,
+                ttl_seconds=VLM_CACHE_TTL_SECONDS,
+                max_bytes=int(VLM_CACHE_MAX_MB * 1024 * 1024),
+                version=vision_prompt_version(),
+                name="vlm_analysis"
+            )
+            invalidated = f", invalidated {state.vlm_cache.invalidated} stale entries" if state.vlm_cache.invalidated else ""
+            print(f"ℹ️  VLM cache: {VLM_CACHE_PATH} (prompt {state.vlm_cache.version}{invalidated})")
+        except Exception as e:
+            print(f"⚠️  VLM cache disabled: {e}")
+
+    # Models load on first use; MODEL_PINNED giữ warm từ lúc khởi động
+    state.models.register('classification', preloaded_loader('classification', load_classification_model))
+    state.models.register('segmentation', preloaded_loader('segmentation', load_segmentation_model))
+    state.models.register(
+        'face_detection', load_face_detection_model,
+        on_unload=lambda pool: [detector.close() for detector in pool.predictors]
+    )
+    state.models.pin(['classification', 'segmentation', 'face_detection'] if 'all' in MODEL_PINNED else MODEL_PINNED)
+    # Weights preload ở master được chia sẻ giữa các worker -> không bao giờ unload
+    state.models.pin(PRELOADED)
+    if PRELOADED:
+        print(f"ℹ️  Sharing preloaded weights (pid {os.getpid()}): {sorted(PRELOADED)}")
+    await state.models.warm_pinned()
+    state.models.start()
+    print(f"ℹ️  Pinned models: {MODEL_PINNED or 'none'} | idle unload after: {MODEL_IDLE_TIMEOUT_SECONDS}s")
+
+    state.classification_batcher = MicroBatcher(
+        predict_classification_batch,
+        max_batch_size=CLASSIFICATION_MAX_BATCH_SIZE,
+        window_ms=CLASSIFICATION_BATCH_WINDOW_MS,
+        name="classification",
+        run_fn=lambda fn, items: run_inference('classification', fn, items)
+    )
+    state.classification_batcher.start()
 
     try:
         setup_api_key()
@@ -348,7 +789,9 @@ async def lifespan(app: FastAPI):
             print("\n⚠️  Vector Store not initialized")
         else:
             state.vectorstore = db
-            state.rag_chain = setup_rag_chain(db)
+            rag_components = build_rag_components(db)
+            state.rag_chain = setup_rag_chain(db, rag_components)
+            state.rag_streamer = RagStreamer(*rag_components)
             print("\n✅ RAG Chatbot ready")
         
         print("\n✅ Server ready!")
@@ -361,6 +804,12 @@ async def lifespan(app: FastAPI):
     yield
     
     print("Shutting down models...")
+    if state.classification_batcher is not None:
+        await state.classification_batcher.stop()
+    await state.models.stop()
+    state.inference_executor.shutdown()
+    if state.vlm_cache is not None:
+        state.vlm_cache.close()
 
 # =============================================================================
 # FASTAPI APP DEFINITION
@@ -391,10 +840,12 @@ class ChatResponse(BaseModel):
     answer: str
     response_time: float
     timestamp: str
+    image_quality: Optional[Dict[str, Any]] = None
 
 class ImageAnalysisRequest(BaseModel):
-    image_base64: str
+    image_base64: Optional[str] = None
     additional_text: Optional[str] = None
+    image_handle: Optional[str] = None  # thay cho image_base64 (POST /api/images)
 
 class ImageAnalysisResponse(BaseModel):
     skin_analysis: str
@@ -402,6 +853,7 @@ class ImageAnalysisResponse(BaseModel):
     severity_warning: Optional[str] = None
     response_time: float
     timestamp: str
+    image_quality: Optional[Dict[str, Any]] = None
 
 class HealthResponse(BaseModel):
     status: str
@@ -409,76 +861,96 @@ class HealthResponse(BaseModel):
     vectorstore_status: str
     classification_model_status: str
     segmentation_model_status: str
+    classification_backend: Optional[str] = None
+    segmentation_backend: Optional[str] = None
+    models: Optional[Dict[str, Any]] = None
     timestamp: str
 
 class VLMAnalysisResponse(BaseModel):
     skin_analysis: str
     response_time: float
     timestamp: str
+    image_quality: Optional[Dict[str, Any]] = None
 
 # =============================================================================
 # HEALTH CHECK
 # =============================================================================
+def _model_status(model_status: Dict[str, Any]) -> str:
+    if model_status["resident"]:
+        return "loaded"
+    # Chưa load (lazy) hoặc đã unload vì idle -> sẽ load lại ở request tiếp theo
+    return "not_loaded" if model_status["last_error"] else "on_demand"
+
 @app.get("/", response_model=HealthResponse)
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
+    models_status = state.models.status()
     return HealthResponse(
         status="healthy" if state.rag_chain else "degraded",
         message="AI Dermatology & Cosmetic API",
         vectorstore_status="ready" if state.rag_chain else "not_initialized",
-        classification_model_status="loaded" if state.classification_model else "not_loaded",
-        segmentation_model_status="loaded" if state.segmentation_model else "not_loaded",
+        classification_model_status=_model_status(models_status['classification']),
+        segmentation_model_status=_model_status(models_status['segmentation']),
+        classification_backend=getattr(state.models.peek('classification'), "backend", None),
+        segmentation_backend=SEGMENTATION_BACKEND,
+        models=models_status,
         timestamp=datetime.now().isoformat()
     )
 
+@app.get("/metrics")
+async def metrics() -> Dict[str, Any]:
+    """Runtime inference metrics (batch sizes, queue wait, per-model busy time)"""
+    segmentation_pool = state.models.peek('segmentation')
+    face_detection_pool = state.models.peek('face_detection')
+    return {
+        "classification_batching": state.classification_batcher.metrics() if state.classification_batcher else None,
+        "inference_executor": state.inference_executor.metrics() if state.inference_executor else None,
+        "segmentation_pool": segmentation_pool.metrics() if segmentation_pool is not None else None,
+        "face_detection_pool": face_detection_pool.metrics() if face_detection_pool is not None else None,
+        "result_cache": {
+            "classification": state.classification_cache.metrics(),
+            "product_suggestions": state.suggestion_cache.metrics(),
+            "segmentation_embeddings": state.embedding_cache.metrics()
+        },
+        "image_store": state.image_store.metrics() if state.image_store else None,
+        "image_quality": {"mode": IMAGE_QUALITY_MODE, **state.image_quality_stats},
+        "vlm_cache": vlm_metrics(),
+        "vision_input": vision_stats(),
+        "chat_stream": chat_stream_metrics(),
+        "llm_coalescing": {"enabled": LLM_SINGLEFLIGHT_ENABLED, **state.llm_flights.metrics()},
+        "timestamp": datetime.now().isoformat()
+    }
+
 # =============================================================================
 # RAG CHATBOT ENDPOINTS
 # =============================================================================
-@app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(
-    question: str = Form(...),
-    conversation_history: Optional[str] = Form(None),
-    image: Optional[UploadFile] = File(None)
-):
-    if state.rag_chain is None:
-        raise HTTPException(status_code=503, detail="RAG chain not initialized")
-    
+def parse_conversation_history(conversation_history: Optional[str]) -> List[Dict[str, Any]]:
+    if not conversation_history:
+        return []
     try:
-        start_time = time.time()
-        
-        # 1. Parse conversation history
-        history_list = []
-        if conversation_history:
-            try:
-                history_list = json.loads(conversation_history)
-            except json.JSONDecodeError:
-                print("⚠️ Failed to parse conversation_history JSON")
-                history_list = []
+        return json.loads(conversation_history)
+    except json.JSONDecodeError:
+        print("⚠️ Failed to parse conversation_history JSON")
+        return []
 
-        # 2. VLM Analysis (If image is provided)
-        vlm_context_str = ""
-        if image:
-            if not image.content_type.startswith("image/"):
-                raise HTTPException(status_code=400, detail="Uploaded file is not an image")
-            
-            image_bytes = await image.read()
-            skin_analysis = analyze_skin_image(image_bytes, note=question)
-            
-            if skin_analysis:
-                vlm_context_str = f"""
+def build_chat_query(question: str, history_list: List[Dict[str, Any]], skin_analysis: Optional[str] = None) -> str:
+    """Prompt cuối cho RAG: lịch sử hội thoại + phân tích ảnh (VLM) + vấn đề da phát hiện được + câu hỏi"""
+    vlm_context_str = ""
+    if skin_analysis:
+        vlm_context_str = f"""
 \n[THÔNG TIN TỪ ẢNH NGƯỜI DÙNG GỬI KÈM]:
 Hệ thống đã phân tích ảnh da của người dùng với kết quả sau:
 {skin_analysis}
 -----------------------------------
 """
-        
-        # 3. Intelligent Product Recommendation Logic
-        detected_condition, suitable_skin_types = detect_skin_condition_and_types(question)
-        
-        condition_context_str = ""
-        if detected_condition:
-            skin_types_str = ", ".join(suitable_skin_types) if suitable_skin_types else "mọi loại da"
-            condition_context_str = f"""
+    
+    # Intelligent Product Recommendation Logic
+    detected_condition, suitable_skin_types = detect_skin_condition_and_types(question)
+    
+    condition_context_str = ""
+    if detected_condition:
+        skin_types_str = ", ".join(suitable_skin_types) if suitable_skin_types else "mọi loại da"
+        condition_context_str = f"""
 [HỆ THỐNG PHÁT HIỆN VẤN ĐỀ DA]:
 - Vấn đề phát hiện: {detected_condition}
 - Loại da phù hợp để tư vấn sản phẩm: {skin_types_str}
@@ -486,77 +958,229 @@ Hệ thống đã phân tích ảnh da của người dùng với kết quả sa
 -----------------------------------
 """
 
-        # 4. Build Context from History
-        context_str = ""
-        if history_list:
-            context_pairs = []
-            for i in range(0, len(history_list) - 1, 2):
-                if i + 1 < len(history_list):
-                    user_msg = history_list[i]
-                    ai_msg = history_list[i + 1]
-                    if user_msg.get('role') == 'user' and ai_msg.get('role') == 'ai':
-                        context_pairs.append((
-                            user_msg.get('content', ''),
-                            ai_msg.get('content', '')
-                        ))
-            
-            if context_pairs:
-                recent = context_pairs[-3:]
-                context_str = "LỊCH SỬ HỘI THOẠI TRƯỚC ĐÓ:\n" + "\n".join([
-                    f"User: {ctx[0]}\nAI: {ctx[1][:200]}..." 
-                    for ctx in recent
-                ]) + "\n"
-
-        # 5. Construct Final Prompt for RAG
-        full_query = f"""{context_str}
+    # Build Context from History
+    context_str = ""
+    if history_list:
+        context_pairs = []
+        for i in range(0, len(history_list) - 1, 2):
+            if i + 1 < len(history_list):
+                user_msg = history_list[i]
+                ai_msg = history_list[i + 1]
+                if user_msg.get('role') == 'user' and ai_msg.get('role') == 'ai':
+                    context_pairs.append((
+                        user_msg.get('content', ''),
+                        ai_msg.get('content', '')
+                    ))
+        
+        if context_pairs:
+            recent = context_pairs[-3:]
+            context_str = "LỊCH SỬ HỘI THOẠI TRƯỚC ĐÓ:\n" + "\n".join([
+                f"User: {ctx[0]}\nAI: {ctx[1][:200]}..." 
+                for ctx in recent
+            ]) + "\n"
+
+    # Construct Final Prompt for RAG
+    return f"""{context_str}
 {vlm_context_str}
 {condition_context_str}
 CÂU HỎI HIỆN TẠI CỦA NGƯỜI DÙNG: {question}
 Yêu cầu: Hãy trả lời câu hỏi của người dùng dựa trên thông tin sản phẩm có trong database. 
 Nếu có thông tin từ ảnh hoặc vấn đề da được phát hiện, hãy sử dụng nó để lọc và tư vấn sản phẩm chính xác hơn."""
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat_endpoint(
+    question: str = Form(...),
+    conversation_history: Optional[str] = Form(None),
+    image: Optional[UploadFile] = File(None),
+    image_handle: Optional[str] = Form(None)
+):
+    if state.rag_chain is None:
+        raise HTTPException(status_code=503, detail="RAG chain not initialized")
+    
+    try:
+        start_time = time.time()
+        
+        # 1. Parse conversation history
+        history_list = parse_conversation_history(conversation_history)
+
+        # 2. VLM Analysis (If image is provided)
+        skin_analysis = None
+        image_quality = None
+        if image or image_handle:
+            image_bytes = await read_image_input(image, image_handle)
+            image_quality = await quality_gate(image_bytes, image_handle)
+            skin_analysis = await analyze_skin_image_cached(image_bytes, note=question)
+        
+        # 3-5. Condition detection + history + image analysis -> Final Prompt for RAG
+        full_query = build_chat_query(question, history_list, skin_analysis)
         
-        # 6. Invoke RAG Chain
-        response = state.rag_chain.invoke(full_query)
+        # 6. Invoke RAG Chain (async: retriever trong thread, Gemini qua async client, single-flight)
+        response = await rag_chain_answer(full_query)
         
         return ChatResponse(
             answer=response,
             response_time=round(time.time() - start_time, 2),
-            timestamp=datetime.now().isoformat()
+            timestamp=datetime.now().isoformat(),
+            image_quality=image_quality
         )
         
+    except HTTPException as he:
+        raise he
     except Exception as e:
         print(f"Chat Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _chat_event_stream(
+    request: Request,
+    question: str,
+    history_list: List[Dict[str, Any]],
+    image_bytes: Optional[bytes],
+    image_quality: Optional[Dict[str, Any]],
+    start_time: float
+):
+    """
+    SSE stream cho /chat/stream: image_analysis (nếu có ảnh) -> retrieval -> products -> token... -> done.
+    Client ngắt kết nối -> huỷ producer, tức là huỷ luôn request Gemini đang stream.
+    """
+    stats = state.chat_stream_stats
+    stats["requests"] += 1
+    events: asyncio.Queue = asyncio.Queue()
+    done_marker = object()
+    answer_parts = []
+    outcome = {"error": False, "disconnected": False, "finished": False}
+
+    async def produce():
+        try:
+            skin_analysis = None
+            if image_bytes is not None:
+                skin_analysis = await analyze_skin_image_cached(image_bytes, note=question)
+                await events.put(("image_analysis", {"analysis": skin_analysis, "image_quality": image_quality}))
+
+            full_query = build_chat_query(question, history_list, skin_analysis)
+            async with aclosing(state.rag_streamer.astream(full_query)) as stream:
+                async for event, data in stream:
+                    await events.put((event, data))
+        except Exception as e:
+            print(f"Chat Stream Error: {str(e)}")
+            outcome["error"] = True
+            await events.put(("error", {"detail": f"Error: {str(e)}"}))
+        finally:
+            await events.put(done_marker)
+
+    async def watch_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(CHAT_STREAM_DISCONNECT_POLL_SECONDS)
+        outcome["disconnected"] = True
+        await events.put(done_marker)
+
+    producer = asyncio.create_task(produce())
+    watcher = asyncio.create_task(watch_disconnect())
+    first_event = first_token = True
+    try:
+        while True:
+            item = await events.get()
+            if item is done_marker:
+                break
+            event, data = item
+            elapsed_ms = (time.time() - start_time) * 1000.0
+            if first_event:
+                first_event = False
+                stats["first_event_ms_total"] += elapsed_ms
+                stats["first_events"] += 1
+            if event == "token":
+                answer_parts.append(data["text"])
+                if first_token:
+                    first_token = False
+                    stats["first_token_ms_total"] += elapsed_ms
+                    stats["first_tokens"] += 1
+            yield sse_event(event, data)
+
+        if outcome["disconnected"]:
+            return
+        outcome["finished"] = True
+        if outcome["error"]:
+            stats["errors"] += 1
+            return
+        yield sse_event("done", {
+            "answer": "".join(answer_parts),
+            "response_time": round(time.time() - start_time, 2),
+            "timestamp": datetime.now().isoformat()
+        })
+        stats["completed"] += 1
+    finally:
+        # Client ngắt kết nối / server shutdown -> huỷ retrieval + Gemini stream còn đang chạy
+        producer.cancel()
+        watcher.cancel()
+        if not outcome["finished"]:
+            stats["cancelled"] += 1
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(
+    request: Request,
+    question: str = Form(...),
+    conversation_history: Optional[str] = Form(None),
+    image: Optional[UploadFile] = File(None),
+    image_handle: Optional[str] = Form(None)
+):
+    """
+    Giống /chat nhưng trả text/event-stream: event "retrieval" + "products" ngay khi tìm xong sản phẩm,
+    sau đó "token" theo từng đoạn Gemini sinh ra, cuối cùng "done" (answer đầy đủ) hoặc "error".
+    """
+    if state.rag_streamer is None:
+        raise HTTPException(status_code=503, detail="RAG chain not initialized")
+
+    start_time = time.time()
+    # Lỗi input / ảnh bị reject trả về HTTP status bình thường, trước khi stream bắt đầu
+    history_list = parse_conversation_history(conversation_history)
+    image_bytes = None
+    image_quality = None
+    if image or image_handle:
+        image_bytes = await read_image_input(image, image_handle)
+        image_quality = await quality_gate(image_bytes, image_handle)
+
+    return StreamingResponse(
+        _chat_event_stream(request, question, history_list, image_bytes, image_quality, start_time),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/analyze-image", response_model=ImageAnalysisResponse)
 async def analyze_image_endpoint(
-    image: UploadFile = File(...),
-    additional_text: Optional[str] = Form(None)
+    image: Optional[UploadFile] = File(None),
+    additional_text: Optional[str] = Form(None),
+    image_handle: Optional[str] = Form(None)
 ):
     if state.rag_chain is None:
         raise HTTPException(status_code=503, detail="RAG chain not initialized")
     
     try:
         start_time = time.time()
-        image_bytes = await image.read()
+        image_bytes = await read_image_input(image, image_handle)
+        image_quality = await quality_gate(image_bytes, image_handle)
         
-        skin_analysis = analyze_skin_image(image_bytes)
+        skin_analysis = await analyze_skin_image_cached(image_bytes)
         if not skin_analysis:
             raise HTTPException(status_code=400, detail="Cannot analyze image")
         
         is_severe = check_severity(skin_analysis)
         rag_query = build_image_analysis_query(skin_analysis, additional_text)
         
-        product_recommendation = state.rag_chain.invoke(rag_query)
+        product_recommendation = await rag_chain_answer(rag_query)
         
         return ImageAnalysisResponse(
             skin_analysis=skin_analysis,
             product_recommendation=product_recommendation,
             severity_warning="⚠️ SEVERE: Please consult a dermatologist immediately!" if is_severe else None,
             response_time=round(time.time() - start_time, 2),
-            timestamp=datetime.now().isoformat()
+            timestamp=datetime.now().isoformat(),
+            image_quality=image_quality
         )
         
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
@@ -567,104 +1191,134 @@ async def analyze_image_base64_endpoint(request: ImageAnalysisRequest):
     
     try:
         start_time = time.time()
-        skin_analysis = analyze_skin_image(request.image_base64)
+        if request.image_handle:
+            image_input = await read_image_input(None, request.image_handle)
+        elif request.image_base64:
+            image_input = decode_base64_image(request.image_base64)
+        else:
+            raise HTTPException(status_code=400, detail="Provide image_base64 or an image_handle")
+        image_quality = await quality_gate(image_input, request.image_handle)
+        skin_analysis = await analyze_skin_image_cached(image_input)
         if not skin_analysis:
             raise HTTPException(status_code=400, detail="Cannot analyze image")
         
         is_severe = check_severity(skin_analysis)
         rag_query = build_image_analysis_query(skin_analysis, request.additional_text)
-        product_recommendation = state.rag_chain.invoke(rag_query)
+        product_recommendation = await rag_chain_answer(rag_query)
         
         return ImageAnalysisResponse(
             skin_analysis=skin_analysis,
             product_recommendation=product_recommendation,
             severity_warning="⚠️ SEVERE: Please consult a dermatologist!" if is_severe else None,
             response_time=round(time.time() - start_time, 2),
-            timestamp=datetime.now().isoformat()
+            timestamp=datetime.now().isoformat(),
+            image_quality=image_quality
         )
         
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+# =============================================================================
+# IMAGE STORE ENDPOINTS
+# =============================================================================
+@app.post("/api/images")
+async def upload_image(file: UploadFile = File(...)) -> Dict[str, Any]:
+    """
+    Upload ảnh 1 lần -> image_handle ngắn hạn. Gửi image_handle (form field / JSON) thay cho file
+    ở mọi endpoint ảnh: không upload lại, ảnh đã decode + bản thu nhỏ được dùng lại.
+    """
+    contents = await read_image_input(file)
+    try:
+        handle = state.image_store.put(contents)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    try:
+        # Decode + validate ngay, bản working resolution dùng chung cho classification / segmentation / face
+        _, original_size = await decode_image_input(contents, handle, SEGMENTATION_MAX_SIDE)
+    except Exception as e:
+        state.image_store.delete(handle)
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+
+    expires_at = state.image_store.expires_at(handle)
+    return {
+        "image_handle": handle,
+        "original_size": original_size,
+        "bytes": len(contents),
+        "expires_in": round(expires_at - time.time(), 1) if expires_at else None,
+        "expires_at": datetime.fromtimestamp(expires_at).isoformat() if expires_at else None
+    }
+
+@app.delete("/api/images/{image_handle}")
+async def delete_image(image_handle: str) -> Dict[str, Any]:
+    try:
+        deleted = state.image_store.delete(image_handle)
+    except ImageNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"image_handle": image_handle, "deleted": deleted}
+
 # =============================================================================
 # CLASSIFICATION & SEGMENTATION ENDPOINTS
 # =============================================================================
 @app.post("/api/classification-disease")
 async def classify_skin_disease(
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None),
+    image_handle: Optional[str] = Form(None),
     notes: Optional[str] = Form(None),
     age: Optional[int] = Form(None),       
     gender: Optional[str] = Form(None),    
-    allergies: Optional[str] = Form(None) 
+    allergies: Optional[str] = Form(None),
+    face_crop: bool = Form(FACE_CROP_ENABLED),
+    compare_crop: bool = Form(False)
 ) -> Dict:
     """
     Classify skin disease, then filter products via Gemini based on Age, Gender, Allergies.
     Returns Dictionary containing classification results and a list of product objects with reasons.
+    notes == 'facial': chỉ classify vùng mặt (face_crop_box [x, y, w, h] theo pixel ảnh gốc);
+    compare_crop=true -> thêm "uncropped_prediction" (classify cả khung hình) để so sánh.
+    image_handle (POST /api/images) thay cho file -> dùng ảnh đã decode sẵn trong image store.
+    image_quality: quality gate chạy trước model (IMAGE_QUALITY_MODE=reject -> 422 khi không đạt).
     """
-    if state.classification_model is None:
+    if await state.models.get('classification') is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
-    
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Invalid file type")
 
     try:
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
-
-        # Conditional Face Detection
+        contents = await read_image_input(file, image_handle)
+        image = original_size = crop_box = None
         if notes == 'facial':
-            if state.face_detector:
-                image_np = np.array(image)
-                results = state.face_detector.process(image_np)
-                
-                if not results.detections:
-                      raise HTTPException(
-                          status_code=400, 
-                          detail="No face detected. Please upload a clear image of a face for facial analysis."
-                      )
-            else:
-                print("⚠️ Face detector skipped (not loaded)")
-
-        input_tensor = IMAGE_TRANSFORMS['classification'](image).unsqueeze(0).to(device)
-        
-        with torch.no_grad():
-            outputs = state.classification_model(input_tensor)
-            probabilities = torch.nn.functional.softmax(outputs, dim=1)
-            confidence, predicted = torch.max(probabilities, 1)
-            all_probs = probabilities[0].cpu().numpy()
-        
-        # Safe Prediction Logic
-        pred_index = predicted.item()
-        if pred_index >= len(SKIN_CLASSES):
-            return {
-                "predicted_class": "Unknown",
-                "confidence": float(confidence.item()),
-                "note": "Model prediction index out of bounds for current class list",
-                "product_suggestions": []
-            }
+            image, original_size = await decode_image_input(contents, image_handle, FACE_ROI_DECODE_MAX_SIDE)
+        elif image_handle:
+            image, original_size = await decode_image_input(contents, image_handle, SEGMENTATION_MAX_SIDE)
+        # Ảnh mờ / tối / quá nhỏ -> reject hoặc cảnh báo trước khi chạy model
+        image_quality = await quality_gate(contents, image_handle, image, original_size)
+        if notes == 'facial':
+            crop_box = await facial_roi(image, original_size, face_crop)
 
-        predicted_class = SKIN_CLASSES[pred_index]
-        
-        # Get product suggestions (Smart Filtering)
-        product_suggestions = []
-        if state.vectorstore:
-            # Map disease to skin types
-            suitable_skin_types = map_disease_to_skin_types(predicted_class)
-            
-            # ✅ CALL SMART FILTERING with Gemini (Async)
-            product_suggestions = await smart_product_filtering(
-                state.vectorstore,
-                predicted_class,
-                suitable_skin_types,
-                age,
-                gender,
-                allergies
+        if crop_box is not None and compare_crop:
+            all_probs, uncropped_probs = await asyncio.gather(
+                run_classification(contents, image, crop_box, original_size),
+                run_classification(contents, image)
             )
+        else:
+            all_probs = await run_classification(contents, image, crop_box, original_size)
+        result = {**format_classification(all_probs), "face_crop_box": crop_box, "image_quality": image_quality}
+        if crop_box is not None and compare_crop:
+            uncropped = format_classification(uncropped_probs)
+            result["uncropped_prediction"] = uncropped
+            result["crop_changed_prediction"] = uncropped["predicted_class"] != result["predicted_class"]
+
+        if result["predicted_class"] == "Unknown":
+            return {**result, "product_suggestions": []}
+
+        # Get product suggestions (Smart Filtering, cached theo class + profile)
+        product_suggestions = await get_product_suggestions(result["predicted_class"], age, gender, allergies)
 
         return {
-            "predicted_class": predicted_class,
-            "confidence": float(confidence.item()),
-            "all_predictions": {SKIN_CLASSES[i]: float(all_probs[i]) for i in range(min(len(SKIN_CLASSES), len(all_probs)))},
+            **result,
             "product_suggestions": product_suggestions # Returns List[Dict]
         }
     except HTTPException as he:
@@ -672,60 +1326,419 @@ async def classify_skin_disease(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/segmentation-disease")
-async def segment_skin_lesion(file: UploadFile = File(...)) -> Dict:
-    if state.segmentation_model is None:
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+async def _iter_bulk_images(files: Optional[List[UploadFile]], archive: Optional[UploadFile],
+                            image_handles: Optional[List[str]] = None):
+    """
+    Yield (filename, bytes | None, error | None) từng ảnh một.
+    Upload đã được Starlette spool ra temp file, zip được đọc từng member -> không giữ toàn bộ trong RAM.
+    image_handles: ảnh đã upload qua POST /api/images (filename = handle)
+    """
+    for handle in image_handles or []:
+        try:
+            yield handle, state.image_store.get_bytes(handle), None
+        except ImageNotFound as e:
+            yield handle, None, str(e)
+
+    for upload in files or []:
+        if upload.content_type and not upload.content_type.startswith("image/"):
+            yield upload.filename, None, "Invalid file type"
+            continue
+        # Đọc tối đa BULK_MAX_IMAGE_BYTES + 1 -> ảnh quá lớn bị từ chối mà không nạp hết vào RAM
+        contents = await upload.read(BULK_MAX_IMAGE_BYTES + 1)
+        await upload.close()
+        if len(contents) > BULK_MAX_IMAGE_BYTES:
+            yield upload.filename, None, f"Image too large (> {BULK_MAX_IMAGE_BYTES} bytes)"
+            continue
+        yield upload.filename, contents, None
+
+    if archive is not None:
+        try:
+            # Đọc central directory + giải nén là blocking I/O -> chạy trên pool preprocess, không chặn event loop
+            zf = await run_inference('preprocess', zipfile.ZipFile, archive.file)
+        except zipfile.BadZipFile:
+            yield archive.filename, None, "Invalid archive (expected .zip)"
+            return
+
+        with zf:
+            for info in zf.infolist():
+                name = info.filename
+                if info.is_dir() or name.startswith("__MACOSX/") or not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                if info.file_size > BULK_MAX_IMAGE_BYTES:
+                    yield name, None, f"Image too large ({info.file_size} bytes)"
+                    continue
+                try:
+                    contents = await run_inference('preprocess', zf.read, info)
+                except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+                    # CRC sai / deflate hỏng / member bị cắt -> lỗi của ảnh này, các ảnh khác vẫn chạy tiếp
+                    yield name, None, f"Corrupt archive member: {e}"
+                    continue
+                except NotImplementedError as e:
+                    yield name, None, f"Unsupported archive member: {e}"
+                    continue
+                except RuntimeError as e:
+                    reason = "Encrypted archive member (password required)" if info.flag_bits & 0x1 else f"Unreadable archive member: {e}"
+                    yield name, None, reason
+                    continue
+                yield name, contents, None
+
+async def _bulk_classification_stream(
+    files: Optional[List[UploadFile]],
+    archive: Optional[UploadFile],
+    image_handles: Optional[List[str]],
+    include_suggestions: bool,
+    age: Optional[int],
+    gender: Optional[str],
+    allergies: Optional[str]
+):
+    """
+    NDJSON stream: một dòng cho mỗi ảnh ngay khi ảnh đó xong (thứ tự hoàn thành, kèm `index`),
+    dòng cuối là summary. Tối đa BULK_MAX_IN_FLIGHT ảnh được giữ trong bộ nhớ cùng lúc.
+    """
+    start_time = time.time()
+    slots = asyncio.Semaphore(BULK_MAX_IN_FLIGHT)
+    results: asyncio.Queue = asyncio.Queue(maxsize=BULK_MAX_IN_FLIGHT)
+    tasks = set()
+    done_marker = object()
+    counts = {"total": 0, "errors": 0}
+
+    async def classify_one(index: int, filename: str, contents: Optional[bytes], error: Optional[str]):
+        line = {"index": index, "filename": filename}
+        try:
+            if error:
+                raise ValueError(error)
+            line.update(format_classification(await run_classification(contents)))
+            if include_suggestions and line["predicted_class"] != "Unknown":
+                line["product_suggestions"] = await get_product_suggestions(
+                    line["predicted_class"], age, gender, allergies
+                )
+        except Exception as e:
+            line["error"] = str(e.detail) if isinstance(e, HTTPException) else str(e)
+        finally:
+            contents = None  # giải phóng bytes trước khi chờ chỗ trong queue
+        await results.put(line)
+        slots.release()
+
+    async def produce():
+        try:
+            index = 0
+            async for filename, contents, error in _iter_bulk_images(files, archive, image_handles):
+                await slots.acquire()
+                task = asyncio.create_task(classify_one(index, filename, contents, error))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                index += 1
+            if tasks:
+                await asyncio.gather(*list(tasks))
+        except Exception as e:
+            await results.put({"error": f"Failed to read uploads: {str(e)}"})
+        finally:
+            await results.put(done_marker)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            line = await results.get()
+            if line is done_marker:
+                break
+            if "index" in line:
+                counts["total"] += 1
+            if "error" in line:
+                counts["errors"] += 1
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+
+        yield json.dumps({
+            "done": True,
+            "total": counts["total"],
+            "errors": counts["errors"],
+            "response_time": round(time.time() - start_time, 2),
+            "timestamp": datetime.now().isoformat()
+        }) + "\n"
+    finally:
+        # Client ngắt kết nối -> huỷ các ảnh còn đang xử lý
+        producer.cancel()
+        for task in list(tasks):
+            task.cancel()
+
+@app.post("/api/classification-disease/bulk")
+async def classify_skin_disease_bulk(
+    files: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    image_handles: Optional[str] = Form(None),
+    include_suggestions: bool = Form(False),
+    age: Optional[int] = Form(None),
+    gender: Optional[str] = Form(None),
+    allergies: Optional[str] = Form(None)
+):
+    """
+    Bulk classification (backfill): nhiều file ảnh, một file .zip và/hoặc image_handles (phân tách bằng dấu phẩy).
+    Streams application/x-ndjson - mỗi ảnh một dòng JSON ngay khi xong, product suggestions là opt-in.
+    """
+    if await state.models.get('classification') is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Invalid file type")
+    handles = [handle.strip() for handle in (image_handles or "").split(",") if handle.strip()]
+    if not files and archive is None and not handles:
+        raise HTTPException(status_code=400, detail="Provide image files, a .zip archive or image_handles")
+
+    return StreamingResponse(
+        _bulk_classification_stream(files, archive, handles, include_suggestions, age, gender, allergies),
+        media_type="application/x-ndjson"
+    )
+
+def image_to_base64(image: Image.Image, format: str = "PNG", **save_kwargs) -> str:
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **save_kwargs)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+async def run_segmentation(image_id: str, working_np: Optional[np.ndarray] = None, original_size=None,
+                           point_coords=None, point_labels=None, box=None, multimask_output: bool = False,
+                           embedding: Optional[Dict[str, Any]] = None):
+    """
+    Segment qua predictor pool, dùng lại SAM2 embedding đã cache theo image_id nếu có.
+    working_np: ảnh đã thu nhỏ về SEGMENTATION_MAX_SIDE; None -> bắt buộc có embedding trong cache (404 nếu hết hạn).
+    embedding: entry caller đã lấy từ embedding_cache (không tra lại -> entry hết hạn giữa chừng không gây 404).
+    Prompts theo pixel ảnh gốc, được scale về working resolution trước khi decode.
+    Returns (masks ở working resolution, scores, embedding_cached, original_size, working_size)
+    """
+    if embedding is None:
+        embedding = state.embedding_cache.get(image_id)
+    if embedding is None and working_np is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Image embedding not found or expired - upload the image again"
+        )
+
+    if embedding is not None:
+        original_size = embedding["original_size"]
+        working_height, working_width = embedding["orig_hw"][0]
+    else:
+        working_height, working_width = working_np.shape[:2]
+    scale = np.array([working_width / original_size[0], working_height / original_size[1]], dtype=np.float32)
+
+    async with state.models.use('segmentation') as pool:
+        if pool is None:
+            raise HTTPException(status_code=503, detail="Model not loaded")
+        try:
+            new_embedding, masks, scores, _ = await pool.run(
+                segment_image,
+                working_np if embedding is None else None,
+                embedding,
+                point_coords=point_coords * scale if point_coords is not None else None,
+                point_labels=point_labels,
+                box=box * np.tile(scale, 2) if box is not None else None,
+                multimask_output=multimask_output
+            )
+        except PoolExhausted as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+    if embedding is None:
+        new_embedding["original_size"] = tuple(original_size)
+        state.embedding_cache.set(image_id, new_embedding)
+    return masks, scores, embedding is not None, tuple(original_size), (working_width, working_height)
+
+def render_segmentation(mask: np.ndarray, image: Optional[Image.Image], size, original_size,
+                        formats=("image",), polygon_tolerance: float = 2.0) -> Dict[str, Any]:
+    """
+    Mask working-res -> các output được chọn (blocking, chạy trên preprocess pool).
+    image / rle ở `size`; polygon / bbox theo pixel ảnh gốc; image != None -> thêm lesion_on_black.
+    """
+    output = {}
+    mask_size = (mask.shape[1], mask.shape[0])
+    scale = (original_size[0] / mask_size[0], original_size[1] / mask_size[1])
+
+    mask_image = upsample_mask(mask, size) if ("image" in formats or image is not None or tuple(size) != mask_size) else None
+    if "image" in formats:
+        output["mask"] = image_to_base64(mask_image, "PNG")
+        output["format"] = "base64_png"
+    if image is not None:
+        black_bg = Image.new("RGB", size, (0, 0, 0))
+        output["lesion_on_black"] = image_to_base64(Image.composite(image, black_bg, mask_image), "JPEG", quality=90)
+    if "rle" in formats:
+        output["rle"] = encode_rle(mask if mask_image is None else np.asarray(mask_image))
+    if "polygon" in formats:
+        output["polygons"] = mask_polygons(mask, tolerance=polygon_tolerance, scale=scale)
+    if "bbox" in formats:
+        output.update(mask_bbox(mask, scale=scale))
+    return output
+
+def _output_formats(output: str) -> List[str]:
+    try:
+        return parse_output_formats(output)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def segmentation_image_id(contents: bytes) -> str:
+    """Content hash của ảnh + working resolution (embedding phụ thuộc cả hai)"""
+    return content_hash(contents, SEGMENTATION_MAX_SIDE)
+
+def _parse_prompt(value: Optional[str], field: str, width: Optional[int], example: str, dtype=np.float32):
+    """JSON form field -> array có chiều cuối = width (None nếu không gửi), 400 nếu sai định dạng"""
+    if value is None or value.strip() == "":
+        return None
+    try:
+        array = np.asarray(json.loads(value), dtype=dtype)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail=f"Invalid JSON for '{field}', expected {example}")
+    if array.size == 0 or (width is not None and array.shape[-1] != width):
+        raise HTTPException(status_code=400, detail=f"Invalid '{field}', expected {example}")
+    return array
+
+@app.post("/api/segmentation-disease")
+async def segment_skin_lesion(
+    file: Optional[UploadFile] = File(None),
+    image_handle: Optional[str] = Form(None),
+    full_size: bool = Form(False),
+    output: str = Form("image"),
+    include_composite: bool = Form(False),
+    polygon_tolerance: float = Form(2.0)
+) -> Dict:
+    """
+    SAM2 segmentation trên bản thu nhỏ (cạnh dài <= SEGMENTATION_MAX_SIDE).
+    - output: 1 hoặc nhiều format, phân tách bằng dấu phẩy
+        image   -> "mask" PNG base64 (mặc định)
+        rle     -> "rle" COCO compressed RLE {"size": [h, w], "counts": "..."}
+        polygon -> "polygons" [[x1, y1, x2, y2, ...], ...] theo pixel ảnh gốc
+        bbox    -> "bbox" [x, y, w, h], "area", "area_ratio", "centroid" theo pixel ảnh gốc
+    - include_composite: thêm "lesion_on_black" JPEG base64 (opt-in, payload lớn)
+    - full_size=true -> mask image / RLE / composite ở kích thước ảnh gốc thay vì working resolution
+    - image_handle (POST /api/images) thay cho file
+    - image_quality: quality gate chạy trước SAM2 (IMAGE_QUALITY_MODE=reject -> 422 khi không đạt)
+    """
+    formats = _output_formats(output)
+    if await state.models.get('segmentation') is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
     
     try:
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
-        original_size = image.size
-        image_np = np.array(image)
-        
-        state.segmentation_model.set_image(image_np)
-        
-        with torch.no_grad():
-            masks, scores, _ = state.segmentation_model.predict(
-                point_coords=None, point_labels=None, box=None, multimask_output=False
+        contents = await read_image_input(file, image_handle)
+        if image_handle:
+            working, original_size = await decode_image_input(contents, image_handle, SEGMENTATION_MAX_SIDE)
+            full_image = (await decode_image_input(contents, image_handle, 0))[0] if full_size else None
+        else:
+            working, full_image, original_size = await run_inference(
+                'preprocess', decode_for_segmentation, contents, SEGMENTATION_MAX_SIDE, full_size
             )
+        image_quality = await quality_gate(contents, image_handle, working, original_size)
+        image_id = segmentation_image_id(contents)
         
-        mask = masks[0] if len(masks) > 0 else np.zeros(image_np.shape[:2], dtype=np.uint8)
-        
-        if mask.dtype == bool:
-            mask = mask.astype(np.uint8) * 255
-        elif mask.max() <= 1:
-            mask = (mask * 255).astype(np.uint8)
+        masks, scores, embedding_cached, _, working_size = await run_segmentation(
+            image_id, np.asarray(working), original_size
+        )
         
-        black_bg = Image.new("RGB", original_size, (0, 0, 0))
-        mask_pil = Image.fromarray(mask).convert("L")
+        output_image = full_image if full_size else working
+        mask = masks[0] if len(masks) > 0 else np.zeros((working_size[1], working_size[0]), dtype=np.uint8)
+        rendered = await run_inference(
+            'preprocess', render_segmentation, mask, output_image if include_composite else None,
+            output_image.size, original_size, formats, polygon_tolerance
+        )
         
-        if mask_pil.size != original_size:
-            mask_pil = mask_pil.resize(original_size, Image.NEAREST)
-
-        full_image_on_black = Image.composite(image, black_bg, mask_pil)
-        buffer_black_bg = io.BytesIO()
-        full_image_on_black.save(buffer_black_bg, format="JPEG", quality=90)
-        black_bg_base64 = base64.b64encode(buffer_black_bg.getvalue()).decode("utf-8")
+        return {
+            **rendered,
+            "outputs": formats,
+            "original_size": original_size,
+            "mask_size": output_image.size,
+            "working_size": working_size,
+            "confidence": float(scores[0]) if len(scores) > 0 else 0.0,
+            # Dùng image_id với /api/segmentation-disease/refine để chỉnh mask mà không upload lại
+            "image_id": image_id,
+            "embedding_cached": embedding_cached,
+            "image_quality": image_quality
+        }
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        mask_image = Image.fromarray(mask)
-        if mask_image.size != original_size:
-            mask_image = mask_image.resize(original_size, Image.NEAREST)
+@app.post("/api/segmentation-disease/refine")
+async def refine_skin_lesion_mask(
+    image_id: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None),
+    image_handle: Optional[str] = Form(None),
+    points: Optional[str] = Form(None),
+    point_labels: Optional[str] = Form(None),
+    box: Optional[str] = Form(None),
+    multimask_output: bool = Form(False),
+    full_size: bool = Form(False),
+    output: str = Form("image"),
+    polygon_tolerance: float = Form(2.0)
+) -> Dict:
+    """
+    Prompted re-segmentation: chỉ chạy mask decoder trên SAM2 embedding đã cache.
+    Masks trả về ở working resolution, full_size=true -> upsample về kích thước ảnh gốc.
+    - image_id: từ response của /api/segmentation-disease (hoặc gửi lại file / image_handle nếu embedding đã hết hạn)
+    - points: JSON [[x, y], ...] theo pixel ảnh gốc; point_labels: JSON [1, 0, ...] (1 = lesion, 0 = background)
+    - box: JSON [x1, y1, x2, y2] theo pixel ảnh gốc
+    - output: như /api/segmentation-disease (image | rle | polygon | bbox), mỗi mask trong "masks" là 1 object
+    """
+    formats = _output_formats(output)
+    if image_id is None and file is None and not image_handle:
+        raise HTTPException(status_code=400, detail="Provide image_id, file or image_handle")
+    
+    point_coords = _parse_prompt(points, "points", 2, "[[x, y], ...]")
+    box_array = _parse_prompt(box, "box", 4, "[x1, y1, x2, y2]")
+    labels = None
+    if point_coords is not None:
+        point_coords = point_coords.reshape(-1, 2)
+        labels = _parse_prompt(point_labels, "point_labels", None, "[1, 0, ...]", dtype=np.int32)
+        if labels is None:
+            labels = np.ones(len(point_coords), dtype=np.int32)  # mặc định: tất cả là điểm lesion
+        if labels.shape != (len(point_coords),):
+            raise HTTPException(status_code=400, detail="'point_labels' must have one label per point")
+    if point_coords is None and box_array is None:
+        raise HTTPException(status_code=400, detail="Provide at least one point or a box")
+    
+    if await state.models.get('segmentation') is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    try:
+        start_time = time.time()
+        working_np, original_size, embedding = None, None, None
+        if file is not None or image_handle:
+            contents = await read_image_input(file, image_handle)
+            image_id = segmentation_image_id(contents)
+            # Lấy embedding 1 lần rồi truyền vào run_segmentation: miss -> decode ảnh đã gửi, không bao giờ 404
+            embedding = state.embedding_cache.get(image_id)
+            if embedding is None:
+                working, original_size = await decode_image_input(contents, image_handle, SEGMENTATION_MAX_SIDE)
+                working_np = np.asarray(working)
         
-        buffer = io.BytesIO()
-        mask_image.save(buffer, format="PNG")
-        mask_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+        masks, scores, embedding_cached, original_size, working_size = await run_segmentation(
+            image_id,
+            working_np,
+            original_size,
+            point_coords=point_coords,
+            point_labels=labels,
+            box=box_array,
+            multimask_output=multimask_output,
+            embedding=embedding
+        )
         
+        # Multimask: sắp xếp theo score, mask tốt nhất đứng đầu
+        order = np.argsort(-np.asarray(scores))
+        output_size = original_size if full_size else working_size
+        rendered = [
+            {
+                "score": round(float(scores[i]), 4),
+                **await run_inference(
+                    'preprocess', render_segmentation, masks[i], None,
+                    output_size, original_size, formats, polygon_tolerance
+                )
+            }
+            for i in order
+        ]
         return {
-            "mask": mask_base64,
-            "lesion_on_black": black_bg_base64,
-            "format": "base64_png",
+            "masks": rendered,
+            "outputs": formats,
             "original_size": original_size,
-            "confidence": float(scores[0]) if len(scores) > 0 else 0.0
+            "mask_size": output_size,
+            "image_id": image_id,
+            "embedding_cached": embedding_cached,
+            "response_time": round(time.time() - start_time, 4)
         }
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -733,33 +1746,41 @@ async def segment_skin_lesion(file: UploadFile = File(...)) -> Dict:
 # FACE DETECTION ENDPOINT
 # =============================================================================
 @app.post("/api/face-detection")
-async def face_detection(file: UploadFile = File(...)) -> Dict[str, bool]:
-    if state.face_detector is None:
+async def face_detection(
+    file: Optional[UploadFile] = File(None),
+    image_handle: Optional[str] = Form(None)
+) -> Dict[str, Any]:
+    """has_face + faces [{"box": [x, y, w, h], "score"}] theo pixel ảnh gốc (detect trên bản thu nhỏ)"""
+    if await state.models.get('face_detection') is None:
         print("⚠️  Face detection model not loaded")
         return {"has_face": True} 
     try:
-        content = await file.read()
-        image = Image.open(io.BytesIO(content)).convert("RGB")
-        image_np = np.array(image)
+        content = await read_image_input(file, image_handle)
+        # JPEG decode thẳng ở độ phân giải detection (draft), không decode full-res
+        image, original_size = await decode_image_input(content, image_handle, FACE_DETECTION_MAX_SIDE)
 
-        results = state.face_detector.process(image_np)
-
-        if results.detections:
+        faces = await run_face_detection(np.asarray(image), original_size)
+        if faces is None:
             return {"has_face": True}
-        return {"has_face": False}
+
+        return {"has_face": bool(faces), "faces": faces}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         print(f"❌ Error during face detection: {e}")
         return {"has_face": False}
 
 @app.post("/api/analyze-skin-image-vlm", response_model=VLMAnalysisResponse)
-async def analyze_skin_image_vlm_endpoint(file: UploadFile = File(...), note: Optional[str] = Form(None)):
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
-
+async def analyze_skin_image_vlm_endpoint(
+    file: Optional[UploadFile] = File(None),
+    note: Optional[str] = Form(None),
+    image_handle: Optional[str] = Form(None)
+):
     try: 
         start_time = time.time()
-        image_bytes = await file.read()
-        skin_analysis = analyze_skin_image(image_bytes, note)
+        image_bytes = await read_image_input(file, image_handle)
+        image_quality = await quality_gate(image_bytes, image_handle)
+        skin_analysis = await analyze_skin_image_cached(image_bytes, note)
         
         if not skin_analysis:
             raise HTTPException(status_code=500, detail="VLM failed to analyze the image. Please try again.")
@@ -767,7 +1788,8 @@ async def analyze_skin_image_vlm_endpoint(file: UploadFile = File(...), note: Op
         return VLMAnalysisResponse(
             skin_analysis=skin_analysis,
             response_time=round(time.time() - start_time, 2),
-            timestamp=datetime.now().isoformat()
+            timestamp=datetime.now().isoformat(),
+            image_quality=image_quality
         )
     
     except HTTPException as he:
@@ -776,6 +1798,169 @@ async def analyze_skin_image_vlm_endpoint(file: UploadFile = File(...), note: Op
         print(f"❌ Error in VLM endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
+async def _timed_stage(timings: Dict[str, float], name: str, awaitable):
+    """Await 1 stage, ghi thời gian (ms) vào timings[name] kể cả khi lỗi"""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1000.0, 1)
+
+def _stage_error(error: BaseException) -> Dict[str, Any]:
+    if isinstance(error, HTTPException):
+        return {"status_code": error.status_code, "detail": error.detail}
+    return {"status_code": 500, "detail": str(error)}
+
+@app.post("/api/analyze-skin")
+async def analyze_skin(
+    file: Optional[UploadFile] = File(None),
+    image_handle: Optional[str] = Form(None),
+    notes: Optional[str] = Form(None),
+    age: Optional[int] = Form(None),
+    gender: Optional[str] = Form(None),
+    allergies: Optional[str] = Form(None),
+    face_crop: bool = Form(FACE_CROP_ENABLED),
+    include_suggestions: bool = Form(True),
+    include_segmentation: bool = Form(True),
+    include_vlm: bool = Form(False),
+    note: Optional[str] = Form(None),
+    output: str = Form("bbox"),
+    polygon_tolerance: float = Form(2.0)
+) -> Dict:
+    """
+    1 lần upload -> face detection + classification + segmentation (+ VLM) trong 1 response.
+    Ảnh được decode 1 lần (working resolution SEGMENTATION_MAX_SIDE) và dùng chung cho mọi stage;
+    các stage độc lập chạy song song, chỉ product suggestions phải chờ classification.
+    - notes == 'facial': không có khuôn mặt -> 400 và huỷ các stage còn lại (như /api/classification-disease);
+      face_crop -> classification chờ face detection rồi chỉ classify vùng mặt (face_crop_box)
+    - classification lỗi -> trả lỗi của classification; segmentation / VLM lỗi -> ghi vào "errors", field = null
+    - output: format mask của segmentation (xem /api/segmentation-disease), mặc định "bbox" cho payload nhỏ
+    - note: ghi chú cho VLM (như /api/analyze-skin-image-vlm)
+    - timings: thời gian từng stage (ms); các stage chạy song song nên tổng > total_ms
+    - image_handle (POST /api/images) thay cho file -> bỏ qua cả upload lẫn decode
+    - image_quality: kết quả quality gate; IMAGE_QUALITY_MODE=reject -> 422 trước khi chạy model
+    """
+    formats = _output_formats(output) if include_segmentation else []
+
+    start_time = time.perf_counter()
+    timings: Dict[str, float] = {}
+    contents = await read_image_input(file, image_handle)
+    try:
+        working, original_size = await _timed_stage(
+            timings, "decode", decode_image_input(contents, image_handle, SEGMENTATION_MAX_SIDE)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    # Reject (IMAGE_QUALITY_MODE=reject) trước khi start bất kỳ stage nào
+    image_quality = await _timed_stage(timings, "quality", quality_gate(contents, image_handle, working, original_size))
+    working_np = np.asarray(working)
+
+    async def classify():
+        crop_box = None
+        if notes == 'facial' and face_crop:
+            try:
+                crop_box = face_roi_box(await face_task, original_size, FACE_CROP_MARGIN)
+            except Exception:
+                crop_box = None  # detector lỗi / không load được -> classify cả khung hình
+        all_probs = await _timed_stage(
+            timings, "classification", run_classification(contents, working, crop_box, original_size)
+        )
+        result = {**format_classification(all_probs), "face_crop_box": crop_box}
+        suggestions = []
+        if include_suggestions and result["predicted_class"] != "Unknown":
+            suggestions = await _timed_stage(
+                timings, "product_suggestions",
+                get_product_suggestions(result["predicted_class"], age, gender, allergies)
+            )
+        return {**result, "product_suggestions": suggestions}
+
+    async def segment():
+        image_id = segmentation_image_id(contents)
+        masks, scores, embedding_cached, _, working_size = await run_segmentation(image_id, working_np, original_size)
+        mask = masks[0] if len(masks) > 0 else np.zeros((working_size[1], working_size[0]), dtype=np.uint8)
+        rendered = await run_inference(
+            'preprocess', render_segmentation, mask, None, working.size, original_size, formats, polygon_tolerance
+        )
+        return {
+            **rendered,
+            "outputs": formats,
+            "mask_size": working.size,
+            "working_size": working_size,
+            "confidence": float(scores[0]) if len(scores) > 0 else 0.0,
+            "image_id": image_id,
+            "embedding_cached": embedding_cached
+        }
+
+    async def analyze_vlm():
+        skin_analysis = await analyze_skin_image_cached(contents, note)
+        if not skin_analysis:
+            raise HTTPException(status_code=500, detail="VLM failed to analyze the image. Please try again.")
+        return skin_analysis
+
+    face_task = asyncio.ensure_future(
+        _timed_stage(timings, "face_detection", run_face_detection(working_np, original_size))
+    )
+    tasks = {
+        "face": face_task,
+        "classification": asyncio.ensure_future(classify()),
+    }
+    if include_segmentation:
+        tasks["segmentation"] = asyncio.ensure_future(_timed_stage(timings, "segmentation", segment()))
+    if include_vlm:
+        tasks["vlm"] = asyncio.ensure_future(_timed_stage(timings, "vlm", analyze_vlm()))
+
+    try:
+        # Face gate trước: ảnh facial không có mặt thì không cần chờ các stage khác
+        try:
+            detections = await tasks["face"]
+        except Exception as e:
+            print(f"❌ Error during face detection: {e}")
+            detections = None
+        if notes == 'facial' and detections is not None and not detections:
+            raise HTTPException(status_code=400, detail=NO_FACE_DETAIL)
+
+        await asyncio.wait(tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+    classification_task = tasks["classification"]
+    if classification_task.exception() is not None:
+        error = classification_task.exception()
+        if isinstance(error, HTTPException):
+            raise error
+        raise HTTPException(status_code=500, detail=str(error))
+
+    response: Dict[str, Any] = {
+        **classification_task.result(),
+        # None: detector không load được / lỗi -> không kiểm tra được
+        "has_face": None if detections is None else bool(detections),
+        "faces": detections,
+        "original_size": original_size,
+        "image_quality": image_quality,
+    }
+    errors = {}
+    for stage in ("segmentation", "vlm"):
+        if stage not in tasks:
+            continue
+        error = tasks[stage].exception()
+        if error is not None:
+            errors[stage] = _stage_error(error)
+            print(f"⚠️ {stage} stage failed: {errors[stage]['detail']}")
+        response["segmentation" if stage == "segmentation" else "skin_analysis"] = (
+            None if error is not None else tasks[stage].result()
+        )
+
+    return {
+        **response,
+        "errors": errors,
+        "timings": {**timings, "total_ms": round((time.perf_counter() - start_time) * 1000.0, 1)},
+        "timestamp": datetime.now().isoformat()
+    }
+
 # =============================================================================
 # RUN SERVER
 # =============================================================================
@@ -0,0 +1,100 @@
+"""
+Mask encodings gọn cho segmentation response (thay cho PNG/JPEG base64 hàng trăm KB)
+- rle:     COCO run-length encoding (compressed string, decode được bằng pycocotools.mask.decode)
+- polygon: contour ngoài đã đơn giản hoá (Douglas-Peucker), toạ độ theo pixel ảnh gốc
+- bbox:    bounding box + diện tích / tỉ lệ diện tích / tâm
+- image:   PNG mask base64 như cũ
+"""
+
+from typing import Any, Dict, List, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+MASK_OUTPUT_FORMATS = ("image", "rle", "polygon", "bbox")
+
+
+def parse_output_formats(value: str) -> List[str]:
+    """'rle,bbox' -> ['rle', 'bbox']; ValueError nếu có format không hỗ trợ"""
+    formats = [name.strip().lower() for name in (value or "").split(",") if name.strip()]
+    unknown = [name for name in formats if name not in MASK_OUTPUT_FORMATS]
+    if unknown or not formats:
+        raise ValueError(f"Unsupported output format {unknown or value!r}, choose from {', '.join(MASK_OUTPUT_FORMATS)}")
+    return list(dict.fromkeys(formats))
+
+
+def binarize(mask: np.ndarray) -> np.ndarray:
+    """bool / 0-1 float / 0-255 uint8 -> bool"""
+    mask = np.asarray(mask)
+    return mask > (127 if mask.dtype == np.uint8 and mask.max() > 1 else 0.5)
+
+
+def _run_lengths(mask: np.ndarray) -> np.ndarray:
+    """Độ dài các run theo thứ tự column-major (COCO), run đầu tiên luôn là 0 (có thể dài 0)"""
+    flat = mask.ravel(order="F").astype(np.int8)
+    changes = np.flatnonzero(np.diff(flat)) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(bounds)
+    if flat.size and flat[0] == 1:
+        counts = np.concatenate(([0], counts))
+    return counts
+
+
+def _counts_to_string(counts: Sequence[int]) -> str:
+    """COCO rleToString: delta với run cách 2 vị trí + LEB128-like 5 bit/ký tự"""
+    chars = []
+    for i, value in enumerate(counts):
+        x = int(value) - (int(counts[i - 2]) if i > 2 else 0)
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = (x != -1) if (c & 0x10) else (x != 0)
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def encode_rle(mask: np.ndarray) -> Dict[str, Any]:
+    """COCO compressed RLE: {"size": [h, w], "counts": "..."}"""
+    binary = binarize(mask)
+    return {"size": list(binary.shape), "counts": _counts_to_string(_run_lengths(binary))}
+
+
+def mask_polygons(mask: np.ndarray, tolerance: float = 2.0, scale: Tuple[float, float] = (1.0, 1.0),
+                  min_area: float = 16.0) -> List[List[float]]:
+    """
+    Contour ngoài của các vùng mask, mỗi polygon là [x1, y1, x2, y2, ...] (COCO segmentation).
+    tolerance: sai số Douglas-Peucker (pixel của mask); scale: (sx, sy) đổi sang pixel ảnh gốc.
+    """
+    binary = binarize(mask).astype(np.uint8)
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    polygons = []
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True):
+        if cv2.contourArea(contour) < min_area:
+            continue
+        approx = cv2.approxPolyDP(contour, tolerance, True).reshape(-1, 2).astype(np.float64)
+        if len(approx) < 3:
+            continue
+        approx *= scale
+        polygons.append([round(float(v), 1) for v in approx.ravel()])
+    return polygons
+
+
+def mask_bbox(mask: np.ndarray, scale: Tuple[float, float] = (1.0, 1.0)) -> Dict[str, Any]:
+    """Bounding box [x, y, w, h] + area theo pixel ảnh gốc, area_ratio và centroid"""
+    binary = binarize(mask)
+    area = int(binary.sum())
+    if area == 0:
+        return {"bbox": None, "area": 0, "area_ratio": 0.0, "centroid": None}
+
+    ys, xs = np.nonzero(binary)
+    sx, sy = scale
+    x0, y0, x1, y1 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+    return {
+        "bbox": [round(x0 * sx, 1), round(y0 * sy, 1), round((x1 - x0) * sx, 1), round((y1 - y0) * sy, 1)],
+        "area": int(round(area * sx * sy)),
+        "area_ratio": round(area / binary.size, 6),
+        "centroid": [round(float(xs.mean()) * sx, 1), round(float(ys.mean()) * sy, 1)],
+    }
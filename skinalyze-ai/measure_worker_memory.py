@@ -0,0 +1,154 @@
+"""
+Đo RAM riêng của từng gunicorn worker: per-worker load (cũ) vs preload-then-fork
+Chạy: python measure_worker_memory.py [--workers 4] [--models classification,segmentation,embeddings]
+      python measure_worker_memory.py --pid <gunicorn master pid>   # đo server đang chạy
+
+Đọc /proc/<pid>/smaps_rollup (Linux):
+- USS (Private_Clean + Private_Dirty): RAM chỉ worker đó dùng -> RAM tăng thêm khi thêm 1 worker
+- PSS: RAM chia đều phần dùng chung
+- RSS: tổng trang resident (đếm trùng phần dùng chung)
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty")
+
+
+def read_smaps_rollup(pid: int):
+    """MB cho mỗi field trong FIELDS + 'Uss'"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in FIELDS:
+                values[key] = int(rest.split()[0]) / 1024.0
+    values["Uss"] = values["Private_Clean"] + values["Private_Dirty"]
+    values["Shared"] = values["Shared_Clean"] + values["Shared_Dirty"]
+    return values
+
+
+def child_pids(pid: int):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+def measure(master_pid: int):
+    return {
+        "master": read_smaps_rollup(master_pid),
+        "workers": {pid: read_smaps_rollup(pid) for pid in child_pids(master_pid)},
+    }
+
+
+def print_report(title: str, report):
+    print(f"\n📊 {title}")
+    print(f"    {'process':<16}{'RSS MB':>10}{'PSS MB':>10}{'USS MB':>10}{'Shared MB':>12}")
+    rows = [("master", report["master"])] + [(f"worker {pid}", v) for pid, v in report["workers"].items()]
+    for name, v in rows:
+        print(f"    {name:<16}{v['Rss']:>10.1f}{v['Pss']:>10.1f}{v['Uss']:>10.1f}{v['Shared']:>12.1f}")
+
+    workers = list(report["workers"].values())
+    if workers:
+        avg_uss = sum(v["Uss"] for v in workers) / len(workers)
+        total_pss = report["master"]["Pss"] + sum(v["Pss"] for v in workers)
+        print(f"    ➜ avg worker USS: {avg_uss:.1f} MB | total PSS (master + workers): {total_pss:.1f} MB")
+
+
+def wait_until_ready(port: int, workers: int, master_pid: int, timeout: float):
+    """Đợi đủ số worker và mỗi worker đã qua lifespan (RSS ổn định)"""
+    deadline = time.time() + timeout
+    url = f"http://127.0.0.1:{port}/health"
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=5).read()
+            if len(child_pids(master_pid)) >= workers:
+                break
+        except OSError:
+            pass
+        time.sleep(1.0)
+    else:
+        raise TimeoutError("Server did not become ready")
+
+    # Lifespan của từng worker chạy độc lập -> đợi tổng RSS ngừng tăng
+    previous = -1.0
+    while time.time() < deadline:
+        current = sum(read_smaps_rollup(pid)["Rss"] for pid in child_pids(master_pid))
+        if abs(current - previous) < 5.0:
+            return
+        previous = current
+        time.sleep(3.0)
+
+
+def run_server(preload: bool, args):
+    env = dict(os.environ)
+    env["WEB_CONCURRENCY"] = str(args.workers)
+    env["BIND"] = f"127.0.0.1:{args.port}"
+    env["PRELOAD_MODELS"] = args.models if preload else ""
+    # Không preload -> mỗi worker tự load cùng các model đó lúc khởi động (so sánh công bằng)
+    env["MODEL_PINNED"] = ",".join(name for name in args.models.split(",") if name != "embeddings")
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn_conf.py", "main:app"],
+        env=env, stdout=subprocess.DEVNULL if args.quiet else None, stderr=subprocess.STDOUT if args.quiet else None
+    )
+    try:
+        wait_until_ready(args.port, args.workers, process.pid, args.timeout)
+        return measure(process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-worker unique memory: per-worker load vs preload-then-fork")
+    parser.add_argument("--pid", type=int, default=None, help="Measure a running gunicorn master instead")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--models", default="classification,segmentation,embeddings")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--quiet", action="store_true", help="Hide server logs")
+    args = parser.parse_args()
+
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        print("❌ /proc/<pid>/smaps_rollup not available (Linux 4.14+ required)")
+        return 1
+
+    print("\n" + "=" * 80)
+    print("🧠 WORKER MEMORY (USS = RAM riêng của worker)")
+    print("=" * 80)
+
+    if args.pid:
+        print_report(f"gunicorn master {args.pid}", measure(args.pid))
+        return 0
+
+    print(f"\n⏳ [1/2] {args.workers} workers, each loading its own weights...")
+    before = run_server(False, args)
+    print_report("Before: per-worker load", before)
+
+    print(f"\n⏳ [2/2] {args.workers} workers, weights preloaded in master ({args.models})...")
+    after = run_server(True, args)
+    print_report("After: preload-then-fork", after)
+
+    def avg_uss(report):
+        workers = list(report["workers"].values())
+        return sum(v["Uss"] for v in workers) / max(1, len(workers))
+
+    saved = avg_uss(before) - avg_uss(after)
+    print(f"\n✅ Unique RAM per worker: {avg_uss(before):.1f} MB -> {avg_uss(after):.1f} MB "
+          f"({saved:.1f} MB saved per additional worker)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""
+Model registry - lazy loading theo yêu cầu + unload model idle
+Model chỉ được load ở request đầu tiên cần nó (có lock tránh load 2 lần),
+model không dùng quá idle timeout sẽ bị unload để trả RAM. Model "pinned" luôn warm.
+"""
+
+import asyncio
+import gc
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+def release_memory():
+    """Best-effort trả RAM về OS sau khi unload model"""
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class _ModelEntry:
+    def __init__(self, name: str, loader: Callable[[], Any], on_unload: Optional[Callable[[Any], None]]):
+        self.name = name
+        self.loader = loader
+        self.on_unload = on_unload
+        self.model = None
+        self.lock = asyncio.Lock()
+        self.pinned = False
+        self.in_use = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_time = None
+        self.loaded_at = None
+        self.last_used = None
+        self.last_error = None
+        self.failed_at = None
+
+
+class ModelRegistry:
+    """
+    registry.register('segmentation', load_segmentation_model)
+    async with registry.use('segmentation') as predictor:
+        ...  # predictor là None nếu không load được
+    """
+
+    def __init__(self, idle_timeout_seconds: float = 1800, retry_after_seconds: float = 60):
+        self.idle_timeout = idle_timeout_seconds if idle_timeout_seconds and idle_timeout_seconds > 0 else None
+        self.retry_after = retry_after_seconds
+        self._entries: Dict[str, _ModelEntry] = {}
+        self._evictor: Optional[asyncio.Task] = None
+
+    def register(self, name: str, loader: Callable[[], Any], on_unload: Optional[Callable[[Any], None]] = None):
+        """loader: blocking function trả về model hoặc None nếu lỗi (chạy trong thread)"""
+        self._entries[name] = _ModelEntry(name, loader, on_unload)
+
+    def pin(self, names: Iterable[str]):
+        for name in names:
+            if name in self._entries:
+                self._entries[name].pinned = True
+
+    # -------------------------------------------------------------------------
+    # Access
+    # -------------------------------------------------------------------------
+    def peek(self, name: str) -> Any:
+        """Model nếu đang resident, không trigger load"""
+        return self._entries[name].model
+
+    async def get(self, name: str) -> Any:
+        """Model đã load (load lần đầu nếu cần), None nếu loader thất bại"""
+        entry = self._entries[name]
+        if entry.model is not None:
+            entry.last_used = time.monotonic()
+            return entry.model
+
+        async with entry.lock:
+            if entry.model is None:
+                # Loader lỗi gần đây -> không thử lại liên tục
+                if entry.failed_at is not None and time.monotonic() - entry.failed_at < self.retry_after:
+                    return None
+                await self._load(entry)
+            entry.last_used = time.monotonic()
+            return entry.model
+
+    @asynccontextmanager
+    async def use(self, name: str):
+        """Giữ model trong suốt request để không bị evict giữa chừng"""
+        entry = self._entries[name]
+        entry.in_use += 1
+        try:
+            yield await self.get(name)
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+
+    async def _load(self, entry: _ModelEntry):
+        print(f"⏳ Loading model on demand: {entry.name}")
+        start = time.perf_counter()
+        try:
+            model = await asyncio.get_running_loop().run_in_executor(None, entry.loader)
+        except Exception as e:
+            model = None
+            entry.last_error = str(e)
+
+        if model is None:
+            entry.failed_at = time.monotonic()
+            entry.last_error = entry.last_error or "loader returned None"
+            print(f"❌ Model '{entry.name}' unavailable: {entry.last_error}")
+            return
+
+        entry.model = model
+        entry.loads += 1
+        entry.load_time = time.perf_counter() - start
+        entry.loaded_at = time.time()
+        entry.failed_at = None
+        entry.last_error = None
+        print(f"✅ Model '{entry.name}' loaded in {entry.load_time:.2f}s")
+
+    # -------------------------------------------------------------------------
+    # Warm-up / eviction
+    # -------------------------------------------------------------------------
+    async def warm_pinned(self):
+        for entry in self._entries.values():
+            if entry.pinned:
+                await self.get(entry.name)
+
+    def unload(self, name: str) -> bool:
+        entry = self._entries[name]
+        if entry.model is None or entry.in_use > 0:
+            return False
+
+        model, entry.model = entry.model, None
+        if entry.on_unload is not None:
+            try:
+                entry.on_unload(model)
+            except Exception as e:
+                print(f"⚠️  Error while unloading '{name}': {e}")
+        del model
+        entry.evictions += 1
+        release_memory()
+        print(f"♻️  Unloaded idle model: {name}")
+        return True
+
+    def evict_idle(self):
+        if self.idle_timeout is None:
+            return
+        now = time.monotonic()
+        for entry in self._entries.values():
+            if (
+                entry.model is not None
+                and not entry.pinned
+                and entry.in_use == 0
+                and entry.last_used is not None
+                and now - entry.last_used >= self.idle_timeout
+            ):
+                self.unload(entry.name)
+
+    async def _evict_loop(self):
+        interval = max(1.0, min(60.0, self.idle_timeout / 2))
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_idle()
+
+    def start(self):
+        if self.idle_timeout is not None and (self._evictor is None or self._evictor.done()):
+            self._evictor = asyncio.get_running_loop().create_task(self._evict_loop())
+
+    async def stop(self):
+        if self._evictor is not None:
+            self._evictor.cancel()
+            try:
+                await self._evictor
+            except asyncio.CancelledError:
+                pass
+            self._evictor = None
+
+    # -------------------------------------------------------------------------
+    # Reporting
+    # -------------------------------------------------------------------------
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        report = {}
+        for name, entry in self._entries.items():
+            report[name] = {
+                "resident": entry.model is not None,
+                "pinned": entry.pinned,
+                "in_use": entry.in_use,
+                "loads": entry.loads,
+                "evictions": entry.evictions,
+                "load_time_s": round(entry.load_time, 3) if entry.load_time is not None else None,
+                "loaded_at": (
+                    time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(entry.loaded_at))
+                    if entry.model is not None and entry.loaded_at else None
+                ),
+                "idle_s": round(now - entry.last_used, 1) if entry.last_used is not None else None,
+                "last_error": entry.last_error,
+            }
+        return report
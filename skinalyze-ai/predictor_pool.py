@@ -0,0 +1,109 @@
+"""
+Pool các predictor có state riêng (SAM2ImagePredictor giữ image embedding giữa set_image và predict)
+N predictor dùng chung 1 bộ weights, mỗi request checkout 1 predictor riêng -> không request nào
+thấy embedding của ảnh khác. Hàng đợi chờ có giới hạn: quá tải thì từ chối ngay thay vì dồn ứ.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, List, Optional
+
+
+class PoolExhausted(Exception):
+    """Không có predictor rảnh: hàng đợi đầy hoặc chờ quá checkout timeout"""
+
+
+class PredictorPool:
+    """
+    pool = PredictorPool([SAM2ImagePredictor(model) for _ in range(2)], run_fn=...)
+    embedding, masks, scores, logits = await pool.run(segment_image, image_np)
+    """
+
+    def __init__(
+        self,
+        predictors: List[Any],
+        run_fn: Callable[..., Awaitable[Any]],
+        max_waiting: int = 8,
+        checkout_timeout: Optional[float] = 30.0,
+        name: str = "predictor_pool"
+    ):
+        self.predictors = list(predictors)
+        self.run_fn = run_fn  # run_fn(fn, predictor, *args, **kwargs) -> chạy blocking call trên inference thread
+        self.max_waiting = max(0, int(max_waiting))
+        self.checkout_timeout = checkout_timeout if checkout_timeout and checkout_timeout > 0 else None
+        self.name = name
+
+        # Queue tạo lazily trong event loop của worker (pool có thể được build ở gunicorn master)
+        self._available: Optional[asyncio.Queue] = None
+        self._waiting = 0
+
+        self.checkouts = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+
+    @property
+    def size(self) -> int:
+        return len(self.predictors)
+
+    def _queue(self) -> asyncio.Queue:
+        if self._available is None:
+            self._available = asyncio.Queue()
+            for predictor in self.predictors:
+                self._available.put_nowait(predictor)
+        return self._available
+
+    async def _acquire(self) -> Any:
+        available = self._queue()
+        if available.empty() and self._waiting >= self.max_waiting:
+            self.rejected += 1
+            raise PoolExhausted(f"{self.name}: all {self.size} predictors busy, {self._waiting} requests waiting")
+
+        self._waiting += 1
+        start = time.perf_counter()
+        try:
+            predictor = await asyncio.wait_for(available.get(), self.checkout_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise PoolExhausted(f"{self.name}: no predictor free after {self.checkout_timeout}s")
+        finally:
+            self._waiting -= 1
+
+        waited = time.perf_counter() - start
+        self._wait_time += waited
+        self._max_wait = max(self._max_wait, waited)
+        self.checkouts += 1
+        return predictor
+
+    def _release(self, predictor: Any, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+        self._queue().put_nowait(predictor)
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Checkout 1 predictor, chạy fn(predictor, *args, **kwargs) trên inference thread, trả predictor về pool.
+        Nếu request bị huỷ giữa chừng, thread vẫn đang dùng predictor -> chỉ trả về pool khi thread chạy xong.
+        """
+        predictor = await self._acquire()
+        task = asyncio.ensure_future(self.run_fn(fn, predictor, *args, **kwargs))
+        task.add_done_callback(lambda done: self._release(predictor, done))
+        return await asyncio.shield(task)
+
+    def metrics(self):
+        available = self._available.qsize() if self._available is not None else self.size
+        return {
+            "size": self.size,
+            "available": available,
+            "in_use": self.size - available,
+            "waiting": self._waiting,
+            "max_waiting": self.max_waiting,
+            "checkouts": self.checkouts,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "avg_wait_ms": round(self._wait_time / self.checkouts * 1000.0, 2) if self.checkouts else 0.0,
+            "max_wait_ms": round(self._max_wait * 1000.0, 2),
+        }
@@ -0,0 +1,63 @@
+"""
+Preload-then-fork: load model weights một lần ở gunicorn master trước khi fork workers.
+Các worker kế thừa weights qua copy-on-write (chỉ đọc khi inference) nên RAM không nhân theo số worker.
+Dùng với gunicorn_conf.py; chạy uvicorn trực tiếp thì module này không làm gì.
+"""
+
+import gc
+import os
+from typing import Any, Callable, Dict, Iterable, Optional
+
+# name -> model đã load ở master (worker thấy cùng object sau fork)
+PRELOADED: Dict[str, Any] = {}
+
+
+def preload_models(loaders: Dict[str, Callable[[], Any]], names: Iterable[str]) -> Dict[str, Any]:
+    """Load các model trong `names` (blocking, gọi ở master trước khi fork)"""
+    import torch
+
+    # Giữ master single-threaded: OpenMP/MKL thread pool khởi tạo trước fork có thể treo ở worker
+    torch.set_num_threads(1)
+
+    for name in names:
+        loader = loaders.get(name)
+        if loader is None:
+            print(f"⚠️  Preload skipped: '{name}' cannot be shared across forked workers")
+            continue
+        model = loader()
+        if model is None:
+            print(f"⚠️  Preload failed: {name} (workers will load it on demand)")
+            continue
+        PRELOADED[name] = model
+        print(f"📦 Preloaded in master: {name}")
+
+    freeze_for_fork()
+    return PRELOADED
+
+
+def freeze_for_fork():
+    """
+    Chuyển mọi object hiện có sang permanent generation: GC của worker không duyệt
+    (và không ghi vào header của) các object preload -> trang nhớ không bị copy-on-write
+    """
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def preloaded_loader(name: str, loader: Callable[[], Any]) -> Callable[[], Any]:
+    """Loader cho ModelRegistry: ưu tiên object đã preload, fallback load riêng trong worker"""
+    def load():
+        model = PRELOADED.get(name)
+        return model if model is not None else loader()
+    return load
+
+
+def configure_worker_threads(num_workers: int, threads: Optional[int] = None) -> int:
+    """Gọi trong worker sau fork: chia CPU cores cho các worker để tránh oversubscription"""
+    import torch
+
+    if not threads or threads <= 0:
+        threads = max(1, (os.cpu_count() or 1) // max(1, num_workers))
+    torch.set_num_threads(threads)
+    return threads
@@ -0,0 +1,192 @@
+"""
+INT8 post-training quantization cho classifier + báo cáo accuracy parity so với FP32
+Chạy: python quantize_classifier.py --calibration-images DIR --eval-images DIR
+
+Cần ảnh da thật: calibration và evaluation là 2 tập riêng (held-out, không trùng file nào),
+không dùng ảnh synthetic -> agreement trong report phản ánh ảnh thật, không phải chính tập calibration.
+Calibration + evaluation đi qua đúng decode + preprocess của server (--preprocess, mặc định theo
+CLASSIFICATION_FAST_PREPROCESS); mode được ghi vào report, server không bật INT8 nếu mode khác.
+Report (top-1 agreement, per-class probability drift, latency, memory, sha256 của model INT8)
+được lưu cạnh model INT8 (*.report.json). Server chỉ bật CLASSIFICATION_BACKEND=int8 khi
+top1_agreement >= CLASSIFICATION_INT8_MIN_AGREEMENT và sha256 khớp file INT8 đang có.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+
+from config import MODEL_PATHS, CLASSIFICATION_FAST_PREPROCESS, CLASSIFICATION_INT8_MIN_AGREEMENT
+from classifier import (
+    SKIN_CLASSES,
+    OnnxClassifier,
+    current_rss_mb,
+    export_onnx,
+    file_sha256,
+    image_paths,
+    load_image_bytes,
+    load_torch_classifier,
+    prepare_classification_bytes,
+    preprocess_mode,
+    quantization_report_path,
+    quantize_onnx_static
+)
+
+
+def measure(model_path: str, backend: str, batch: np.ndarray, repeats: int = 3):
+    """Load session, đo memory tăng thêm và latency single-image (median, ms)"""
+    gc.collect()
+    rss_before = current_rss_mb()
+    model = OnnxClassifier(model_path, backend=backend)
+    probs = model.predict_proba(batch)
+    rss_after = current_rss_mb()
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for sample in batch:
+            model.predict_proba(sample[None])
+        timings.append((time.perf_counter() - start) / len(batch))
+
+    return model, probs, {
+        "latency_ms_per_image": round(float(np.median(timings)) * 1000.0, 3),
+        "session_rss_mb": round(rss_after - rss_before, 1),
+        "file_size_mb": round(os.path.getsize(model_path) / (1024 * 1024), 2),
+    }
+
+
+def per_class_drift(fp32_probs: np.ndarray, int8_probs: np.ndarray):
+    fp32_top1 = fp32_probs.argmax(axis=1)
+    int8_top1 = int8_probs.argmax(axis=1)
+    drift = {}
+    for i, name in enumerate(SKIN_CLASSES[:fp32_probs.shape[1]]):
+        delta = int8_probs[:, i] - fp32_probs[:, i]
+        support = fp32_top1 == i
+        drift[name] = {
+            "mean_abs_drift": round(float(np.abs(delta).mean()), 6),
+            "max_abs_drift": round(float(np.abs(delta).max()), 6),
+            "mean_signed_drift": round(float(delta.mean()), 6),
+            "fp32_top1_count": int(support.sum()),
+            "top1_agreement": round(float(np.mean(int8_top1[support] == i)), 4) if support.any() else None,
+        }
+    return drift
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the skin classifier to INT8 and report parity vs FP32")
+    parser.add_argument("--checkpoint", default=MODEL_PATHS['classification'])
+    parser.add_argument("--fp32", default=MODEL_PATHS['classification_onnx'])
+    parser.add_argument("--output", default=MODEL_PATHS['classification_int8'])
+    parser.add_argument("--calibration-images", required=True, help="Directory of representative skin images")
+    parser.add_argument("--eval-images", required=True, help="Held-out skin images, disjoint from calibration")
+    parser.add_argument("--calibration-count", type=int, default=100)
+    parser.add_argument("--eval-count", type=int, default=200)
+    parser.add_argument("--threshold", type=float, default=CLASSIFICATION_INT8_MIN_AGREEMENT)
+    parser.add_argument("--preprocess", choices=["fast", "torchvision"],
+                        default=preprocess_mode(CLASSIFICATION_FAST_PREPROCESS),
+                        help="Serving preprocess path to calibrate / evaluate on (default: CLASSIFICATION_FAST_PREPROCESS)")
+    parser.add_argument("--skip-quantize", action="store_true", help="Only re-evaluate an existing INT8 model")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print("🧮 INT8 QUANTIZATION - SKIN CLASSIFIER")
+    print("=" * 80)
+    fast = args.preprocess == "fast"
+    print(f"🖼️  Preprocess mode: {args.preprocess} (same decode + preprocess as the server)")
+
+    # Report này quyết định server có bật INT8 hay không -> chỉ chấp nhận ảnh thật, eval held-out
+    calibration_paths = image_paths(args.calibration_images, args.calibration_count)
+    eval_paths = image_paths(args.eval_images, args.eval_count)
+    if not calibration_paths or not eval_paths:
+        print("❌ Calibration and eval directories must both contain images (synthetic images are not accepted)")
+        return 2
+    overlap = {file_sha256(path) for path in calibration_paths} & {file_sha256(path) for path in eval_paths}
+    if overlap:
+        print(f"❌ {len(overlap)} eval image(s) also appear in the calibration set - use a held-out eval set")
+        return 2
+
+    # 1. FP32 ONNX reference (export nếu chưa có)
+    if not os.path.exists(args.fp32):
+        print(f"\n📦 [1/4] FP32 ONNX not found, exporting from {args.checkpoint}...")
+        export_onnx(load_torch_classifier(args.checkpoint, torch.device("cpu")), args.fp32)
+    else:
+        print(f"\n📦 [1/4] Using FP32 ONNX: {args.fp32}")
+
+    # 2. Calibration
+    if not args.skip_quantize:
+        print("\n🎯 [2/4] Calibrating on sample images...")
+        calibration = np.stack([
+            prepare_classification_bytes(data, fast)
+            for data in load_image_bytes(args.calibration_images, count=args.calibration_count)
+        ])
+        start_time = time.time()
+        quantize_onnx_static(args.fp32, args.output, calibration)
+        print(f"    ✓ Quantized with {len(calibration)} calibration images ({time.time() - start_time:.1f}s)")
+    else:
+        print("\n🎯 [2/4] Skipping quantization")
+
+    # 3. Evaluate FP32 vs INT8
+    print("\n📊 [3/4] Evaluating FP32 vs INT8...")
+    batch = np.stack([
+        prepare_classification_bytes(data, fast) for data in load_image_bytes(args.eval_images, count=args.eval_count)
+    ])
+
+    _, fp32_probs, fp32_stats = measure(args.fp32, "onnx", batch)
+    _, int8_probs, int8_stats = measure(args.output, "int8", batch)
+
+    top1_agreement = float(np.mean(fp32_probs.argmax(axis=1) == int8_probs.argmax(axis=1)))
+    drift = per_class_drift(fp32_probs, int8_probs)
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "fp32_model": os.path.abspath(args.fp32),
+        "int8_model": os.path.abspath(args.output),
+        "int8_sha256": file_sha256(args.output),
+        "calibration_dir": os.path.abspath(args.calibration_images),
+        "eval_dir": os.path.abspath(args.eval_images),
+        "preprocess_mode": args.preprocess,
+        "eval_images": len(batch),
+        "top1_agreement": round(top1_agreement, 6),
+        "max_abs_drift": round(float(np.abs(int8_probs - fp32_probs).max()), 6),
+        "per_class": drift,
+        "fp32": fp32_stats,
+        "int8": int8_stats,
+        "speedup": round(fp32_stats["latency_ms_per_image"] / int8_stats["latency_ms_per_image"], 3),
+        "threshold": args.threshold,
+        "passes_threshold": top1_agreement >= args.threshold,
+    }
+
+    # 4. Report
+    print("\n📝 [4/4] Report")
+    print(f"    Top-1 agreement: {top1_agreement * 100:.2f}% (threshold {args.threshold * 100:.2f}%)")
+    print(f"    {'Class':<22}{'n':>5}{'agree':>9}{'mean|Δ|':>11}{'max|Δ|':>10}")
+    for name, stats in drift.items():
+        agree = f"{stats['top1_agreement'] * 100:.1f}%" if stats['top1_agreement'] is not None else "-"
+        print(f"    {name:<22}{stats['fp32_top1_count']:>5}{agree:>9}"
+              f"{stats['mean_abs_drift']:>11.4f}{stats['max_abs_drift']:>10.4f}")
+    print(f"\n    ⏱️  FP32: {fp32_stats['latency_ms_per_image']:.2f} ms/image | "
+          f"INT8: {int8_stats['latency_ms_per_image']:.2f} ms/image ({report['speedup']:.2f}x)")
+    print(f"    💾 FP32: {fp32_stats['file_size_mb']} MB file, +{fp32_stats['session_rss_mb']} MB RSS | "
+          f"INT8: {int8_stats['file_size_mb']} MB file, +{int8_stats['session_rss_mb']} MB RSS")
+
+    report_path = quantization_report_path(args.output)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Saved report: {report_path}")
+
+    if report["passes_threshold"]:
+        print(f"✅ INT8 passes threshold - enable with CLASSIFICATION_BACKEND=int8 "
+              f"(CLASSIFICATION_FAST_PREPROCESS={'1' if fast else '0'})")
+        return 0
+    print("❌ INT8 below threshold - server will keep serving FP32")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
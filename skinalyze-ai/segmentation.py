@@ -0,0 +1,422 @@
+"""
+Skin lesion segmentation (SAM2 fine-tuned) - build model + load checkpoint
+Dùng chung cho API server (main.py) và các tool convert / export / benchmark
+Backend: 'torch' (SAM2ImagePredictor eager) | 'onnx' (OnnxSam2Predictor, xem export_segmentation_onnx.py)
+"""
+
+import io
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+SAM2_CONFIG = "configs/sam2.1/sam2.1_hiera_t.yaml"
+SAM2_RESOLUTION = 1024
+SAM2_BB_FEAT_SIZES = [(256, 256), (128, 128), (64, 64)]  # feature map của 3 level backbone ở 1024x1024
+SAM2_PIXEL_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+SAM2_PIXEL_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def build_sam2_model(device: torch.device) -> nn.Module:
+    """SAM2 architecture (chưa có fine-tuned weights)"""
+    from sam2.build_sam import build_sam2
+
+    return build_sam2(
+        config_file=SAM2_CONFIG,
+        ckpt_path=None,
+        device=device,
+        mode='eval',
+        apply_postprocessing=False
+    )
+
+
+def load_sam2_model(checkpoint_path: str, device: torch.device, safetensors_path: Optional[str] = None) -> nn.Module:
+    """
+    SAM2 model ở eval mode.
+    Ưu tiên safetensors_path (mmap, build trên meta device - xem convert_checkpoints.py),
+    fallback pickle checkpoint gốc (torch.load toàn bộ rồi copy vào model).
+    """
+    if safetensors_path and os.path.exists(safetensors_path):
+        from weights import build_with_mmap_weights
+        print(f"ℹ️ Loading SAM2 ({SAM2_CONFIG}) from memory-mapped weights: {safetensors_path}")
+        return build_with_mmap_weights(build_sam2_model, safetensors_path, device)
+
+    checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
+    print(f"ℹ️ Loading SAM2 with config: {SAM2_CONFIG}")
+
+    sam2_model = build_sam2_model(device)
+    if isinstance(checkpoint, dict) and 'model_state_dict' in checkpoint:
+        sam2_model.load_state_dict(checkpoint['model_state_dict'], strict=False)
+    return sam2_model
+
+
+# =============================================================================
+# WORKING RESOLUTION (SAM2 tự resize về 1024 nên segment ảnh 12MP ở full-res chỉ tốn RAM/CPU)
+# =============================================================================
+def resize_max_side(image: Image.Image, max_side: int) -> Image.Image:
+    """Thu nhỏ để cạnh dài <= max_side (giữ tỉ lệ); max_side <= 0 hoặc ảnh đã nhỏ -> giữ nguyên"""
+    width, height = image.size
+    if not max_side or max_side <= 0 or max(width, height) <= max_side:
+        return image
+    scale = max_side / max(width, height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(size, Image.BILINEAR, reducing_gap=3.0)
+
+
+def decode_for_segmentation(data: bytes, max_side: int = 0, keep_full: bool = False
+                            ) -> Tuple[Image.Image, Optional[Image.Image], Tuple[int, int]]:
+    """
+    Upload bytes -> (working image, full-res image | None, original_size (w, h)).
+    Không cần output full-size thì JPEG được decode thẳng ở độ phân giải thấp (draft) rồi resize về max_side.
+    """
+    image = Image.open(io.BytesIO(data))
+    original_size = image.size
+    if max_side and max_side > 0 and not keep_full and image.format == "JPEG" and max(original_size) > max_side:
+        image.draft("RGB", (max_side, max_side))
+    image = image.convert("RGB")
+    return resize_max_side(image, max_side), (image if keep_full else None), original_size
+
+
+def upsample_mask(mask: np.ndarray, size: Tuple[int, int]) -> Image.Image:
+    """Mask (bool / 0-1 / 0-255) -> ảnh L 0/255 ở `size` (w, h); bilinear + threshold cho biên mượt hơn NEAREST"""
+    mask = np.asarray(mask)
+    binary = mask > (127 if mask.dtype == np.uint8 and mask.max() > 1 else 0.5)
+    mask_image = Image.fromarray(binary.astype(np.uint8) * 255)
+    if mask_image.size == tuple(size):
+        return mask_image
+    return mask_image.resize(tuple(size), Image.BILINEAR).point(lambda value: 255 if value >= 128 else 0)
+
+
+# =============================================================================
+# IMAGE EMBEDDINGS (encoder chạy 1 lần, mask decoder chạy lại với prompt mới)
+# =============================================================================
+def encode_image(predictor, image_np: np.ndarray) -> Dict[str, Any]:
+    """Chạy image encoder (phần đắt) -> embedding dùng lại được cho nhiều lần predict"""
+    try:
+        predictor.set_image(image_np)
+        return {"features": predictor._features, "orig_hw": predictor._orig_hw}
+    finally:
+        predictor.reset_predictor()
+
+
+def embedding_nbytes(embedding: Dict[str, Any]) -> int:
+    """Dung lượng tensors của embedding (cho cache giới hạn theo bytes) - torch tensors hoặc numpy (ONNX)"""
+    features = embedding["features"]
+    tensors = [features["image_embed"], *features["high_res_feats"]]
+    return sum(t.nbytes if isinstance(t, np.ndarray) else t.numel() * t.element_size() for t in tensors)
+
+
+def predict_with_embedding(predictor, embedding: Dict[str, Any], point_coords=None, point_labels=None,
+                           box=None, multimask_output: bool = False):
+    """
+    Chỉ chạy prompt encoder + mask decoder trên embedding có sẵn (vài ms thay vì vài giây).
+    Embedding chỉ được đọc nên cùng 1 embedding có thể dùng đồng thời trên nhiều predictor.
+    """
+    predictor._features = embedding["features"]
+    predictor._orig_hw = embedding["orig_hw"]
+    predictor._is_batch = False
+    predictor._is_image_set = True
+    try:
+        with torch.no_grad():
+            return predictor.predict(
+                point_coords=point_coords,
+                point_labels=point_labels,
+                box=box,
+                multimask_output=multimask_output
+            )
+    finally:
+        predictor.reset_predictor()
+
+
+def segment_image(predictor, image_np: Optional[np.ndarray], embedding: Optional[Dict[str, Any]] = None, **prompts):
+    """
+    1 lần checkout predictor: encode ảnh nếu chưa có embedding rồi decode mask.
+    Returns (embedding, masks, scores, low_res_logits)
+    """
+    if embedding is None:
+        embedding = encode_image(predictor, image_np)
+    masks, scores, logits = predict_with_embedding(predictor, embedding, **prompts)
+    return embedding, masks, scores, logits
+
+
+# =============================================================================
+# ONNX EXPORT (image encoder + prompt encoder / mask decoder thành 2 graph riêng)
+# =============================================================================
+class Sam2ImageEncoder(nn.Module):
+    """
+    image [1, 3, 1024, 1024] (đã normalize) -> image_embed, high_res_feats_0, high_res_feats_1
+    Giống SAM2ImagePredictor.set_image sau bước transforms.
+    """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image: torch.Tensor):
+        backbone_out = self.model.forward_image(image)
+        _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
+        if self.model.directly_add_no_mem_embed:
+            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
+        feats = [
+            feat.permute(1, 2, 0).reshape(1, -1, *feat_size)
+            for feat, feat_size in zip(vision_feats[::-1], SAM2_BB_FEAT_SIZES[::-1])
+        ][::-1]
+        return feats[-1], feats[0], feats[1]
+
+
+class Sam2MaskDecoder(nn.Module):
+    """
+    Embedding + prompt points -> low-res mask logits [1, M, 256, 256] + IoU predictions [1, M] (cả M mask token).
+    point_coords [1, N, 2] ở toạ độ ảnh 1024x1024, point_labels [1, N]: box = 2 điểm label 2 / 3, padding = -1.
+    N = 0 khi không có prompt (/api/segmentation-disease) - được kiểm tra bởi check_sam2_decoder_onnx.
+    Chỉ nhận point / box prompt: dense prompt luôn là no_mask_embed, không có mask_input (mask logits của lần trước).
+    Chọn single / multimask làm ở OnnxSam2Predictor để 1 graph dùng cho cả 2 chế độ.
+    """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def _embed_points(self, coords: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+        # PromptEncoder._embed_points(pad=False) viết lại bằng torch.where thay cho boolean index assignment
+        prompt_encoder = self.model.sam_prompt_encoder
+        embedding = prompt_encoder.pe_layer.forward_with_coords(coords + 0.5, prompt_encoder.input_image_size)
+        labels = labels.unsqueeze(-1)
+        embedding = torch.where(labels == -1, prompt_encoder.not_a_point_embed.weight.expand_as(embedding), embedding)
+        for i in range(prompt_encoder.num_point_embeddings):
+            embedding = embedding + (labels == i).to(embedding.dtype) * prompt_encoder.point_embeddings[i].weight
+        return embedding
+
+    def forward(self, image_embed, high_res_feats_0, high_res_feats_1, point_coords, point_labels):
+        prompt_encoder = self.model.sam_prompt_encoder
+        sparse_embeddings = self._embed_points(point_coords, point_labels)
+        dense_embeddings = prompt_encoder.no_mask_embed.weight.reshape(1, -1, 1, 1).expand(
+            1, -1, *prompt_encoder.image_embedding_size
+        )
+        masks, iou_predictions, _, _ = self.model.sam_mask_decoder.predict_masks(
+            image_embeddings=image_embed,
+            image_pe=prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            repeat_image=False,
+            high_res_features=[high_res_feats_0, high_res_feats_1]
+        )
+        return masks, iou_predictions
+
+
+def _set_onnx_metadata(path: str, metadata: Dict[str, Any]):
+    import onnx
+
+    model = onnx.load(path)
+    for key, value in metadata.items():
+        entry = model.metadata_props.add()
+        entry.key, entry.value = key, str(value)
+    onnx.save(model, path)
+
+
+def export_sam2_onnx(model: nn.Module, encoder_path: str, decoder_path: str, opset: int = 17):
+    """
+    Export SAM2 (eval, CPU) thành 2 graph: image encoder (chạy 1 lần / ảnh) và prompt + mask decoder
+    (chạy cho mỗi prompt, số điểm dynamic). Cấu hình chọn mask của decoder được lưu vào metadata của graph.
+    """
+    model = model.cpu().eval()
+    for path in (encoder_path, decoder_path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    with torch.no_grad():
+        encoder = Sam2ImageEncoder(model).eval()
+        dummy_image = torch.randn(1, 3, SAM2_RESOLUTION, SAM2_RESOLUTION)
+        torch.onnx.export(
+            encoder,
+            dummy_image,
+            encoder_path,
+            input_names=['image'],
+            output_names=['image_embed', 'high_res_feats_0', 'high_res_feats_1'],
+            opset_version=opset,
+            do_constant_folding=True
+        )
+
+        image_embed, high_res_0, high_res_1 = encoder(dummy_image)
+        dummy_coords = torch.tensor([[[300.0, 400.0], [700.0, 800.0], [0.0, 0.0]]])
+        dummy_labels = torch.tensor([[2.0, 3.0, -1.0]])
+        torch.onnx.export(
+            Sam2MaskDecoder(model).eval(),
+            (image_embed, high_res_0, high_res_1, dummy_coords, dummy_labels),
+            decoder_path,
+            input_names=['image_embed', 'high_res_feats_0', 'high_res_feats_1', 'point_coords', 'point_labels'],
+            output_names=['low_res_masks', 'iou_predictions'],
+            dynamic_axes={'point_coords': {1: 'num_points'}, 'point_labels': {1: 'num_points'}},
+            opset_version=opset,
+            do_constant_folding=True
+        )
+
+    decoder = model.sam_mask_decoder
+    _set_onnx_metadata(decoder_path, {
+        "dynamic_multimask_via_stability": int(bool(getattr(decoder, "dynamic_multimask_via_stability", False))),
+        "dynamic_multimask_stability_delta": getattr(decoder, "dynamic_multimask_stability_delta", 0.05),
+        "dynamic_multimask_stability_thresh": getattr(decoder, "dynamic_multimask_stability_thresh", 0.98),
+    })
+
+
+# Prompt cases cho check_sam2_decoder_onnx (toạ độ 1024x1024, đã pad như OnnxSam2Predictor._prompt_points)
+SAM2_DECODER_CHECK_PROMPTS = {
+    "no prompt": (np.zeros((1, 0, 2), dtype=np.float32), np.zeros((1, 0), dtype=np.float32)),
+    "point": (np.array([[[512.0, 512.0], [0.0, 0.0]]], dtype=np.float32), np.array([[1.0, -1.0]], dtype=np.float32)),
+    "box": (np.array([[[300.0, 400.0], [700.0, 800.0], [0.0, 0.0]]], dtype=np.float32),
+            np.array([[2.0, 3.0, -1.0]], dtype=np.float32)),
+    "box + points": (np.array([[[300.0, 400.0], [700.0, 800.0], [500.0, 600.0], [450.0, 500.0], [0.0, 0.0]]],
+                              dtype=np.float32),
+                     np.array([[2.0, 3.0, 1.0, 0.0, -1.0]], dtype=np.float32)),
+}
+
+
+def check_sam2_decoder_onnx(model: nn.Module, decoder_path: str) -> Dict[str, float]:
+    """
+    Chạy decoder ONNX với số điểm khác dummy lúc trace (3 điểm), kể cả 0 điểm (không prompt -> trục
+    num_points rỗng), và so với Sam2MaskDecoder eager trên cùng embedding.
+    Returns {case: max |Δ| của low-res logits + IoU}. Lỗi ONNX Runtime -> RuntimeError kèm tên case.
+    """
+    import onnxruntime as ort
+
+    model = model.cpu().eval()
+    session = ort.InferenceSession(decoder_path, providers=['CPUExecutionProvider'])
+    decoder = Sam2MaskDecoder(model).eval()
+    diffs = {}
+    with torch.no_grad():
+        generator = torch.Generator().manual_seed(0)
+        image = torch.randn(1, 3, SAM2_RESOLUTION, SAM2_RESOLUTION, generator=generator)
+        features = Sam2ImageEncoder(model).eval()(image)
+        inputs = dict(zip(['image_embed', 'high_res_feats_0', 'high_res_feats_1'], (f.numpy() for f in features)))
+        for case, (coords, labels) in SAM2_DECODER_CHECK_PROMPTS.items():
+            ref_masks, ref_iou = decoder(*features, torch.from_numpy(coords), torch.from_numpy(labels))
+            try:
+                masks, iou = session.run(None, {**inputs, "point_coords": coords, "point_labels": labels})
+            except Exception as e:
+                raise RuntimeError(f"ONNX decoder failed for '{case}' ({coords.shape[1]} points): {e}") from e
+            if masks.shape != tuple(ref_masks.shape):
+                raise RuntimeError(f"ONNX decoder output {masks.shape} != {tuple(ref_masks.shape)} for '{case}'")
+            diffs[case] = float(max(np.abs(masks - ref_masks.numpy()).max(), np.abs(iou - ref_iou.numpy()).max()))
+    return diffs
+
+
+# =============================================================================
+# ONNX RUNTIME PREDICTOR (cùng interface SAM2ImagePredictor mà segment_image dùng)
+# =============================================================================
+class Sam2OnnxSessions:
+    """2 InferenceSession dùng chung cho mọi predictor trong pool (session.run thread-safe)"""
+
+    def __init__(self, encoder_path: str, decoder_path: str, intra_op_threads: int = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+
+        providers = ['CPUExecutionProvider']
+        self.encoder = ort.InferenceSession(encoder_path, sess_options=options, providers=providers)
+        self.decoder = ort.InferenceSession(decoder_path, sess_options=options, providers=providers)
+
+        metadata = self.decoder.get_modelmeta().custom_metadata_map
+        self.dynamic_multimask = metadata.get("dynamic_multimask_via_stability", "0") == "1"
+        self.stability_delta = float(metadata.get("dynamic_multimask_stability_delta", 0.05))
+        self.stability_thresh = float(metadata.get("dynamic_multimask_stability_thresh", 0.98))
+
+
+class OnnxSam2Predictor:
+    """
+    SAM2ImagePredictor chạy trên ONNX Runtime: set_image / predict / reset_predictor và các field
+    _features / _orig_hw / _is_image_set / _is_batch mà encode_image / predict_with_embedding dùng.
+    Features là numpy arrays (cache được như torch embedding).
+    """
+
+    mask_threshold = 0.0
+
+    def __init__(self, sessions: Sam2OnnxSessions):
+        self.sessions = sessions
+        self.reset_predictor()
+
+    def reset_predictor(self):
+        self._features = None
+        self._orig_hw = None
+        self._is_image_set = False
+        self._is_batch = False
+
+    @staticmethod
+    def preprocess(image_np: np.ndarray) -> np.ndarray:
+        """RGB uint8 HWC -> [1, 3, 1024, 1024] float32 normalize như SAM2Transforms (resize không giữ tỉ lệ)"""
+        resized = Image.fromarray(np.ascontiguousarray(image_np)).resize(
+            (SAM2_RESOLUTION, SAM2_RESOLUTION), Image.BILINEAR
+        )
+        image = (np.asarray(resized, dtype=np.float32) / 255.0 - SAM2_PIXEL_MEAN) / SAM2_PIXEL_STD
+        return np.ascontiguousarray(image.transpose(2, 0, 1)[None])
+
+    def set_image(self, image_np: np.ndarray):
+        self.reset_predictor()
+        image_embed, high_res_0, high_res_1 = self.sessions.encoder.run(None, {"image": self.preprocess(image_np)})
+        self._features = {"image_embed": image_embed, "high_res_feats": [high_res_0, high_res_1]}
+        self._orig_hw = [tuple(image_np.shape[:2])]
+        self._is_image_set = True
+
+    def _prompt_points(self, point_coords, point_labels, box) -> Tuple[np.ndarray, np.ndarray]:
+        """Prompts (pixel ảnh gốc) -> points ở toạ độ 1024 như SAM2ImagePredictor._prep_prompts + _predict"""
+        height, width = self._orig_hw[0]
+        scale = np.array([SAM2_RESOLUTION / width, SAM2_RESOLUTION / height], dtype=np.float32)
+        coords: List[np.ndarray] = []
+        labels: List[np.ndarray] = []
+        if box is not None:
+            coords.append(np.asarray(box, dtype=np.float32).reshape(-1, 2)[:2] * scale)
+            labels.append(np.array([2, 3], dtype=np.float32))
+        if point_coords is not None:
+            coords.append(np.asarray(point_coords, dtype=np.float32).reshape(-1, 2) * scale)
+            labels.append(np.asarray(point_labels, dtype=np.float32).reshape(-1))
+        if coords:
+            # Prompt encoder pad thêm 1 điểm "not a point" khi không có box riêng (predictor luôn truyền box dạng điểm)
+            coords.append(np.zeros((1, 2), dtype=np.float32))
+            labels.append(np.array([-1], dtype=np.float32))
+            return np.concatenate(coords)[None], np.concatenate(labels)[None]
+        return np.zeros((1, 0, 2), dtype=np.float32), np.zeros((1, 0), dtype=np.float32)
+
+    def _select_masks(self, low_res: np.ndarray, iou: np.ndarray, multimask_output: bool):
+        """MaskDecoder.forward: multimask -> token 1..3, single -> token 0 (hoặc dynamic theo stability)"""
+        if multimask_output:
+            return low_res[:, 1:], iou[:, 1:]
+        if self.sessions.dynamic_multimask:
+            single = low_res[:, 0].reshape(low_res.shape[0], -1)
+            area_i = (single > self.sessions.stability_delta).sum(axis=-1)
+            area_u = (single > -self.sessions.stability_delta).sum(axis=-1)
+            stability = np.where(area_u > 0, area_i / np.maximum(area_u, 1), 1.0)
+            if stability[0] < self.sessions.stability_thresh:
+                best = 1 + int(np.argmax(iou[0, 1:]))
+                return low_res[:, best:best + 1], iou[:, best:best + 1]
+        return low_res[:, 0:1], iou[:, 0:1]
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output: bool = True, return_logits: bool = False):
+        """Returns (masks [C, H, W], iou_predictions [C], low_res_logits [C, 256, 256]) như SAM2ImagePredictor"""
+        if not self._is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        if mask_input is not None:
+            raise ValueError("The ONNX segmentation backend accepts only point / box prompts, not mask_input")
+
+        coords, labels = self._prompt_points(point_coords, point_labels, box)
+        features = self._features
+        low_res, iou = self.sessions.decoder.run(None, {
+            "image_embed": features["image_embed"],
+            "high_res_feats_0": features["high_res_feats"][0],
+            "high_res_feats_1": features["high_res_feats"][1],
+            "point_coords": coords,
+            "point_labels": labels,
+        })
+        low_res, iou = self._select_masks(low_res, iou, multimask_output)
+
+        # postprocess_masks: bilinear (align_corners=False) về kích thước ảnh gốc
+        height, width = self._orig_hw[0]
+        masks = np.stack([cv2.resize(logits, (width, height), interpolation=cv2.INTER_LINEAR) for logits in low_res[0]])
+        if not return_logits:
+            masks = (masks > self.mask_threshold).astype(np.float32)
+        return masks, iou[0], np.clip(low_res[0], -32.0, 32.0)
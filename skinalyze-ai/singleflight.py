@@ -0,0 +1,88 @@
+"""
+Single-flight request coalescing cho các lời gọi LLM
+Các lời gọi đồng thời cùng key (hash prompt cuối + model settings) dùng chung MỘT upstream call
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class _Flight:
+    __slots__ = ("task", "waiters", "label")
+
+    def __init__(self, task: asyncio.Task, label: str):
+        self.task = task
+        self.waiters = 0
+        self.label = label
+
+
+class SingleFlight:
+    """
+    `await flights.do(key, fn)`: caller đầu tiên (leader) chạy `fn()` trong một task riêng,
+    các caller cùng key tới trong lúc task đó chưa xong chờ chung task đó (coalesced).
+
+    - Kết quả / exception của upstream được trả cho MỌI caller đang chờ.
+    - Key bị xoá ngay khi upstream xong -> không cache kết quả hay lỗi, lần gọi sau gọi lại upstream.
+    - Một caller bị huỷ (client ngắt kết nối, timeout) chỉ huỷ phần chờ của chính nó;
+      upstream chỉ bị huỷ khi không còn caller nào chờ.
+    """
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+        self._flights: Dict[Hashable, _Flight] = {}
+
+        # Metrics
+        self._calls = 0
+        self._upstream_calls = 0
+        self._coalesced = 0
+        self._errors = 0
+        self._cancelled = 0
+        self._max_waiters = 0
+        self._coalesced_by_label: Dict[str, int] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]], label: Optional[str] = None) -> Any:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()), label or self.name)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finish(key, flight))
+            self._upstream_calls += 1
+        else:
+            self._coalesced += 1
+            self._coalesced_by_label[flight.label] = self._coalesced_by_label.get(flight.label, 0) + 1
+
+        self._calls += 1
+        flight.waiters += 1
+        self._max_waiters = max(self._max_waiters, flight.waiters)
+        try:
+            # shield: huỷ caller này không huỷ upstream đang dùng chung
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                # Caller cuối cùng bỏ đi -> không ai cần kết quả nữa
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+                self._cancelled += 1
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _finish(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.task.cancelled() and flight.task.exception() is not None:
+            self._errors += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "calls": self._calls,
+            "upstream_calls": self._upstream_calls,
+            "coalesced": self._coalesced,
+            "coalesce_rate": round(self._coalesced / self._calls, 4) if self._calls else 0.0,
+            "coalesced_by_label": dict(self._coalesced_by_label),
+            "errors": self._errors,
+            "upstream_cancelled": self._cancelled,
+            "in_flight": len(self._flights),
+            "max_waiters": self._max_waiters,
+        }
@@ -0,0 +1,129 @@
+"""
+Stress test /api/segmentation-disease: gửi nhiều request đồng thời, kiểm tra mask trả về thuộc đúng ảnh của request
+Chạy (server đang chạy): python stress_test_segmentation.py [--url http://localhost:8000] [--images 8] [--concurrency 16]
+
+1. Sinh N ảnh khác nhau (kích thước + vị trí tổn thương khác nhau), segment tuần tự -> mask tham chiếu
+2. Bắn mỗi ảnh nhiều lần đồng thời (xáo trộn thứ tự)
+3. Mỗi mask phải khớp mask tham chiếu của chính ảnh đó (IoU >= --min-iou) và khớp nó hơn mọi ảnh khác
+"""
+
+import argparse
+import base64
+import io
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from PIL import Image, ImageDraw, ImageFilter
+
+
+def make_image(index: int, seed: int = 0):
+    """Nền màu da + 1 vùng tổn thương tối ở vị trí/kích thước riêng cho mỗi ảnh"""
+    rng = random.Random(seed * 1000 + index)
+    width, height = 512 + 32 * (index % 5), 384 + 32 * (index % 3)
+    image = Image.new("RGB", (width, height), (224, 172, 140))
+
+    draw = ImageDraw.Draw(image)
+    radius_x, radius_y = rng.randint(40, 90), rng.randint(40, 90)
+    cx, cy = rng.randint(radius_x + 10, width - radius_x - 10), rng.randint(radius_y + 10, height - radius_y - 10)
+    draw.ellipse((cx - radius_x, cy - radius_y, cx + radius_x, cy + radius_y), fill=(120, 50, 45))
+    image = image.filter(ImageFilter.GaussianBlur(2))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def segment(url: str, index: int, data: bytes):
+    start = time.perf_counter()
+    response = requests.post(
+        f"{url}/api/segmentation-disease",
+        files={"file": (f"stress_{index}.jpg", data, "image/jpeg")},
+        timeout=300
+    )
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        return index, None, elapsed, response.status_code
+
+    mask = Image.open(io.BytesIO(base64.b64decode(response.json()["mask"]))).convert("L")
+    return index, np.array(mask) > 127, elapsed, 200
+
+
+def iou(a: np.ndarray, b: np.ndarray) -> float:
+    if a.shape != b.shape:
+        return 0.0
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent segmentation stress test (mask isolation)")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=4, help="Concurrent requests per image")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--min-iou", type=float, default=0.98)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print("🧪 SEGMENTATION STRESS TEST (concurrent mask isolation)")
+    print("=" * 80)
+
+    images = [make_image(i, args.seed) for i in range(args.images)]
+
+    # 1. Reference masks (tuần tự)
+    print(f"\n📌 [1/3] Reference masks for {args.images} images (sequential)...")
+    references = {}
+    for i, data in enumerate(images):
+        _, mask, elapsed, status = segment(args.url, i, data)
+        if mask is None:
+            print(f"❌ Reference request failed for image {i}: HTTP {status}")
+            return 1
+        references[i] = mask
+        print(f"    image {i}: {mask.shape[1]}x{mask.shape[0]}, {int(mask.sum())} px, {elapsed:.2f}s")
+
+    # 2. Concurrent burst
+    jobs = [i for i in range(args.images) for _ in range(args.repeats)]
+    random.Random(args.seed).shuffle(jobs)
+    print(f"\n🚀 [2/3] Firing {len(jobs)} requests with concurrency {args.concurrency}...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda i: segment(args.url, i, images[i]), jobs))
+    wall = time.perf_counter() - start
+
+    # 3. Verify isolation
+    print("\n🔍 [3/3] Verifying each mask belongs to its own image...")
+    mismatches, rejected, ious = 0, 0, []
+    for index, mask, _, status in results:
+        if mask is None:
+            rejected += 1  # 503 khi pool quá tải là hành vi hợp lệ (bounded queue)
+            continue
+        own = iou(mask, references[index])
+        best_other = max((iou(mask, ref) for j, ref in references.items() if j != index), default=0.0)
+        ious.append(own)
+        if own < args.min_iou or best_other >= own:
+            mismatches += 1
+            print(f"    ❌ image {index}: IoU own {own:.3f} vs best other {best_other:.3f}")
+
+    latencies = sorted(r[2] for r in results if r[1] is not None)
+    ok = len(latencies)
+    print(f"\n📊 {ok}/{len(jobs)} succeeded, {rejected} rejected (pool busy), {mismatches} mismatched masks")
+    if latencies:
+        print(f"    min IoU vs own reference: {min(ious):.4f}")
+        print(f"    latency p50 {latencies[len(latencies) // 2]:.2f}s | "
+              f"p95 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]:.2f}s | "
+              f"throughput {ok / wall:.2f} req/s")
+
+    if mismatches or not ok:
+        print("\n❌ Mask isolation FAILED")
+        return 1
+    print("\n✅ Every mask matches its own image")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+Test /chat/stream (SSE): time-to-first-byte so với /chat + client ngắt kết nối phải huỷ request Gemini
+Chạy: python test_chat_stream.py [--tokens 20] [--token-delay 0.2] [--retrieval-delay 0.3]
+
+Không gọi Gemini thật: RagStreamer + rag_chain được thay bằng bản giả (retrieval chậm `--retrieval-delay`,
+mỗi token chậm `--token-delay`). App chạy trên uvicorn thật (cần socket thật để client ngắt kết nối giữa chừng).
+- /chat:        byte đầu tiên chỉ tới khi có đủ câu trả lời
+- /chat/stream: retrieval + products ngay sau retrieval, token đầu tiên sau 1 token-delay
+- disconnect:   client đóng stream sau vài token -> upstream stream của Gemini bị huỷ, không chạy hết
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import time
+
+import httpx
+import uvicorn
+
+import main
+
+
+class FakeStreamer:
+    """Thay cho RagStreamer (astream) và rag_chain (ainvoke): cùng độ trễ retrieval + từng token"""
+
+    def __init__(self, tokens: int, token_delay: float, retrieval_delay: float):
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.retrieval_delay = retrieval_delay
+        self.started = 0
+        self.finished = 0
+        self.cancelled = 0
+
+    async def astream(self, question: str):
+        self.started += 1
+        try:
+            await asyncio.sleep(self.retrieval_delay)
+            yield "retrieval", {"chunks": 30, "products": 2, "elapsed_ms": self.retrieval_delay * 1000.0}
+            yield "products", {"products": [{"name": "Fake Cream"}, {"name": "Fake Serum"}]}
+            for i in range(self.tokens):
+                await asyncio.sleep(self.token_delay)
+                yield "token", {"text": f"t{i} "}
+            self.finished += 1
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            raise
+
+    async def ainvoke(self, question: str):
+        answer = []
+        async for event, data in self.astream(question):
+            if event == "token":
+                answer.append(data["text"])
+        return "".join(answer)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def read_events(response, stop_after_tokens: int = None):
+    """Đọc SSE -> [(event, data, giây từ lúc gửi request)]; dừng sớm sau stop_after_tokens token"""
+    events, event, start = [], None, time.perf_counter()
+    async for line in response.aiter_lines():
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            events.append((event, json.loads(line[len("data: "):]), time.perf_counter() - start))
+            tokens = sum(1 for name, _, _ in events if name == "token")
+            if stop_after_tokens is not None and tokens >= stop_after_tokens:
+                break
+    return events
+
+
+async def run(args) -> int:
+    main.load_or_create_vectorstore = lambda: (None, None)
+    fake = FakeStreamer(args.tokens, args.token_delay, args.retrieval_delay)
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    serve = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    main.state.rag_chain = fake
+    main.state.rag_streamer = fake
+    ok = True
+
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            form = {"question": "Tôi cần kem dưỡng cho da khô"}
+
+            start = time.perf_counter()
+            response = await client.post("/chat", data=form)
+            chat_seconds = time.perf_counter() - start
+            response.raise_for_status()
+
+            async with client.stream("POST", "/chat/stream", data=form) as response:
+                events = await read_events(response)
+            names = [name for name, _, _ in events]
+            first_event = events[0][2]
+            first_token = next(at for name, _, at in events if name == "token")
+            done = events[-1][1] if names[-1] == "done" else {}
+
+            print(f"\n    {'endpoint':<16}{'first byte':>12}{'first token':>13}{'complete':>11}")
+            print(f"    {'/chat':<16}{chat_seconds:>11.2f}s{chat_seconds:>12.2f}s{chat_seconds:>10.2f}s")
+            print(f"    {'/chat/stream':<16}{first_event:>11.2f}s{first_token:>12.2f}s{events[-1][2]:>10.2f}s")
+            print(f"    events: {names[:3]} ... {names[-1]} ({names.count('token')} tokens)")
+
+            if names[:2] != ["retrieval", "products"] or names[-1] != "done":
+                ok = False
+                print("    ❌ Expected retrieval, products, tokens..., done")
+            if done.get("answer", "").split() != [f"t{i}" for i in range(args.tokens)]:
+                ok = False
+                print("    ❌ done.answer does not match the streamed tokens")
+            if first_event > args.retrieval_delay + 0.5 or first_event > chat_seconds / 2:
+                ok = False
+                print(f"    ❌ First event after {first_event:.2f}s (retrieval takes {args.retrieval_delay}s)")
+
+            # Client ngắt kết nối sau 3 token -> Gemini stream phải bị huỷ
+            cancelled_before = fake.cancelled
+            async with client.stream("POST", "/chat/stream", data=form) as response:
+                await read_events(response, stop_after_tokens=3)
+            await asyncio.sleep(args.token_delay * 3 + main.CHAT_STREAM_DISCONNECT_POLL_SECONDS)
+            upstream_cancelled = fake.cancelled > cancelled_before
+            print(f"    disconnect after 3 tokens -> upstream cancelled: {upstream_cancelled}")
+            if not upstream_cancelled:
+                ok = False
+                print("    ❌ Upstream LLM stream kept running after the client disconnected")
+
+            print(f"    /metrics chat_stream: {(await client.get('/metrics')).json()['chat_stream']}")
+    finally:
+        server.should_exit = True
+        await serve
+
+    if not ok:
+        return 1
+    print(f"\n✅ First byte after {first_event:.2f}s instead of {chat_seconds:.2f}s; disconnect cancels upstream")
+    return 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="/chat/stream time-to-first-byte and disconnect handling")
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--token-delay", type=float, default=0.2, help="Fake Gemini delay per token (seconds)")
+    parser.add_argument("--retrieval-delay", type=float, default=0.3, help="Fake retrieval latency (seconds)")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print(f"📡 CHAT STREAM TEST ({args.tokens} tokens x {args.token_delay}s, retrieval {args.retrieval_delay}s)")
+    print("=" * 80)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
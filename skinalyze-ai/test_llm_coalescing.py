@@ -0,0 +1,197 @@
+"""
+Test single-flight cho Gemini: N request giống hệt nhau đồng thời -> 1 lời gọi LLM upstream
+Chạy: python test_llm_coalescing.py [--requests 8] [--delay 1.0]
+
+Không gọi Gemini thật: RAG chain + GenerativeModel được thay bằng bản giả đếm số lời gọi.
+- /chat và gợi ý sản phẩm (smart filtering, vd Acne + profile mặc định) với cùng input -> 1 upstream call
+- câu hỏi khác nhau -> không gộp
+- lỗi upstream -> mọi caller đang chờ đều nhận lỗi, lần gọi sau gọi lại upstream
+- huỷ 1 caller -> các caller khác vẫn nhận kết quả; huỷ tất cả -> upstream bị huỷ
+- gợi ý fallback (Gemini trả sai format) không được cache -> request sau gọi lại Gemini
+- profile chỉ khác hoa thường / khoảng trắng -> cùng prompt Gemini, cùng cache entry
+"""
+
+import argparse
+import asyncio
+import sys
+
+import httpx
+
+import RAG_cosmetic
+import main
+from singleflight import SingleFlight
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+RANKED_REPLY = '[{"product_name": "Fake Cream", "reason": "fake"}]'
+
+
+class CountingLLM:
+    """Thay cho RAG chain (ainvoke) và GenerativeModel (generate_content_async), đếm số lời gọi upstream"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.calls = 0
+        self.reply = RANKED_REPLY
+        self.prompts = []
+
+    async def ainvoke(self, query):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return "Gợi ý sản phẩm (fake)"
+
+    async def generate_content_async(self, parts):
+        self.calls += 1
+        self.prompts.append(parts)
+        await asyncio.sleep(self.delay)
+        return FakeResponse(self.reply)
+
+
+class FakeDoc:
+    def __init__(self, name: str):
+        self.metadata = {"product_name": name}
+        self.page_content = f"Product Name: {name}\nChunk type: Product Summary"
+
+
+class FakeVectorStore:
+    async def asimilarity_search(self, query, k=25):
+        return [FakeDoc(f"Product {i}") for i in range(5)]
+
+
+def check(ok: bool, message: str) -> bool:
+    print(f"    {'✅' if ok else '❌'} {message}")
+    return ok
+
+
+async def check_singleflight(delay: float) -> bool:
+    """Semantics của SingleFlight: lỗi, huỷ 1 caller, huỷ tất cả caller"""
+    ok = True
+    flights = SingleFlight(name="test")
+    upstream = {"calls": 0, "cancelled": 0}
+
+    async def failing():
+        upstream["calls"] += 1
+        await asyncio.sleep(delay)
+        raise RuntimeError("quota exceeded")
+
+    results = await asyncio.gather(*(flights.do("fail", failing) for _ in range(4)), return_exceptions=True)
+    ok &= check(upstream["calls"] == 1 and all(isinstance(r, RuntimeError) for r in results),
+                "error is raised to all 4 waiters of one upstream call")
+    await asyncio.gather(flights.do("fail", failing), return_exceptions=True)
+    ok &= check(upstream["calls"] == 2, "errors are not kept: the next call goes upstream again")
+
+    async def slow():
+        upstream["calls"] += 1
+        try:
+            await asyncio.sleep(delay)
+            return "ok"
+        except asyncio.CancelledError:
+            upstream["cancelled"] += 1
+            raise
+
+    upstream["calls"] = 0
+    waiters = [asyncio.create_task(flights.do("slow", slow)) for _ in range(3)]
+    await asyncio.sleep(delay / 4)
+    waiters[0].cancel()
+    results = await asyncio.gather(*waiters, return_exceptions=True)
+    ok &= check(isinstance(results[0], asyncio.CancelledError) and results[1:] == ["ok", "ok"]
+                and upstream["cancelled"] == 0,
+                "cancelling one waiter leaves the shared upstream call running for the others")
+
+    waiters = [asyncio.create_task(flights.do("slow", slow)) for _ in range(3)]
+    await asyncio.sleep(delay / 4)
+    for waiter in waiters:
+        waiter.cancel()
+    await asyncio.gather(*waiters, return_exceptions=True)
+    await asyncio.sleep(0)
+    ok &= check(upstream["cancelled"] == 1 and flights.metrics()["in_flight"] == 0,
+                "cancelling every waiter cancels the upstream call")
+    return ok
+
+
+async def check_endpoints(args) -> bool:
+    ok = True
+    main.load_or_create_vectorstore = lambda: (None, None)
+    llm = CountingLLM(args.delay)
+
+    async with main.app.router.lifespan_context(main.app):
+        main.state.rag_chain = llm
+        main.state.vectorstore = FakeVectorStore()
+        RAG_cosmetic._GEMINI_MODELS[RAG_cosmetic.GEMINI_MODEL_NAME] = llm
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=600) as client:
+            question = {"question": "Tôi cần kem dưỡng cho da khô"}
+            responses = await asyncio.gather(*(client.post("/chat", data=question) for _ in range(args.requests)))
+            ok &= check(all(r.status_code == 200 for r in responses) and llm.calls == 1,
+                        f"/chat: {args.requests} identical questions -> {llm.calls} upstream call(s)")
+
+            llm.calls = 0
+            responses = await asyncio.gather(*(
+                client.post("/chat", data={"question": f"Tôi cần kem dưỡng số {i}"}) for i in range(args.requests)
+            ))
+            ok &= check(all(r.status_code == 200 for r in responses) and llm.calls == args.requests,
+                        f"/chat: {args.requests} different questions -> {llm.calls} upstream calls")
+
+            # Cùng classification + profile mặc định (vd Acne) -> smart filtering gửi cùng 1 prompt
+            llm.calls = 0
+            main.state.suggestion_cache.clear()
+            suggestions = await asyncio.gather(*(
+                main.get_product_suggestions("Acne", None, None, None) for _ in range(args.requests)
+            ))
+            ok &= check(all(s == suggestions[0] and s for s in suggestions) and llm.calls == 1,
+                        f"product suggestions: {args.requests} concurrent 'Acne' + default profile "
+                        f"-> {llm.calls} upstream call(s)")
+
+            # Gemini trả sai format -> danh sách fallback, không được cache (không ghim 30 phút)
+            llm.calls = 0
+            llm.reply = "not json"
+            fallback = await main.get_product_suggestions("Eczema", None, None, None)
+            llm.reply = RANKED_REPLY
+            ranked = await main.get_product_suggestions("Eczema", None, None, None)
+            cached = await main.get_product_suggestions("Eczema", None, None, None)
+            ok &= check(bool(fallback) and fallback[0]["product_name"] != "Fake Cream" and llm.calls == 2
+                        and ranked == cached and ranked[0]["product_name"] == "Fake Cream",
+                        f"fallback suggestions are not cached: next request called Gemini again "
+                        f"({llm.calls} upstream calls, ranked result cached)")
+
+            # Profile chỉ khác hoa thường / khoảng trắng -> cache key và prompt đều dùng giá trị đã normalize
+            llm.calls = 0
+            llm.prompts.clear()
+            first = await main.get_product_suggestions("Psoriasis", 30, "Female", "Fragrance,  Paraben")
+            second = await main.get_product_suggestions("Psoriasis", 30, " female ", "fragrance, paraben")
+            ok &= check(llm.calls == 1 and first == second and "fragrance, paraben" in llm.prompts[0],
+                        f"profile differing only in case / whitespace -> 1 normalized prompt, "
+                        f"{llm.calls} upstream call(s)")
+
+            print(f"    /metrics llm_coalescing: {(await client.get('/metrics')).json()['llm_coalescing']}")
+    return ok
+
+
+async def run(args) -> int:
+    ok = await check_singleflight(args.delay)
+    ok &= await check_endpoints(args)
+    if not ok:
+        print("\n❌ Single-flight coalescing failed")
+        return 1
+    print("\n✅ Identical concurrent LLM requests share one upstream call")
+    return 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Identical concurrent LLM requests must share one upstream call")
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--delay", type=float, default=1.0, help="Fake Gemini latency per call (seconds)")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print(f"🔗 LLM SINGLE-FLIGHT TEST ({args.requests} concurrent requests, {args.delay}s per LLM call)")
+    print("=" * 80)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,143 @@
+"""
+Concurrency test cho Gemini path: N request LLM chậm song song trong 1 worker phải xong trong ~ thời gian của 1 request
+Chạy: python test_llm_concurrency.py [--requests 8] [--delay 2.0]
+
+Không gọi Gemini thật: RAG chain + GenerativeModel được thay bằng bản giả trả lời sau `--delay` giây,
+rồi bắn N request đồng thời vào app (in-process, 1 event loop = 1 uvicorn worker) cho
+/chat, /analyze-image và /api/analyze-skin-image-vlm.
+- async:    LLM chờ bằng await (như ainvoke / generate_content_async) -> tổng ~ 1 request
+- blocking: LLM chờ bằng time.sleep ngay trong handler (như invoke / generate_content cũ) -> tổng ~ N request
+"""
+
+import argparse
+import asyncio
+import io
+import sys
+import time
+
+import httpx
+import numpy as np
+from PIL import Image
+
+import RAG_cosmetic
+import main
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class SlowLLM:
+    """Thay cho RAG chain (invoke / ainvoke) và GenerativeModel (generate_content / generate_content_async)"""
+
+    def __init__(self, delay: float, blocking: bool):
+        self.delay = delay
+        self.blocking = blocking
+
+    async def _wait(self):
+        if self.blocking:
+            time.sleep(self.delay)  # block cả event loop, như gọi client đồng bộ trong async def
+        else:
+            await asyncio.sleep(self.delay)
+
+    def invoke(self, query):
+        time.sleep(self.delay)
+        return "Gợi ý sản phẩm (fake)"
+
+    async def ainvoke(self, query):
+        await self._wait()
+        return "Gợi ý sản phẩm (fake)"
+
+    def generate_content(self, parts):
+        time.sleep(self.delay)
+        return FakeResponse("MỨC ĐỘ: NHẸ (fake)")
+
+    async def generate_content_async(self, parts):
+        await self._wait()
+        return FakeResponse("MỨC ĐỘ: NHẸ (fake)")
+
+
+def sample_image() -> bytes:
+    rng = np.random.default_rng(0)
+    coarse = rng.normal(0, 14, size=(24, 32, 3)) + np.array([210, 165, 140])
+    image = Image.fromarray(np.clip(coarse, 0, 255).astype(np.uint8)).resize((1024, 768), Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def endpoint_requests(image: bytes):
+    """(tên, số lần gọi LLM nối tiếp trong 1 request, hàm gửi request)"""
+    return [
+        ("/chat", 1, lambda client: client.post(
+            "/chat", data={"question": "Tôi cần kem dưỡng cho da khô"})),
+        ("/analyze-image", 2, lambda client: client.post(
+            "/analyze-image", files={"image": ("skin.jpg", image, "image/jpeg")})),
+        ("/api/analyze-skin-image-vlm", 1, lambda client: client.post(
+            "/api/analyze-skin-image-vlm", files={"file": ("skin.jpg", image, "image/jpeg")})),
+    ]
+
+
+async def measure(client, send, requests: int) -> float:
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(send(client) for _ in range(requests)))
+    wall = time.perf_counter() - start
+    failed = [r.status_code for r in responses if r.status_code != 200]
+    if failed:
+        raise RuntimeError(f"{len(failed)} requests failed: {failed[:5]}")
+    return wall
+
+
+async def run(args) -> int:
+    # Không cần vector store / API key thật: RAG chain được thay bằng bản giả
+    main.load_or_create_vectorstore = lambda: (None, None)
+    # Cùng 1 ảnh được gửi nhiều lần -> tắt VLM cache để mọi request đều thực sự chờ LLM
+    main.VLM_CACHE_ENABLED = False
+    # ... và tắt single-flight: request giống hệt nhau sẽ dùng chung 1 lời gọi LLM, không đo được blocking
+    main.LLM_SINGLEFLIGHT_ENABLED = False
+    image = sample_image()
+    ok = True
+
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=600) as client:
+            print(f"\n    {'endpoint':<30}{'mode':<10}{'1 request':>12}{f'{args.requests} parallel':>14}{'ratio':>8}")
+            for name, llm_calls, send in endpoint_requests(image):
+                for blocking in (False, True):
+                    llm = SlowLLM(args.delay, blocking)
+                    main.state.rag_chain = llm
+                    RAG_cosmetic._GEMINI_MODELS[RAG_cosmetic.GEMINI_MODEL_NAME] = llm
+
+                    single = await measure(client, send, 1)
+                    wall = await measure(client, send, args.requests)
+                    ratio = wall / single
+                    mode = "blocking" if blocking else "async"
+                    print(f"    {name:<30}{mode:<10}{single:>11.2f}s{wall:>13.2f}s{ratio:>7.1f}x")
+                    if not blocking and ratio > 1 + args.tolerance:
+                        ok = False
+                        print(f"    ❌ {name}: {args.requests} parallel requests took {ratio:.1f}x one request "
+                              f"(expected <= {1 + args.tolerance:.1f}x, {llm_calls} LLM call(s) each)")
+
+    if not ok:
+        print("\n❌ LLM calls are blocking the event loop")
+        return 1
+    print(f"\n✅ {args.requests} parallel slow LLM requests finish in about the time of one (async path)")
+    return 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Parallel slow LLM calls must not serialize the worker")
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--delay", type=float, default=2.0, help="Fake Gemini latency per call (seconds)")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed slowdown vs one request")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 80)
+    print(f"⏱️  LLM CONCURRENCY TEST ({args.requests} parallel requests, {args.delay}s per LLM call)")
+    print("=" * 80)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
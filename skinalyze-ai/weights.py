@@ -0,0 +1,86 @@
+"""
+Memory-mapped safetensors checkpoints
+Weights được map thẳng từ file (không unpickle, không giữ thêm bản copy khi load_state_dict):
+model build trên meta device rồi assign tensor mmap vào parameters. Convert: python convert_checkpoints.py
+"""
+
+import os
+from typing import Any, Callable, Dict, Optional
+
+import torch
+import torch.nn as nn
+
+
+def safetensors_path(checkpoint_path: str) -> str:
+    """models/foo.pt -> models/foo.safetensors"""
+    return os.path.splitext(checkpoint_path)[0] + ".safetensors"
+
+
+def extract_state_dict(checkpoint: Any) -> Dict[str, torch.Tensor]:
+    """state_dict từ checkpoint: full model object, {'model_state_dict': ...}, {'model': ...} (SAM2) hoặc state_dict"""
+    if isinstance(checkpoint, nn.Module):
+        return checkpoint.state_dict()
+    for key in ('model_state_dict', 'model', 'state_dict'):
+        if isinstance(checkpoint, dict) and isinstance(checkpoint.get(key), dict):
+            return checkpoint[key]
+    return {k: v for k, v in checkpoint.items() if isinstance(v, torch.Tensor)}
+
+
+def save_state_dict(state_dict: Dict[str, torch.Tensor], path: str, metadata: Optional[Dict[str, Any]] = None):
+    """Ghi safetensors; tensor được tách storage riêng + contiguous (safetensors không cho shared storage)"""
+    from safetensors.torch import save_file
+
+    tensors = {name: tensor.detach().cpu().contiguous().clone() for name, tensor in state_dict.items()}
+    save_file(tensors, path, metadata={k: str(v) for k, v in (metadata or {}).items()})
+
+
+def read_metadata(path: str) -> Dict[str, str]:
+    """Metadata header (chỉ đọc header, không đọc weights)"""
+    from safetensors import safe_open
+
+    with safe_open(path, framework="pt") as f:
+        return f.metadata() or {}
+
+
+def load_state_dict_mmap(path: str) -> Dict[str, torch.Tensor]:
+    """CPU tensors backed by mmap của file: trang nhớ chỉ được đọc khi dùng, file-backed (chia sẻ được giữa process)"""
+    from safetensors.torch import load_file
+
+    return load_file(path, device="cpu")
+
+
+def _has_meta_tensors(model: nn.Module) -> bool:
+    return any(t.is_meta for t in list(model.parameters()) + list(model.buffers()))
+
+
+def assign_weights(model: nn.Module, state_dict: Dict[str, torch.Tensor], strict: bool = False) -> nn.Module:
+    """load_state_dict(assign=True): parameters trỏ thẳng vào tensor mmap thay vì copy vào tensor đã khởi tạo"""
+    result = model.load_state_dict(state_dict, strict=strict, assign=True)
+    if result.missing_keys:
+        print(f"⚠️  {len(result.missing_keys)} missing keys (e.g. {result.missing_keys[:3]})")
+    if result.unexpected_keys:
+        print(f"⚠️  {len(result.unexpected_keys)} unexpected keys (e.g. {result.unexpected_keys[:3]})")
+    return model
+
+
+def build_with_mmap_weights(build_fn: Callable[[torch.device], nn.Module], path: str, device: torch.device,
+                            strict: bool = False) -> nn.Module:
+    """
+    build_fn(device) dựng architecture. Lần đầu gọi với meta device (không cấp phát / khởi tạo
+    random weights) rồi map weights vào. Nếu checkpoint thiếu tensor nào (còn ở meta)
+    -> build lại trên CPU để giữ giá trị khởi tạo cho phần thiếu.
+    """
+    state_dict = load_state_dict_mmap(path)
+
+    meta = torch.device("meta")
+    with meta:
+        model = build_fn(meta)
+    assign_weights(model, state_dict, strict=strict)
+
+    if _has_meta_tensors(model):
+        print("ℹ️  Checkpoint does not cover every tensor, rebuilding on CPU")
+        model = assign_weights(build_fn(torch.device("cpu")), state_dict, strict=strict)
+
+    model.to(device)
+    model.eval()
+    return model